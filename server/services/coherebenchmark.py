@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Synthetic end-to-end benchmark for cohereexcelparsing.py.
+
+Generates a pricelist and a multi-sheet BOQ workbook (title rows, varying header
+rows, section headers), then runs the matcher against a deterministic fake
+embedding client, one fresh process per run. Reports per-stage wall time,
+embedding API calls, peak RSS and rows/sec as JSON, so runs can be compared
+between versions without spending API credits.
+
+    python coherebenchmark.py --pricelist-rows 5000 --sheets 4 --rows-per-sheet 800 \\
+        --latency 0.2 --repeat 3 --report bench.json -- --fusion rrf
+    python coherebenchmark.py ... --baseline bench.json
+
+Arguments after "--" are passed to the matcher's main().
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from openpyxl import Workbook
+
+MATCHER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cohereexcelparsing.py')
+
+# Vocabulary of the synthetic pricelist and BOQ descriptions
+OPERATIONS = ["Supply and fix", "Supply and install", "Provide", "Excavate for", "Lay", "Cast in situ",
+              "Apply", "Erect", "Form", "Construct"]
+MATERIALS = ["concrete", "blockwork", "brickwork", "reinforcement", "structural steel", "timber", "uPVC",
+             "copper", "ceramic tile", "plasterboard", "bitumen", "granite", "glass", "aluminium"]
+COMPONENTS = ["wall", "slab", "beam", "column", "footing", "pipe", "door frame", "window", "floor finish",
+              "skirting", "ceiling", "roof covering", "manhole", "kerb"]
+DETAILS = ["grade C25/30", "to falls", "in trench", "fair faced", "with sealed joints", "including formwork",
+           "to detail", "2 coats", "class B", "on hardcore bed"]
+UNITS = ["m", "m2", "m3", "nr", "kg", "t", "item"]
+SECTION_TITLES = ["PRELIMINARIES", "SUBSTRUCTURE", "FRAME", "UPPER FLOORS", "ROOF", "EXTERNAL WALLS",
+                  "WINDOWS AND DOORS", "FINISHES", "SERVICES", "EXTERNAL WORKS"]
+NOISE_ITEMS = ["Allow for contingencies", "Provisional sum for statutory fees", "Daywork labour allowance",
+               "Testing and commissioning", "Builder's work in connection"]
+BOQ_HEADER = ["Item", "Description", "Unit", "Qty", "Rate", "Amount"]
+
+# Stages timed in the matcher process: module function name -> stage name
+TIMED_STAGES = {
+    'load_pricelist_enhanced': 'load_pricelist',
+    'extract_workbook_items': 'extract',
+    'match_items': 'match',
+    'match_workbook_pipelined': 'pipeline',  # --pipeline: extract + match, overlapped
+    'write_results': 'write',
+}
+EMBED_STAGES = {'search_document': 'embed_pricelist', 'search_query': 'embed_inquiries'}
+
+def generate_pricelist(path: str, rows: int, seed: int = 0) -> List[Tuple[str, str, float, str]]:
+    """Write a pricelist workbook (ID, Description, Rate, Unit) and return its rows"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(rows):
+        description = (f"{rng.choice(OPERATIONS)} {rng.choice([50, 75, 100, 150, 200, 225, 300])}mm "
+                       f"{rng.choice(MATERIALS)} {rng.choice(COMPONENTS)} {rng.choice(DETAILS)}")
+        if rng.random() < 0.2:
+            letters = ''.join(rng.choice('ABCDEFGHJKLMNPRSTUVWXYZ') for _ in range(2))
+            description += f" ref {letters}-{rng.randrange(1000, 9999)}"
+        items.append((f"P{i + 1:06d}", description, round(rng.uniform(1, 2500), 2), rng.choice(UNITS)))
+
+    # Regular (not write-only) workbooks, so the sheet dimensions are recorded like in Excel-saved files
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Pricelist"
+    ws.append(["ID", "Description", "Rate", "Unit"])
+    for item in items:
+        ws.append(list(item))
+    wb.save(path)
+    return items
+
+def inquiry_description(rng: random.Random, description: str) -> str:
+    """A BOQ wording of a pricelist description: reordered, abbreviated or padded the way estimators write"""
+    words = description.split()
+    roll = rng.random()
+    if roll < 0.3:
+        # Different operation verb
+        for operation in OPERATIONS:
+            if description.startswith(operation):
+                return rng.choice(OPERATIONS) + description[len(operation):]
+    elif roll < 0.5:
+        # Trailing detail dropped
+        return ' '.join(words[:-2])
+    elif roll < 0.7:
+        return description + rng.choice([" as specified", " all in accordance with drawings", " complete"])
+    return description
+
+def generate_boq(path: str, pricelist: List[Tuple[str, str, float, str]], sheets: int, rows_per_sheet: int,
+                 seed: int = 0, noise: float = 0.1):
+    """Write a multi-sheet BOQ workbook whose items are rewordings of pricelist descriptions"""
+    rng = random.Random(seed)
+    wb = Workbook()
+    wb.remove(wb.active)
+    for sheet in range(sheets):
+        ws = wb.create_sheet(f"Bill {sheet + 1}")
+        # Header rows move around between sheets, below a few title rows
+        ws.append([None, f"Benchmark project - Bill No. {sheet + 1}"])
+        for _ in range(rng.randrange(0, 6)):
+            ws.append([])
+        ws.append(BOQ_HEADER)
+
+        written = 0
+        section = 0
+        while written < rows_per_sheet:
+            section += 1
+            ws.append([None, f"{rng.choice(SECTION_TITLES)} - PART {section}"])
+            for position in range(min(rng.randrange(5, 40), rows_per_sheet - written)):
+                if rng.random() < noise:
+                    description = rng.choice(NOISE_ITEMS)
+                else:
+                    description = inquiry_description(rng, rng.choice(pricelist)[1])
+                ws.append([f"{section}.{position + 1}", description, rng.choice(UNITS),
+                           round(rng.uniform(1, 500), 1), None, None])
+                written += 1
+            if rng.random() < 0.3:
+                ws.append([])
+    wb.save(path)
+
+class FakeEmbeddingClient:
+    """
+    Stand-in for cohere.Client with the same embed() signature and response shape.
+
+    Vectors are the matcher's own local character n-gram embeddings, so they are
+    deterministic and similar texts still match; each call sleeps `latency` seconds
+    to mimic the API round trip. Calls and texts are counted across threads.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.texts = 0
+        self.lock = threading.Lock()
+        self.provider = None
+
+    def embed(self, texts: List[str], model: str = None, input_type: str = None,
+              embedding_types: Optional[List[str]] = None, output_dimension: Optional[int] = None,
+              request_options: Optional[Dict[str, Any]] = None) -> SimpleNamespace:
+        import cohereexcelparsing as matcher
+        with self.lock:
+            self.calls += 1
+            self.texts += len(texts)
+            if self.provider is None:
+                self.provider = matcher.LocalNgramProvider()
+
+        if self.latency:
+            time.sleep(self.latency)
+        vectors = self.provider.embed(list(texts), "search_query", output_dimension or matcher.OUTPUT_DIMENSION)
+        return SimpleNamespace(embeddings=SimpleNamespace(float=vectors.tolist()))
+
+def timed(stage: str, fn: Callable, timings: Dict[str, float], results: Dict[str, Any]) -> Callable:
+    """Wrap fn so its wall time accumulates under timings[stage]"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+            results[stage] = result
+            return result
+        finally:
+            timings[stage] += time.perf_counter() - start
+    return wrapper
+
+def run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    """Run the matcher once in this process and measure it (called in the child process)"""
+    sys.path.insert(0, os.path.dirname(MATCHER_PATH))
+    import cohereexcelparsing as matcher
+    logging.getLogger().setLevel(logging.WARNING)
+
+    client = FakeEmbeddingClient(case['latency'])
+    matcher.cohere.Client = lambda *args, **kwargs: client
+
+    timings = defaultdict(float)
+    results = {}
+    for name, stage in TIMED_STAGES.items():
+        setattr(matcher, name, timed(stage, getattr(matcher, name), timings, results))
+
+    embed_texts_cached = matcher.embed_texts_cached
+
+    def timed_embed(client, texts, input_type="search_document", *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return embed_texts_cached(client, texts, input_type, *args, **kwargs)
+        finally:
+            timings[EMBED_STAGES.get(input_type, input_type)] += time.perf_counter() - start
+    matcher.embed_texts_cached = timed_embed
+
+    start = time.perf_counter()
+    if case['entry'] == 'main':
+        sys.argv = [MATCHER_PATH, '--inquiry', case['inquiry'], '--pricelist', case['pricelist'],
+                    '--output', case['output'], '--api-key', 'benchmark', *case['matcher_args']]
+        status = matcher.main()
+        succeeded = status in (None, 0)
+    else:
+        matcher.configure_embedding_dispatch(requests_per_minute=case['requests_per_minute'])
+        descriptions, rates, units, ids = matcher.load_pricelist_enhanced(case['pricelist'])
+        pricelist_df = matcher.pd.DataFrame({'id': ids, 'description': descriptions, 'rate': rates, 'unit': units})
+        cache = matcher.EmbeddingCache(case['cache_dir']) if case['cache_dir'] else None
+        succeeded = matcher.process_all_sheets(case['inquiry'], pricelist_df, 'benchmark', client, cache,
+                                               output_path=case['output']) is not None
+    total = time.perf_counter() - start
+
+    items, matches = results.get('pipeline') or (results.get('extract'), results.get('match'))
+    items = len(items or [])
+    stages = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    if 'pipeline' not in timings:
+        # Scoring, rerank and row assembly: match time not spent embedding. Pipelined stages
+        # overlap (embedding times are summed over concurrent batches), so there is no such split
+        stages['score'] = round(timings['match'] - timings['embed_inquiries'] - timings['embed_pricelist'], 4)
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        'succeeded': succeeded,
+        'total_seconds': round(total, 4),
+        'stage_seconds': stages,
+        'items': items,
+        'matches': len(matches or []),
+        'rows_per_second': round(items / total, 2) if total > 0 else None,
+        'api_calls': client.calls,
+        'api_texts': client.texts,
+        # ru_maxrss is KB on Linux and bytes on macOS
+        'peak_rss_mb': round(max(own, children) / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    }
+
+def median(values: List[float]) -> Optional[float]:
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return round(values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2, 4)
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Median times and rates over the runs; peak RSS is the worst run"""
+    stages = sorted({stage for run in runs for stage in run['stage_seconds']})
+    return {
+        'total_seconds': median([run['total_seconds'] for run in runs]),
+        'stage_seconds': {stage: median([run['stage_seconds'].get(stage) for run in runs]) for stage in stages},
+        'rows_per_second': median([run['rows_per_second'] for run in runs]),
+        'api_calls': median([run['api_calls'] for run in runs]),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+    }
+
+def compare(summary: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    """Ratio of each summary metric to the baseline report's (below 1 is faster / smaller)"""
+    def ratio(new, old):
+        return round(new / old, 3) if new is not None and old else None
+
+    base = baseline['summary']
+    return {
+        'total_seconds': ratio(summary['total_seconds'], base['total_seconds']),
+        'stage_seconds': {stage: ratio(seconds, base['stage_seconds'].get(stage))
+                          for stage, seconds in summary['stage_seconds'].items()},
+        'rows_per_second': ratio(summary['rows_per_second'], base['rows_per_second']),
+        'api_calls': ratio(summary['api_calls'], base['api_calls']),
+        'peak_rss_mb': ratio(summary['peak_rss_mb'], base['peak_rss_mb']),
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    matcher_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, matcher_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description="Synthetic end-to-end benchmark of the price matcher")
+    parser.add_argument('--pricelist-rows', type=int, default=2000, help='Pricelist items to generate')
+    parser.add_argument('--sheets', type=int, default=3, help='BOQ sheets to generate')
+    parser.add_argument('--rows-per-sheet', type=int, default=300, help='BOQ item rows per sheet')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic workbooks')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake embedding call latency in seconds')
+    parser.add_argument('--requests-per-minute', type=float, default=100000,
+                        help='Embedding rate limit in the benchmark (high by default so only latency counts)')
+    parser.add_argument('--entry', choices=['main', 'process_all_sheets'], default='main',
+                        help='Drive the CLI main() or call process_all_sheets directly')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs, each in a fresh process')
+    parser.add_argument('--with-cache', action='store_true',
+                        help='Keep the embedding cache on (in the work directory) so later runs hit it')
+    parser.add_argument('--workdir', help='Directory for the generated workbooks and outputs (default: temporary)')
+    parser.add_argument('--report', help='Write the JSON report here as well as to stdout')
+    parser.add_argument('--baseline', help='Earlier JSON report to compare against')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        with open(args.run_case) as f:
+            result = run_case(json.load(f))
+        with open(args.result, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='matcher-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    pricelist_path = os.path.join(workdir, 'pricelist.xlsx')
+    inquiry_path = os.path.join(workdir, 'inquiry.xlsx')
+
+    start = time.perf_counter()
+    pricelist = generate_pricelist(pricelist_path, args.pricelist_rows, args.seed)
+    generate_boq(inquiry_path, pricelist, args.sheets, args.rows_per_sheet, args.seed + 1)
+    print(f"Generated workbooks in {workdir} ({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+
+    cache_dir = os.path.join(workdir, 'cache') if args.with_cache else None
+    if cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    dispatch_args = ['--requests-per-minute', str(args.requests_per_minute)]
+    cache_args = ['--cache-dir', cache_dir] if cache_dir else ['--no-cache']
+    case = {
+        'entry': args.entry,
+        'pricelist': pricelist_path,
+        'inquiry': inquiry_path,
+        'output': os.path.join(workdir, 'results.xlsx'),
+        'latency': args.latency,
+        'requests_per_minute': args.requests_per_minute,
+        'cache_dir': cache_dir,
+        'matcher_args': dispatch_args + cache_args + matcher_args,
+    }
+    case_path = os.path.join(workdir, 'case.json')
+    with open(case_path, 'w') as f:
+        json.dump(case, f)
+
+    runs = []
+    for run in range(args.repeat):
+        result_path = os.path.join(workdir, f'run-{run + 1}.json')
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', case_path,
+                                    '--result', result_path], cwd=workdir,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if completed.returncode != 0 or not os.path.exists(result_path):
+            print(completed.stderr, file=sys.stderr)
+            print(f"Benchmark run {run + 1} failed", file=sys.stderr)
+            return 1
+        with open(result_path) as f:
+            runs.append(json.load(f))
+        print(f"Run {run + 1}/{args.repeat}: {runs[-1]['total_seconds']:.2f}s", file=sys.stderr)
+
+    with open(MATCHER_PATH, 'rb') as f:
+        matcher_sha256 = hashlib.sha256(f.read()).hexdigest()
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'matcher_sha256': matcher_sha256,
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'pricelist_rows': args.pricelist_rows,
+            'sheets': args.sheets,
+            'rows_per_sheet': args.rows_per_sheet,
+            'seed': args.seed,
+            'latency': args.latency,
+            'entry': args.entry,
+            'with_cache': args.with_cache,
+            'matcher_args': matcher_args,
+        },
+        'runs': runs,
+        'summary': summarize(runs),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print("Warning: baseline was run with a different configuration", file=sys.stderr)
+        report['comparison'] = compare(report['summary'], baseline)
+
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text)
+    print(text)
+    return 0 if all(run['succeeded'] for run in runs) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,18 +7,38 @@ import sys
 import json
 import logging
 import time
+import hashlib
+import inspect
+import sqlite3
+import shutil
+import socket
+import socketserver
+import queue
+import subprocess
+import multiprocessing
+import threading
+import zlib
+import base64
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from itertools import chain, islice
 from datetime import datetime
-from typing import List, Tuple, Dict, Optional, Any, Union
+from functools import lru_cache
+from typing import List, Tuple, Dict, Optional, Any, Union, Callable, Iterable, Iterator, Sequence
 import numpy as np
 from openpyxl import load_workbook, Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
 import cohere
 import uuid
 import traceback
 
 import pandas as pd
 from scipy.spatial.distance import cosine
+from scipy import sparse
 
 # Configure logging
 logging.basicConfig(
@@ -91,17 +111,72 @@ STOP_WORDS = {
 EMBED_BATCH = 90  # Slightly reduced for stability
 EMBED_MODEL = "embed-v4.0"
 OUTPUT_DIMENSION = 1536
+EMBED_DIMENSIONS = (256, 512, 1024, 1536)  # Output dimensions embed-v4.0 can return
+LOCAL_EMBED_MODEL = "local-char-ngram-v1"  # Offline hashed character n-gram TF-IDF vectors
+LOCAL_NGRAM_RANGE = (3, 5)  # Character n-gram lengths of the local embedder
+EMBEDDERS = ('cohere', 'local', 'auto')  # auto = Cohere, falling back to local if the API fails
 SIMILARITY_THRESHOLD = 0.3  # Minimum similarity score to consider a match
 MAX_RETRIES = 3
 RETRY_DELAY = 1.0
+MAX_RATE_LIMIT_RETRIES = 8  # 429 responses are retried separately from other failures
+EMBED_CONCURRENCY = int(os.getenv('EMBED_CONCURRENCY', '4'))  # Embedding batches in flight at once
+EMBED_REQUESTS_PER_MINUTE = float(os.getenv('EMBED_REQUESTS_PER_MINUTE', '100'))
+EMBED_TOKENS_PER_MINUTE = float(os.getenv('EMBED_TOKENS_PER_MINUTE', '0'))  # 0 = no token limit
+EMBED_CACHE_DIR = os.getenv('EMBED_CACHE_DIR', os.path.join('cache', 'embeddings'))
+EMBED_BROKER_SOCKET = os.getenv('EMBED_BROKER_SOCKET')  # Unix socket of a shared embed-broker, if one runs
+BROKER_LINGER_SECONDS = 0.05  # How long the broker holds a partial batch open for other jobs' texts
+EMBED_CACHE_MAX_MB = 1024  # Least recently used entries are evicted above this size
+CACHE_WRITE_BATCHES = 8  # Embedding batches between cache writes, so an interrupted job keeps what it paid for
+JOB_CHECKPOINT_DIR = os.getenv('JOB_CHECKPOINT_DIR', os.path.join('cache', 'jobs'))
+TOP_K = 5  # Ranked candidates kept per inquiry item
+SCORING_CHUNK_MB = 256  # Upper bound for one block of the similarity matrix
+IVF_NPROBE = 8  # Cells probed per query when searching an IVF index
+# Quantized scans shortlist top_k * this many candidates for float rescoring; one bit per dimension
+# loses far more ranking detail than int8, so ubinary needs a deeper shortlist for the same recall
+QUANTIZED_RESCORE = {'int8': 10, 'ubinary': 100}
+BM25_K1 = 1.2  # BM25 term frequency saturation
+BM25_B = 0.75  # BM25 document length normalization
+RRF_K = 60  # Reciprocal rank fusion damping constant
+HYBRID_WEIGHT = 0.7  # Dense share of the weighted fusion score
+FUSION_METHODS = ('none', 'rrf', 'weighted')
+COMPACT_TOMBSTONE_RATIO = 0.2  # update-index compacts in the background once this share of rows is tombstoned
+PREPROCESS_CACHE_SIZE = 65536  # Memoized preprocessed texts (and words)
+HEADER_SCAN_ROWS = 15  # Rows searched for a header row
+QTY_SCAN_ROWS = 30  # Rows below the header sampled when guessing the quantity column
+HEADER_BUFFER_ROWS = HEADER_SCAN_ROWS + QTY_SCAN_ROWS  # Rows buffered before streaming the rest of a sheet
+# Extraction workers start from a fresh interpreter: forking the threaded serve worker or pipeline
+# could hand a child locks (sqlite, HTTP client, BLAS) held by another thread at fork time
+EXTRACT_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+PIPELINE_QUEUE_DEPTH = 2  # Sheets buffered between pipeline extraction and batching before extraction waits
+PIPELINE_POLL_SECONDS = 0.1  # How often a waiting pipeline producer checks whether the job was abandoned
+
+# Per-job matching options; CLI flags and worker requests override these
+DEFAULT_MATCH_OPTIONS = {
+    'top_k': TOP_K,
+    'dimension': OUTPUT_DIMENSION,  # Embedding size when the pricelist is embedded per job; an index fixes its own
+    'search': 'exact',  # 'exact', 'ivf', or a quantized scan: 'int8' / 'ubinary'
+    'nprobe': IVF_NPROBE,
+    'rescore': None,  # None uses QUANTIZED_RESCORE for the scan type
+    'fusion': 'none',  # Merge BM25 candidates into the dense top-k: 'rrf' or 'weighted'
+    'hybrid_weight': HYBRID_WEIGHT,
+    'check_recall': False,  # Also run exact search and log recall@k of the approximate one
+    'rerank': True,  # Apply hierarchical_match_scoring boosts to the top-k candidates
+    'extract_workers': 1,  # Processes used to extract sheets; 1 keeps extraction in-process
+    'pipeline': False,  # Overlap extraction, inquiry embedding and search (match_workbook_pipelined)
+}
+
+# Field order of the compact item records returned by sheet extraction workers
+ITEM_FIELDS = ('description', 'original_description', 'enhanced_description', 'quantity',
+               'row_number', 'sheet_name', 'head_title', 'section_context')
 
 class ProgressTracker:
     """Track and report progress during processing"""
     
-    def __init__(self, total_steps: int = 100):
+    def __init__(self, total_steps: int = 100, callback: Optional[Callable[[float, str], None]] = None):
         self.total_steps = total_steps
         self.current_step = 0
         self.start_time = datetime.now()
+        self.callback = callback  # Receives (percentage, message) instead of the PROGRESS stdout line
     
     def update(self, step: int, message: str = ""):
         self.current_step = step
@@ -113,171 +188,471 @@ class ProgressTracker:
             progress_msg += f" - {message}"
         
         logger.info(progress_msg)
-        print(f"PROGRESS: {percentage:.1f}%", flush=True)
+        if self.callback:
+            self.callback(percentage, message)
+        else:
+            print(f"PROGRESS: {percentage:.1f}%", flush=True)
     
     def complete(self, message: str = "Processing completed"):
         elapsed = datetime.now() - self.start_time
         logger.info(f"{message} in {elapsed.total_seconds():.2f} seconds")
 
-def enhanced_preprocess(text: str, synonym_map: Dict[str, str], stop_words: set) -> str:
-    """Enhanced text preprocessing with better normalization"""
-    if not text or text is None or (hasattr(text, '__len__') and len(str(text).strip()) == 0):
-        return ""
-    
-    # Convert to string and lowercase
-    s = str(text).lower().strip()
-    
-    # Remove special characters but preserve spaces and alphanumeric
-    s = re.sub(r"[^\w\s]", " ", s)
-    
-    # Normalize units and measurements
-    s = re.sub(r"\b\d+(?:\.\d+)?\s*(mm|cm|m|inch|in|ft|feet|yard|yd)\b", " UNIT ", s)
-    
-    # Normalize numbers
-    s = re.sub(r"\b\d+(?:\.\d+)?\b", " NUM ", s)
-    
-    # Remove extra whitespace
-    s = re.sub(r"\s+", " ", s).strip()
-    
-    # Apply synonyms and stemming
-    words = []
-    for word in s.split():
+class JobMetrics:
+    """
+    Span timings and counters for one job, written as JSON with --metrics.
+
+    Spans aggregate by name (total seconds, count, slowest), so a span entered once
+    per sheet or per embedding batch reports the sum over the job. Dotted names
+    nest stages: "embed.batch" is part of "embed.search_query". Spans and counters
+    may be recorded from worker threads.
+    """
+
+    def __init__(self, job_id: Optional[str] = None):
+        self.job_id = job_id
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.counters = defaultdict(float)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float, count: int = 1, slowest: Optional[float] = None):
+        with self.lock:
+            span = self.spans.setdefault(name, {'seconds': 0.0, 'count': 0, 'max_seconds': 0.0})
+            span['seconds'] += seconds
+            span['count'] += count
+            span['max_seconds'] = max(span['max_seconds'], seconds if slowest is None else slowest)
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def merge(self, other: Dict[str, Any]):
+        """Add the spans and counters of a to_dict() from another process"""
+        for name, span in other.get('spans', {}).items():
+            self.record(name, span['seconds'], span['count'], span['max_seconds'])
+        for name, value in other.get('counters', {}).items():
+            self.count(name, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'job_id': self.job_id,
+                'started_at': self.started_at.isoformat(),
+                'wall_seconds': round(time.perf_counter() - self.start, 4),
+                'spans': {name: {'seconds': round(span['seconds'], 4), 'count': span['count'],
+                                 'max_seconds': round(span['max_seconds'], 4)}
+                          for name, span in sorted(self.spans.items())},
+                'counters': {name: round(value, 4) if isinstance(value, float) and not value.is_integer()
+                             else int(value) for name, value in sorted(self.counters.items())},
+            }
+
+# Metrics of the job running in this context; None outside a job, so recording is a no-op
+_job_metrics: contextvars.ContextVar[Optional[JobMetrics]] = contextvars.ContextVar('job_metrics', default=None)
+
+@contextmanager
+def collect_metrics(metrics: JobMetrics):
+    """Record spans and counters from this context (and tasks it hands to thread pools) into metrics"""
+    token = _job_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _job_metrics.reset(token)
+
+@contextmanager
+def metric_span(name: str):
+    metrics = _job_metrics.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.span(name):
+        yield
+
+def count_metric(name: str, value: float = 1):
+    metrics = _job_metrics.get()
+    if metrics is not None:
+        metrics.count(name, value)
+
+def emit_metrics(metrics: JobMetrics, destination: str):
+    """Write metrics JSON to a file, or as a METRICS: line on stdout when destination is '-'"""
+    payload = json.dumps(metrics.to_dict())
+    if destination == '-':
+        print(f"METRICS: {payload}", flush=True)
+    else:
+        with open(destination, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        logger.info(f"Metrics written to: {destination}")
+
+class TextPreprocessor:
+    """
+    Compiled form of the enhanced preprocessing pipeline.
+
+    Lowercases, replaces punctuation, rewrites measurements and bare numbers as
+    UNIT / NUM in one substitution pass, then maps synonyms, strips the longest
+    stemming suffix and drops stop words and short words. Whole texts and single
+    words are memoized, since BOQs repeat the same phrases many times over.
+    """
+
+    PUNCTUATION = re.compile(r"[^\w\s]")
+    # Measurement first, then bare number, at each position (same as two sequential passes)
+    NUMBERS = re.compile(r"\b\d+(?:\.\d+)?(?:\s*(mm|cm|m|inch|in|ft|feet|yard|yd)\b|\b)")
+    # Longest suffix first, matching what a regex alternation anchored with $ strips
+    STEM_SUFFIXES = ('ings', 'tion', 'sion', 'ing', 'ed', 'es', 's')
+
+    def __init__(self, synonym_map: Dict[str, str], stop_words: set, cache_size: int = PREPROCESS_CACHE_SIZE):
+        self.synonym_map = dict(synonym_map)
+        self.stop_words = frozenset(stop_words)
+        self._memo = lru_cache(maxsize=cache_size, typed=True)(self._process)
+        self._word = lru_cache(maxsize=cache_size)(self._normalize_word)
+
+    def __call__(self, text: Any) -> str:
+        try:
+            return self._memo(text)
+        except TypeError:  # Unhashable input
+            return self._process(text)
+
+    def batch(self, texts: Iterable[Any]) -> List[str]:
+        """Preprocess a list of descriptions, computing each distinct text once"""
+        return [self(text) for text in texts]
+
+    def cache_info(self):
+        return self._memo.cache_info()
+
+    @staticmethod
+    def _replace_number(match: re.Match) -> str:
+        return " UNIT " if match.group(1) else " NUM "
+
+    def _normalize_word(self, word: str) -> Optional[str]:
         # Apply synonym mapping
-        word = synonym_map.get(word, word)
+        word = self.synonym_map.get(word, word)
         
         # Simple stemming for common suffixes
         if len(word) > 4:
-            word = re.sub(r"(ings|ing|ed|es|s|tion|sion)$", "", word)
+            for suffix in self.STEM_SUFFIXES:
+                if word.endswith(suffix):
+                    word = word[:-len(suffix)]
+                    break
         
         # Filter out stop words and very short words
-        if word not in stop_words and len(word) > 2:
-            words.append(word)
-    
-    return " ".join(words)
+        if word not in self.stop_words and len(word) > 2:
+            return word
+        return None
 
-def embed_texts_with_retry(client: cohere.Client, texts: List[str], input_type: str = "search_document") -> np.ndarray:
-    """Embed texts with retry logic and better error handling"""
-    embeddings = []
+    def _process(self, text: Any) -> str:
+        if not text or text is None or (hasattr(text, '__len__') and len(str(text).strip()) == 0):
+            return ""
+        
+        s = self.PUNCTUATION.sub(" ", str(text).lower().strip())
+        s = self.NUMBERS.sub(self._replace_number, s)
+        
+        words = []
+        for word in s.split():
+            word = self._word(word)
+            if word:
+                words.append(word)
+        return " ".join(words)
+
+_preprocessor = TextPreprocessor(SYNONYM_MAP, STOP_WORDS)
+
+def enhanced_preprocess(text: str, synonym_map: Dict[str, str] = SYNONYM_MAP, stop_words: set = STOP_WORDS) -> str:
+    """Enhanced text preprocessing with better normalization"""
+    if synonym_map is SYNONYM_MAP and stop_words is STOP_WORDS:
+        return _preprocessor(text)
+    return TextPreprocessor(synonym_map, stop_words, cache_size=0)(text)
+
+def preprocess_batch(texts: Iterable[Any]) -> List[str]:
+    """enhanced_preprocess with the default synonym map and stop words over a list of descriptions"""
+    with metric_span('preprocess'):
+        return _preprocessor.batch(texts)
+
+def parse_embed_response(resp) -> List[List[float]]:
+    """Extract float embeddings from a Cohere embed response across SDK response formats"""
+    # Debug: Log response structure
+    logger.debug(f"API response type: {type(resp)}")
+    logger.debug(f"API response has embeddings: {hasattr(resp, 'embeddings')}")
     
-    for i in range(0, len(texts), EMBED_BATCH):
-        batch = texts[i:i+EMBED_BATCH]
-        batch_num = (i // EMBED_BATCH) + 1
-        total_batches = (len(texts) + EMBED_BATCH - 1) // EMBED_BATCH
+    # Extract embeddings with proper validation for Cohere v4.0
+    if hasattr(resp, 'embeddings') and resp.embeddings:
+        # For Cohere v4.0, embeddings is an EmbedByTypeResponseEmbeddings object
+        batch_embeddings_raw = resp.embeddings
+        logger.debug(f"Batch embeddings type: {type(batch_embeddings_raw)}")
         
-        logger.info(f"Processing embedding batch {batch_num}/{total_batches} ({len(batch)} items)")
+        # Try to access the float embeddings
+        embeddings_list = []
+        
+        # Method 1: Try to access 'float' attribute (Cohere v4.0)
+        float_embeddings = getattr(batch_embeddings_raw, 'float', None)
+        if float_embeddings is not None:
+            logger.debug(f"Found float embeddings (v4.0 format)")
+            logger.debug(f"Float embeddings type: {type(float_embeddings)}")
+            logger.debug(f"Float embeddings length: {len(float_embeddings)}")
+            
+            # Each embedding should be a list of floats
+            for emb in float_embeddings:
+                if isinstance(emb, list) and len(emb) > 100:  # Validate dimension
+                    embeddings_list.append(emb)
+                else:
+                    logger.warning(f"Invalid embedding format: {type(emb)}, length: {len(emb) if hasattr(emb, '__len__') else 'No length'}")
+        
+        # Method 2: Try direct iteration (older formats or direct list)
+        elif isinstance(batch_embeddings_raw, list):
+            logger.debug(f"Found direct list of embeddings (older format)")
+            for emb in batch_embeddings_raw:
+                if isinstance(emb, list) and len(emb) > 100:
+                    embeddings_list.append(emb)
+                else:
+                    logger.warning(f"Invalid direct embedding: {type(emb)}, length: {len(emb) if hasattr(emb, '__len__') else 'No length'}")
         
-        # Add delay between batches to respect rate limits (especially for trial accounts)
-        if batch_num > 1:
-            rate_limit_delay = 2.0  # 2 second delay between batches
-            logger.debug(f"Waiting {rate_limit_delay}s to respect rate limits...")
-            time.sleep(rate_limit_delay)
+        # Method 3: Try iterating and checking attributes
+        elif hasattr(batch_embeddings_raw, '__iter__'):
+            logger.debug(f"Trying attribute-based extraction")
+            for emb in batch_embeddings_raw:
+                if isinstance(emb, list) and len(emb) > 100:
+                    embeddings_list.append(emb)
+                else:
+                    # Try different attribute names
+                    emb_float = getattr(emb, 'float', None)
+                    values = getattr(emb, 'values', None)
+                    embedding = getattr(emb, 'embedding', None)
+                    
+                    if emb_float is not None and isinstance(emb_float, list) and len(emb_float) > 100:
+                        embeddings_list.append(emb_float)
+                    elif values is not None and hasattr(values, '__iter__') and len(list(values)) > 100:
+                        embeddings_list.append(list(values))
+                    elif embedding is not None and hasattr(embedding, '__iter__') and len(list(embedding)) > 100:
+                        embeddings_list.append(list(embedding))
+                    else:
+                        logger.warning(f"Could not extract valid embedding from: {type(emb)}")
+                        continue
         
-        for attempt in range(MAX_RETRIES):
+        if not embeddings_list:
+            logger.error(f"No valid embeddings extracted from batch")
+            logger.error(f"Raw embeddings type: {type(batch_embeddings_raw)}")
+            logger.error(f"Raw embeddings type: {type(batch_embeddings_raw)}")
+            # Safe length check for type checker
             try:
+                # Type-safe length check
+                raw_len = getattr(batch_embeddings_raw, '__len__', None)
+                if raw_len is not None:
+                    logger.error(f"Raw embeddings length: {raw_len()}")
+            except:
+                pass
+            raise ValueError(f"No valid embeddings extracted from batch. Raw type: {type(batch_embeddings_raw)}")
+        
+        logger.debug(f"Extracted {len(embeddings_list)} embeddings from batch")
+        if embeddings_list:
+            logger.debug(f"First embedding length: {len(embeddings_list[0])}")
+            logger.debug(f"Expected embedding dimension: {OUTPUT_DIMENSION}")
+        
+        # Validate all embeddings have same dimension
+        first_dim = len(embeddings_list[0])
+        for idx, emb in enumerate(embeddings_list):
+            if len(emb) != first_dim:
+                logger.error(f"Inconsistent embedding dimensions: embedding {idx} has {len(emb)}, expected {first_dim}")
+                raise ValueError(f"Inconsistent embedding dimensions in batch")
+        
+        return embeddings_list
+    else:
+        raise ValueError("No embeddings found in API response")
+
+class RateLimiter:
+    """
+    Token buckets for embedding requests/minute and input tokens/minute, shared by
+    every concurrent batch in the process.
+
+    A 429 response pauses all callers (for Retry-After when the API sends it) and
+    halves the effective rate; each successful request restores 5% of it.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute  # 0 disables the token bucket
+        self.request_allowance = float(max(requests_per_minute, 1))
+        self.token_allowance = float(tokens_per_minute)
+        self.rate_scale = 1.0
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_allowance = min(self.requests_per_minute,
+                                     self.request_allowance + elapsed * self.requests_per_minute * self.rate_scale / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute,
+                                       self.token_allowance + elapsed * self.tokens_per_minute * self.rate_scale / 60)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until one request of the given size may be sent; returns seconds waited"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.request_allowance >= 1 and (not self.tokens_per_minute or self.token_allowance >= tokens):
+                    self.request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self.token_allowance -= tokens
+                    return waited
+                else:
+                    request_wait = (1 - self.request_allowance) * 60 / (self.requests_per_minute * self.rate_scale)
+                    token_wait = 0.0
+                    if self.tokens_per_minute and self.token_allowance < tokens:
+                        token_wait = (tokens - self.token_allowance) * 60 / (self.tokens_per_minute * self.rate_scale)
+                    wait = max(request_wait, token_wait, 0.01)
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, retry_after: Optional[float] = None) -> float:
+        """Record a 429: pause everyone and slow down; returns the pause in seconds"""
+        with self.lock:
+            self.rate_scale = max(self.rate_scale * 0.5, 0.05)
+            pause = retry_after if retry_after else 60 / (self.requests_per_minute * self.rate_scale)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            return pause
+
+    def succeeded(self):
+        with self.lock:
+            self.rate_scale = min(self.rate_scale + 0.05, 1.0)
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE)
+        return _rate_limiter
+
+def configure_embedding_dispatch(concurrency: Optional[int] = None, requests_per_minute: Optional[float] = None,
+                                 tokens_per_minute: Optional[float] = None):
+    """Override the dispatcher settings for this process (CLI flags)"""
+    global EMBED_CONCURRENCY, EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE, _rate_limiter
+    if concurrency is not None:
+        EMBED_CONCURRENCY = max(1, concurrency)
+    if requests_per_minute is not None:
+        EMBED_REQUESTS_PER_MINUTE = requests_per_minute
+    if tokens_per_minute is not None:
+        EMBED_TOKENS_PER_MINUTE = tokens_per_minute
+    with _rate_limiter_lock:
+        _rate_limiter = None
+
+def estimate_tokens(texts: List[str]) -> int:
+    """Rough input token count (about 4 characters per token)"""
+    return sum(len(text) // 4 + 1 for text in texts)
+
+def rate_limit_retry_after(error: Exception) -> Optional[float]:
+    """Return the Retry-After delay if the error is a 429, 0 if it is a 429 without one, else None"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status != 429 and 'TooManyRequests' not in type(error).__name__:
+        return None
+
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After') or 0)
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+@lru_cache(maxsize=None)
+def accepts_output_dimension(client_type: type) -> bool:
+    """Whether client_type.embed takes output_dimension directly (ClientV2 does, the v1 Client does not)"""
+    try:
+        return 'output_dimension' in inspect.signature(client_type.embed).parameters
+    except (TypeError, ValueError):
+        return False
+
+def dispatch_embed_batch(client: cohere.Client, batch: List[str], input_type: str,
+                         dimension: int = OUTPUT_DIMENSION) -> List[List[float]]:
+    """Send one embedding batch through the shared rate limiter, retrying failures and 429s"""
+    limiter = get_rate_limiter()
+    if accepts_output_dimension(type(client)):
+        dimension_kwargs = {'output_dimension': dimension}
+    else:
+        dimension_kwargs = {'request_options': {'additional_body_parameters': {'output_dimension': dimension}}}
+    failures = 0
+    throttles = 0
+
+    while True:
+        waited = limiter.acquire(estimate_tokens(batch))
+        if waited > 0:
+            logger.debug(f"Rate limiter delayed batch by {waited:.2f}s")
+            count_metric('embed_rate_wait_seconds', waited)
+        try:
+            count_metric('embed_requests')
+            with metric_span('embed.request'):
                 resp = client.embed(
                     texts=batch,
                     model=EMBED_MODEL,
                     input_type=input_type,
-                    embedding_types=["float"]
+                    embedding_types=["float"],
+                    **dimension_kwargs
                 )
-                
-                # Debug: Log response structure
-                logger.debug(f"API response type: {type(resp)}")
-                logger.debug(f"API response has embeddings: {hasattr(resp, 'embeddings')}")
-                
-                # Extract embeddings with proper validation for Cohere v4.0
-                if hasattr(resp, 'embeddings') and resp.embeddings:
-                    # For Cohere v4.0, embeddings is an EmbedByTypeResponseEmbeddings object
-                    batch_embeddings_raw = resp.embeddings
-                    logger.debug(f"Batch embeddings type: {type(batch_embeddings_raw)}")
-                    
-                    # Try to access the float embeddings
-                    embeddings_list = []
-                    
-                    # Method 1: Try to access 'float' attribute (Cohere v4.0)
-                    float_embeddings = getattr(batch_embeddings_raw, 'float', None)
-                    if float_embeddings is not None:
-                        logger.debug(f"Found float embeddings (v4.0 format)")
-                        logger.debug(f"Float embeddings type: {type(float_embeddings)}")
-                        logger.debug(f"Float embeddings length: {len(float_embeddings)}")
-                        
-                        # Each embedding should be a list of floats
-                        for emb in float_embeddings:
-                            if isinstance(emb, list) and len(emb) > 100:  # Validate dimension
-                                embeddings_list.append(emb)
-                            else:
-                                logger.warning(f"Invalid embedding format: {type(emb)}, length: {len(emb) if hasattr(emb, '__len__') else 'No length'}")
-                    
-                    # Method 2: Try direct iteration (older formats or direct list)
-                    elif isinstance(batch_embeddings_raw, list):
-                        logger.debug(f"Found direct list of embeddings (older format)")
-                        for emb in batch_embeddings_raw:
-                            if isinstance(emb, list) and len(emb) > 100:
-                                embeddings_list.append(emb)
-                            else:
-                                logger.warning(f"Invalid direct embedding: {type(emb)}, length: {len(emb) if hasattr(emb, '__len__') else 'No length'}")
-                    
-                    # Method 3: Try iterating and checking attributes
-                    elif hasattr(batch_embeddings_raw, '__iter__'):
-                        logger.debug(f"Trying attribute-based extraction")
-                        for emb in batch_embeddings_raw:
-                            if isinstance(emb, list) and len(emb) > 100:
-                                embeddings_list.append(emb)
-                            else:
-                                # Try different attribute names
-                                emb_float = getattr(emb, 'float', None)
-                                values = getattr(emb, 'values', None)
-                                embedding = getattr(emb, 'embedding', None)
-                                
-                                if emb_float is not None and isinstance(emb_float, list) and len(emb_float) > 100:
-                                    embeddings_list.append(emb_float)
-                                elif values is not None and hasattr(values, '__iter__') and len(list(values)) > 100:
-                                    embeddings_list.append(list(values))
-                                elif embedding is not None and hasattr(embedding, '__iter__') and len(list(embedding)) > 100:
-                                    embeddings_list.append(list(embedding))
-                                else:
-                                    logger.warning(f"Could not extract valid embedding from: {type(emb)}")
-                                    continue
-                    
-                    if not embeddings_list:
-                        logger.error(f"No valid embeddings extracted from batch")
-                        logger.error(f"Raw embeddings type: {type(batch_embeddings_raw)}")
-                        logger.error(f"Raw embeddings type: {type(batch_embeddings_raw)}")
-                        # Safe length check for type checker
-                        try:
-                            # Type-safe length check
-                            raw_len = getattr(batch_embeddings_raw, '__len__', None)
-                            if raw_len is not None:
-                                logger.error(f"Raw embeddings length: {raw_len()}")
-                        except:
-                            pass
-                        raise ValueError(f"No valid embeddings extracted from batch. Raw type: {type(batch_embeddings_raw)}")
-                    
-                    logger.debug(f"Extracted {len(embeddings_list)} embeddings from batch")
-                    if embeddings_list:
-                        logger.debug(f"First embedding length: {len(embeddings_list[0])}")
-                        logger.debug(f"Expected embedding dimension: {OUTPUT_DIMENSION}")
-                    
-                    # Validate all embeddings have same dimension
-                    first_dim = len(embeddings_list[0])
-                    for idx, emb in enumerate(embeddings_list):
-                        if len(emb) != first_dim:
-                            logger.error(f"Inconsistent embedding dimensions: embedding {idx} has {len(emb)}, expected {first_dim}")
-                            raise ValueError(f"Inconsistent embedding dimensions in batch")
-                    
-                    embeddings.extend(embeddings_list)
-                    
-                else:
-                    raise ValueError("No embeddings found in API response")
-                
-                break
-                
-            except Exception as e:
-                logger.warning(f"Embedding attempt {attempt + 1} failed: {str(e)}")
-                if attempt == MAX_RETRIES - 1:
-                    raise Exception(f"Failed to get embeddings after {MAX_RETRIES} attempts: {str(e)}")
-                
-                time.sleep(RETRY_DELAY * (attempt + 1))
+            embeddings_list = parse_embed_response(resp)
+            limiter.succeeded()
+            count_metric('embed_texts', len(batch))
+            return embeddings_list
+
+        except Exception as e:
+            retry_after = rate_limit_retry_after(e)
+            if retry_after is not None:
+                throttles += 1
+                if throttles > MAX_RATE_LIMIT_RETRIES:
+                    raise Exception(f"Still rate limited after {MAX_RATE_LIMIT_RETRIES} retries: {str(e)}")
+                pause = limiter.throttled(retry_after)
+                count_metric('embed_throttled')
+                logger.warning(f"Rate limited (429); pausing embedding requests for {pause:.1f}s")
+                continue
+
+            failures += 1
+            count_metric('embed_failures')
+            logger.warning(f"Embedding attempt {failures} failed: {str(e)}")
+            if failures >= MAX_RETRIES:
+                raise Exception(f"Failed to get embeddings after {MAX_RETRIES} attempts: {str(e)}")
+            count_metric('embed_retry_sleep_seconds', RETRY_DELAY * failures)
+            time.sleep(RETRY_DELAY * failures)
+
+def embed_cohere_texts(client: cohere.Client, texts: List[str], input_type: str = "search_document",
+                       dimension: int = OUTPUT_DIMENSION) -> np.ndarray:
+    """Embed texts with the Cohere API, with retry logic and better error handling"""
+    embeddings = []
+    
+    batches = [texts[i:i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+    total_batches = len(batches)
+
+    def embed_batch(batch_num: int, batch: List[str]) -> List[List[float]]:
+        logger.info(f"Processing embedding batch {batch_num}/{total_batches} ({len(batch)} items)")
+        # Each batch span covers its retries, back-off sleeps and rate limiter waits
+        with metric_span('embed.batch'):
+            return dispatch_embed_batch(client, batch, input_type, dimension)
+
+    # Keep several batches in flight; the shared rate limiter paces the actual requests
+    workers = min(EMBED_CONCURRENCY, total_batches)
+    if workers > 1:
+        # Pool threads run each batch in a copy of this context so it reports to the same job metrics
+        contexts = [contextvars.copy_context() for _ in batches]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batch_results = list(pool.map(lambda context, *args: context.run(embed_batch, *args),
+                                          contexts, range(1, total_batches + 1), batches))
+    else:
+        batch_results = [embed_batch(n, batch) for n, batch in enumerate(batches, start=1)]
+
+    for batch_embeddings in batch_results:
+        embeddings.extend(batch_embeddings)
     
     # Convert to numpy array and validate final shape
     try:
@@ -301,11 +676,7 @@ def embed_texts_with_retry(client: cohere.Client, texts: List[str], input_type:
         if len(embeddings_array.shape) != 2:
             raise ValueError(f"Expected 2D embeddings array, got shape {embeddings_array.shape}")
         
-        # Validate embedding dimension (should be 1024+ for embed-v4.0)
-        if embeddings_array.shape[1] < 100:  # Reasonable minimum dimension check
-            raise ValueError(f"Embedding dimension too small: {embeddings_array.shape[1]}, expected ~1024")
-        
-        return embeddings_array
+        return fit_embedding_dimension(embeddings_array, dimension)
         
     except Exception as e:
         logger.error(f"Failed to create embeddings array: {str(e)}")
@@ -319,6 +690,561 @@ def embed_texts_with_retry(client: cohere.Client, texts: List[str], input_type:
                 logger.error(f"First embedding: {embeddings[0]}")
         raise ValueError(f"Failed to create valid embeddings array: {str(e)}")
 
+def fit_embedding_dimension(embeddings: np.ndarray, dimension: int) -> np.ndarray:
+    """Validate embedding width against the requested output dimension, truncating wider vectors"""
+    if embeddings.shape[1] < dimension:
+        raise ValueError(f"Embedding dimension too small: {embeddings.shape[1]}, expected {dimension}")
+    if embeddings.shape[1] > dimension:
+        # embed-v4.0 vectors are Matryoshka-trained, so a leading slice is the reduced embedding
+        logger.warning(f"API returned {embeddings.shape[1]} dimensions, truncating to {dimension}")
+        embeddings = np.ascontiguousarray(embeddings[:, :dimension])
+    return embeddings
+
+class EmbeddingProvider:
+    """Source of embedding vectors behind embed_texts_with_retry.
+
+    model names the vector space: it keys the embedding cache and is recorded in index
+    manifests, so queries are never scored against vectors from another provider.
+    """
+
+    model = EMBED_MODEL
+    cacheable = True  # Worth storing in the persistent embedding cache
+    corpus_dependent = False  # Document vectors depend on the other texts embedded with them
+    fallback: Optional['EmbeddingProvider'] = None  # Used for the whole job if this provider fails
+
+    def embed(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        raise NotImplementedError
+
+class CohereProvider(EmbeddingProvider):
+    """Cohere embed API, paced by the shared rate limiter"""
+
+    def __init__(self, client: cohere.Client, fallback: Optional[EmbeddingProvider] = None):
+        self.client = client
+        self.fallback = fallback
+
+    def embed(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        return embed_cohere_texts(self.client, texts, input_type, dimension)
+
+@lru_cache(maxsize=PREPROCESS_CACHE_SIZE)
+def char_ngram_buckets(word: str, dimension: int) -> Tuple[int, ...]:
+    """Hash buckets of the space-padded character n-grams of one word (crc32, stable across processes)"""
+    padded = f" {word} "
+    return tuple(zlib.crc32(padded[i:i + n].encode('utf-8')) % dimension
+                 for n in range(LOCAL_NGRAM_RANGE[0], LOCAL_NGRAM_RANGE[1] + 1)
+                 for i in range(len(padded) - n + 1))
+
+class LocalNgramProvider(EmbeddingProvider):
+    """Offline lexical embeddings: hashed character n-gram TF-IDF of the preprocessed text.
+
+    N-gram counts are hashed into `dimension` buckets and built as a sparse matrix with
+    sublinear term frequencies. Documents (the pricelist) are also weighted by IDF computed
+    over the texts being embedded, so the usual normalized dot product scores query TF
+    against document TF-IDF. Deterministic and free, but only matches on shared spelling.
+    """
+
+    model = LOCAL_EMBED_MODEL
+    cacheable = False  # Cheaper to recompute than to read back from the cache
+    corpus_dependent = True  # IDF comes from the whole pricelist
+
+    def embed(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            for word in text.split():
+                buckets = char_ngram_buckets(word, dimension)
+                cols.extend(buckets)
+                rows.extend([row] * len(buckets))
+
+        counts = sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)),
+                                   shape=(len(texts), dimension))
+        counts.sum_duplicates()
+        counts.data = 1 + np.log(counts.data)
+        if input_type == "search_document":
+            document_frequency = np.bincount(counts.indices, minlength=dimension)
+            idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+            counts.data *= idf[counts.indices].astype(np.float32)
+
+        vectors = counts.toarray()
+        # Texts with no words would have no direction; give them a flat vector that matches nothing well
+        vectors[counts.getnnz(axis=1) == 0] = 1.0
+        return vectors
+
+class EmbeddingCoalescer:
+    """
+    Merges embedding requests from concurrent jobs into full EMBED_BATCH requests (embed-broker).
+
+    Texts wait in a queue per (input type, dimension). A text that is already queued or in flight
+    is not sent again; every caller asking for it shares one future. A batch goes out once
+    EMBED_BATCH texts are waiting or the oldest has waited `linger` seconds, and only when one of
+    the `concurrency` send slots is free, so texts keep coalescing while the API is busy. Every
+    batch passes through dispatch_embed_batch and so this process's single rate limiter.
+    """
+
+    def __init__(self, client: cohere.Client, linger: float = BROKER_LINGER_SECONDS,
+                 concurrency: Optional[int] = None):
+        self.client = client
+        self.linger = linger
+        self.concurrency = concurrency or EMBED_CONCURRENCY
+        self.queued = {}  # (input_type, dimension) -> {text: future}, in arrival order
+        self.oldest = {}  # (input_type, dimension) -> arrival time of its oldest queued text
+        self.futures = {}  # (input_type, dimension, text) -> future, while queued or in flight
+        self.condition = threading.Condition()
+        self.slots = threading.Semaphore(self.concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.stats = defaultdict(int)
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def submit(self, texts: List[str], input_type: str, dimension: int) -> List[Future]:
+        """One future per text, resolving to its embedding"""
+        futures = []
+        with self.condition:
+            self.stats['requests'] += 1
+            self.stats['texts'] += len(texts)
+            key = (input_type, dimension)
+            for text in texts:
+                future = self.futures.get((input_type, dimension, text))
+                if future is None:
+                    future = self.futures[(input_type, dimension, text)] = Future()
+                    queued = self.queued.setdefault(key, {})
+                    if not queued:
+                        self.oldest[key] = time.monotonic()
+                    queued[text] = future
+                else:
+                    self.stats['deduplicated'] += 1
+                futures.append(future)
+            self.condition.notify()
+        return futures
+
+    def embed(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        vectors = [future.result() for future in self.submit(texts, input_type, dimension)]
+        return np.array(vectors, dtype=np.float32).reshape(len(texts), dimension)
+
+    def _take_batch(self) -> Tuple[Optional[Tuple[str, int, List[str], List[Future]]], Optional[float]]:
+        """A batch that is full or has lingered long enough, else the seconds until one will have"""
+        now = time.monotonic()
+        wait = None
+        for key, queued in self.queued.items():
+            due = self.oldest[key] + self.linger
+            if len(queued) >= EMBED_BATCH or due <= now:
+                texts = list(islice(queued, EMBED_BATCH))
+                futures = [queued.pop(text) for text in texts]
+                if not queued:
+                    del self.queued[key], self.oldest[key]
+                return (*key, texts, futures), None
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    def _dispatch_loop(self):
+        while True:
+            self.slots.acquire()
+            with self.condition:
+                batch, wait = self._take_batch()
+                while batch is None:
+                    self.condition.wait(wait)
+                    batch, wait = self._take_batch()
+            self.pool.submit(self._send, *batch)
+
+    def _send(self, input_type: str, dimension: int, texts: List[str], futures: List[Future]):
+        try:
+            vectors = np.array(dispatch_embed_batch(self.client, texts, input_type, dimension), dtype=np.float32)
+            if vectors.ndim != 2 or len(vectors) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got an array of shape {vectors.shape}")
+            vectors = fit_embedding_dimension(vectors, dimension)
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        finally:
+            with self.condition:
+                for text in texts:
+                    self.futures.pop((input_type, dimension, text), None)
+                self.stats['batches'] += 1
+                self.stats['embedded'] += len(texts)
+            self.slots.release()
+
+def broker_request(socket_path: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Send one JSON request to the embed-broker and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with conn.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError(f"Embedding broker at {socket_path} closed the connection")
+    return json.loads(line)
+
+class BrokerProvider(EmbeddingProvider):
+    """Cohere embeddings through the host's shared embed-broker process
+
+    Requests go out in chunks of a few batches so large pricelists don't become one huge message.
+    If the broker can't be reached, `direct` (a CohereProvider, when this job has an API key)
+    calls the API itself.
+    """
+
+    def __init__(self, socket_path: str, direct: Optional[EmbeddingProvider] = None,
+                 fallback: Optional[EmbeddingProvider] = None):
+        self.socket_path = socket_path
+        self.direct = direct
+        self.fallback = fallback
+
+    def embed(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        try:
+            return self._embed_via_broker(texts, input_type, dimension)
+        except OSError as e:
+            if self.direct is None:
+                raise
+            logger.warning(f"Embedding broker unavailable ({e}); calling the API directly")
+            return self.direct.embed(texts, input_type, dimension)
+
+    def _embed_via_broker(self, texts: List[str], input_type: str, dimension: int) -> np.ndarray:
+        chunk = EMBED_BATCH * EMBED_CONCURRENCY
+        parts = []
+        for start in range(0, len(texts), chunk):
+            batch = texts[start:start + chunk]
+            with metric_span('embed.broker'):
+                reply = broker_request(self.socket_path, {'command': 'embed', 'texts': batch,
+                                                          'input_type': input_type, 'dimension': dimension})
+            if reply.get('event') != 'embeddings':
+                raise RuntimeError(f"Embedding broker failed: {reply.get('message', reply)}")
+            vectors = np.frombuffer(base64.b64decode(reply['data']), dtype=np.float32)
+            width = reply.get('dimension', dimension)
+            if reply['count'] != len(batch) or vectors.size != reply['count'] * width:
+                raise ValueError(f"Embedding broker returned {vectors.size} values for {reply['count']} vectors "
+                                 f"of dimension {width}, expected {len(batch)}")
+            parts.append(fit_embedding_dimension(vectors.reshape(reply['count'], width), dimension))
+            count_metric('embed_broker_requests')
+        return np.concatenate(parts) if parts else np.empty((0, dimension), dtype=np.float32)
+
+# Anything the embedding functions accept: a provider, or a bare Cohere client
+Embedder = Union[cohere.Client, EmbeddingProvider]
+
+def as_embedding_provider(client: Embedder) -> EmbeddingProvider:
+    """Wrap a bare Cohere client; providers pass through unchanged"""
+    if isinstance(client, EmbeddingProvider):
+        return client
+    return CohereProvider(client)
+
+def embed_texts_with_retry(client: Embedder, texts: List[str], input_type: str = "search_document",
+                           dimension: int = OUTPUT_DIMENSION) -> np.ndarray:
+    """Embed texts with the given provider (or Cohere client)"""
+    return as_embedding_provider(client).embed(texts, input_type, dimension)
+
+class EmbeddingCache:
+    """Persistent embedding store shared by all job processes on this host.
+
+    Entries are keyed by a hash of (model, output dimension, input type, preprocessed text),
+    so a pricelist row is only sent to the API the first time its processed text is seen.
+    SQLite in WAL mode handles locking between concurrent jobs; once the stored vectors
+    exceed max_bytes the least recently used entries are evicted.
+    """
+
+    SQL_CHUNK = 500  # Stay well below SQLite's bound-parameter limit
+
+    def __init__(self, cache_dir: str = EMBED_CACHE_DIR, max_bytes: int = EMBED_CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, 'embeddings.sqlite3')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """One transaction on a fresh connection, closed afterwards (long-lived workers would leak handles)"""
+        # Generous busy timeout so concurrent jobs wait for each other's writes instead of failing
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(text: str, input_type: str, model: str = EMBED_MODEL, dimension: int = OUTPUT_DIMENSION) -> str:
+        payload = f"{model}\x00{dimension}\x00{input_type}\x00{text}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return cached vectors for the given keys and refresh their access time"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+
+        with self._connect() as conn:
+            for i in range(0, len(unique_keys), self.SQL_CHUNK):
+                chunk = unique_keys[i:i + self.SQL_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    conn.executemany(
+                        "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows]
+                    )
+
+        self.hits += len(found)
+        self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, vectors: Dict[str, np.ndarray]):
+        """Store vectors and evict old entries if the size bound is exceeded"""
+        if not vectors:
+            return
+
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the store is back under 90% of max_bytes"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            target = int(self.max_bytes * 0.9)
+            freed = 0
+            stale_keys = []
+            for key, size in conn.execute("SELECT key, size FROM embeddings ORDER BY last_access ASC"):
+                stale_keys.append((key,))
+                freed += size
+                if total - freed <= target:
+                    break
+
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", stale_keys)
+            logger.info(f"Embedding cache evicted {len(stale_keys)} entries ({freed / 1024 / 1024:.1f} MB)")
+
+def embed_texts_cached(client: Embedder, texts: List[str], input_type: str = "search_document",
+                       cache: Optional[EmbeddingCache] = None, dimension: int = OUTPUT_DIMENSION) -> np.ndarray:
+    """Embed texts through the persistent cache, sending only cache misses to the API"""
+    with metric_span(f'embed.{input_type}'):
+        return _embed_texts_cached(as_embedding_provider(client), texts, input_type, cache, dimension)
+
+def _embed_texts_cached(provider: EmbeddingProvider, texts: List[str], input_type: str,
+                        cache: Optional[EmbeddingCache], dimension: int) -> np.ndarray:
+    if cache is None or not provider.cacheable:
+        return embed_texts_with_retry(provider, texts, input_type, dimension)
+
+    keys = [EmbeddingCache.make_key(text, input_type, provider.model, dimension) for text in texts]
+    try:
+        cached = cache.get_many(keys)
+    except sqlite3.Error as e:
+        logger.warning(f"Embedding cache read failed, embedding without cache: {e}")
+        return embed_texts_with_retry(provider, texts, input_type, dimension)
+
+    # Embed each missing text once, even if it appears in several rows
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    hits = sum(key in cached for key in keys)
+    logger.info(f"Embedding cache ({input_type}): {hits}/{len(texts)} hits, {len(missing)} unique texts to embed")
+    count_metric('embed_cache_hits', hits)
+    count_metric('embed_cache_misses', len(missing))
+
+    # Store results every few batches rather than at the end: a job killed part way through
+    # (or resumed from a checkpoint) then only re-embeds the batches that never completed
+    pending = list(missing.items())
+    step = EMBED_BATCH * max(CACHE_WRITE_BATCHES, EMBED_CONCURRENCY)
+    for start in range(0, len(pending), step):
+        part = pending[start:start + step]
+        fresh = embed_texts_with_retry(provider, [text for _, text in part], input_type, dimension)
+        fresh_vectors = dict(zip((key for key, _ in part), fresh))
+        try:
+            cache.put_many(fresh_vectors)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+        cached.update(fresh_vectors)
+
+    return np.vstack([cached[key] for key in keys]).astype(np.float32)
+
+class JobCheckpoint:
+    """Per-stage state of one matching job, so a job cut off by a time limit can be resumed.
+
+    Lives in <root>/<job_id>: job.json records what the job was started with, items.json holds the
+    extracted inquiry items, embeddings.sqlite3 the embedding batches completed so far (only used
+    when the shared cache is off, which otherwise keeps them) and matches.json the scored rows.
+    Stage files are replaced atomically, so a killed job never leaves a half-written one behind.
+    """
+
+    MANIFEST = 'job.json'
+    ITEMS = 'items.json'
+    MATCHES = 'matches.json'
+
+    def __init__(self, job_id: str, root: str = JOB_CHECKPOINT_DIR):
+        if not re.fullmatch(r'[\w.-]+', job_id):
+            raise ValueError(f"Invalid job id: {job_id!r}")
+        self.job_id = job_id
+        self.path = os.path.join(root, job_id)
+        self.manifest = self._read(self.MANIFEST) or {}
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.manifest)
+
+    def _read(self, name: str) -> Optional[Any]:
+        try:
+            with open(os.path.join(self.path, name), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {name}: {e}")
+            return None
+
+    def _write(self, name: str, data: Any):
+        os.makedirs(self.path, exist_ok=True)
+        target = os.path.join(self.path, name)
+        with open(f"{target}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f, default=str)
+        os.replace(f"{target}.tmp", target)
+
+    def start(self, inquiry_sha256: str, fingerprint: Dict[str, Any]):
+        """Record the job's inputs, or check a resumed job against them.
+
+        A different inquiry file makes it a different job. A different pricelist, embedder or
+        matching options only invalidates the scored rows; extracted items are still valid and
+        embeddings are keyed by model and dimension anyway.
+        """
+        if self.exists:
+            if self.manifest.get('inquiry_sha256') != inquiry_sha256:
+                raise ValueError(f"Job {self.job_id} was started with a different inquiry file")
+            if self.manifest.get('fingerprint') != fingerprint:
+                logger.info("Pricelist, embedder or options changed since the checkpoint; scoring again")
+                self.discard(self.MATCHES)
+            logger.info(f"Resuming job {self.job_id} from {self.path}")
+        else:
+            logger.info(f"Checkpointing job {self.job_id} to {self.path}")
+        self.manifest = {
+            'job_id': self.job_id,
+            'created': self.manifest.get('created', datetime.now().isoformat()),
+            'inquiry_sha256': inquiry_sha256,
+            'fingerprint': fingerprint,
+        }
+        self._write(self.MANIFEST, self.manifest)
+
+    def load_items(self) -> Optional[List[Dict]]:
+        return self._read(self.ITEMS)
+
+    def save_items(self, items: List[Dict]):
+        self._write(self.ITEMS, items)
+
+    def load_matches(self) -> Optional[List[Dict]]:
+        return self._read(self.MATCHES)
+
+    def save_matches(self, matches: List[Dict]):
+        self._write(self.MATCHES, matches)
+
+    def discard(self, name: str):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def embedding_cache(self) -> EmbeddingCache:
+        """Job-local store for completed embedding batches"""
+        return EmbeddingCache(self.path)
+
+    def remove(self):
+        """Delete the job directory once the job has written its output"""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def frame_sha256(df: pd.DataFrame) -> str:
+    """Content hash of a DataFrame, independent of where it was loaded from"""
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+def match_fingerprint(options: Dict[str, Any], client: Embedder, pricelist_df: pd.DataFrame) -> Dict[str, Any]:
+    """Everything besides the inquiry rows that a job's scores depend on, as plain JSON values"""
+    fingerprint = {key: value for key, value in {**DEFAULT_MATCH_OPTIONS, **options}.items()
+                   if key not in ('extract_workers', 'pipeline')}
+    fingerprint.update(model=as_embedding_provider(client).model, pricelist_sha256=frame_sha256(pricelist_df))
+    return json.loads(json.dumps(fingerprint, default=str))
+
+# Item fields that decide a row's match; quantity and row position only feed total_amount and the output
+MATCH_KEY_FIELDS = ('sheet_name', 'description', 'original_description', 'enhanced_description',
+                    'head_title', 'section_context')
+
+class MatchState:
+    """Row-level outcome of a finished job, so a revised inquiry can be re-matched incrementally.
+
+    rows maps a content hash of each item's MATCH_KEY_FIELDS to its match (None when it scored below
+    the threshold). The results file can't serve this purpose: it omits unmatched rows and the
+    section context that reranking uses. A state only applies to a job with the same fingerprint.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fingerprint: Dict[str, Any], rows: Dict[str, Optional[Dict]]):
+        self.fingerprint = fingerprint
+        self.rows = rows
+
+    @staticmethod
+    def item_key(item: Dict) -> str:
+        payload = '\x00'.join(str(item.get(field) or '') for field in MATCH_KEY_FIELDS)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_matches(cls, items: List[Dict], matches: List[Dict], fingerprint: Dict[str, Any]) -> 'MatchState':
+        by_row = {(match['sheet_name'], match['row_number']): match for match in matches}
+        rows = {}
+        for item in items:
+            rows[cls.item_key(item)] = by_row.get((item['sheet_name'], int(item['row_number'])))
+        return cls(fingerprint, rows)
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'fingerprint': self.fingerprint, 'rows': self.rows}, f, default=str)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved match state for {len(self.rows)} rows: {path}")
+
+    @classmethod
+    def load(cls, path: str) -> 'MatchState':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f"Unsupported match state version {data.get('version')} in {path}")
+        return cls(data['fingerprint'], data['rows'])
+
+def unique_text_table(texts: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Distinct texts in first-seen order, and for each input row the position of its text in that list"""
+    positions = {}
+    text_ids = np.fromiter((positions.setdefault(text, len(positions)) for text in texts),
+                           dtype=np.int64, count=len(texts))
+    return list(positions), text_ids
+
 def load_pricelist_enhanced(path: str) -> Tuple[List[str], List[float], List[str], List[str]]:
     """Load pricelist with enhanced validation and metadata"""
     logger.info(f"Loading pricelist from: {path}")
@@ -405,44 +1331,480 @@ def load_pricelist_enhanced(path: str) -> Tuple[List[str], List[float], List[str
         logger.error(f"Error loading pricelist: {str(e)}")
         raise
 
-def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[int]]:
-    """Enhanced header detection with comprehensive format support"""
-    header_row = None
-    desc_col = None
-    qty_col = None
-    
-    logger.info("=== ADAPTIVE HEADER DETECTION ===")
-    
-    # Search in first 15 rows for headers (more comprehensive)
-    for row_num in range(1, min(16, ws.max_row + 1)):
-        row = ws[row_num]
-        
-        # Debug: Print all headers in this row
-        row_headers = []
-        for col_num, cell in enumerate(row, start=1):
-            if cell.value:
-                row_headers.append(f"Col {col_num}: '{cell.value}'")
-        
-        if len(row_headers) >= 2:  # Only log rows with multiple headers
-            logger.info(f"Row {row_num} headers: {', '.join(row_headers)}")
-        
-        # Check if this row has header-like characteristics
-        header_indicators = 0
-        potential_desc_col = None
-        potential_qty_col = None
-        
-        for col_num, cell in enumerate(row, start=1):
-            if not cell.value:
-                continue
-                
-            cell_value = str(cell.value).lower().strip()
-            
-            # DESCRIPTION COLUMN - Very comprehensive patterns
-            desc_patterns = [
-                'description', 'desc', 'item', 'work', 'activity', 'task', 'operation',
-                'specification', 'spec', 'details', 'particulars', 'trade', 'element',
-                'component', 'material', 'labor', 'labour', 'service', 'works',
-                'ref', 'reference', 'code', 'product', 'title', 'name', 'category'
+class PricelistIndex:
+    """Pricelist metadata plus L2-normalized float32 embeddings, ready for scoring.
+
+    A saved index is a versioned directory holding embeddings.npy (opened with
+    mmap_mode='r' so worker processes share one page-cached copy), metadata.json
+    with the columnar ids/descriptions/rates/units and manifest.json describing
+    how the vectors were produced. The index root keeps a CURRENT file naming the
+    latest version. A version written by update() may also hold tombstones.npy,
+    marking rows that stay in place but are never returned until compact().
+    """
+
+    FORMAT_VERSION = 1
+    EMBEDDINGS_FILE = 'embeddings.npy'
+    METADATA_FILE = 'metadata.json'
+    MANIFEST_FILE = 'manifest.json'
+    TOMBSTONES_FILE = 'tombstones.npy'
+    CURRENT_FILE = 'CURRENT'
+
+    def __init__(self, ids: List[str], descriptions: List[str], rates: List[float], units: List[str],
+                 embeddings: np.ndarray, manifest: Optional[Dict[str, Any]] = None, path: Optional[str] = None,
+                 ivf: Optional['IVFIndex'] = None, quantized: Optional[Dict[str, 'QuantizedEmbeddings']] = None,
+                 bm25: Optional['BM25Index'] = None, tombstones: Optional[np.ndarray] = None):
+        if len(descriptions) != embeddings.shape[0]:
+            raise ValueError(f"Index has {len(descriptions)} descriptions but {embeddings.shape[0]} embeddings")
+        self.ids = ids
+        self.descriptions = descriptions
+        self.rates = rates
+        self.units = units
+        self.embeddings = embeddings
+        self.manifest = manifest or {}
+        self.path = path
+        self.ivf = ivf
+        self.quantized = quantized or {}
+        self._bm25 = bm25
+        self._features = None
+        self.tombstones = tombstones if tombstones is not None and tombstones.any() else None
+        self.dead_rows = np.flatnonzero(self.tombstones) if self.tombstones is not None else None
+
+    def __len__(self) -> int:
+        return len(self.descriptions)
+
+    @property
+    def live(self) -> np.ndarray:
+        """Mask of the rows that are not tombstoned"""
+        if self.tombstones is None:
+            return np.ones(len(self), dtype=bool)
+        return ~self.tombstones
+
+    @property
+    def dimension(self) -> int:
+        """Embedding dimension of the index; inquiries must be embedded at the same size"""
+        return int(self.embeddings.shape[1])
+
+    @classmethod
+    def from_dataframe(cls, pricelist_df: pd.DataFrame, client: Embedder,
+                       cache: Optional[EmbeddingCache] = None,
+                       dimension: int = OUTPUT_DIMENSION) -> 'PricelistIndex':
+        """Embed and normalize a pricelist DataFrame (id, description, rate, unit)"""
+        provider = as_embedding_provider(client)
+        descriptions = pricelist_df['description'].tolist()
+
+        processed = preprocess_batch(descriptions)
+        unique_processed, text_ids = unique_text_table(processed)
+
+        logger.info(f"Generating {dimension}-dimension price embeddings for {len(unique_processed)} distinct texts...")
+        embeddings = embed_texts_cached(provider, unique_processed, "search_document", cache, dimension)[text_ids]
+        embeddings_norm = (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+        manifest = {
+            'format_version': cls.FORMAT_VERSION,
+            'model': provider.model,
+            'dimension': int(embeddings_norm.shape[1]),
+            'count': len(descriptions),
+        }
+        return cls(
+            [str(i) for i in pricelist_df['id'].tolist()],
+            descriptions,
+            [float(r) for r in pricelist_df['rate'].tolist()],
+            pricelist_df['unit'].tolist(),
+            embeddings_norm,
+            manifest
+        )
+
+    @classmethod
+    def build(cls, pricelist_path: str, client: Embedder,
+              cache: Optional[EmbeddingCache] = None,
+              dimension: int = OUTPUT_DIMENSION) -> 'PricelistIndex':
+        """Load a pricelist workbook and embed it"""
+        descriptions, rates, units, ids = load_pricelist_enhanced(pricelist_path)
+        pricelist_df = pd.DataFrame({'id': ids, 'description': descriptions, 'rate': rates, 'unit': units})
+        index = cls.from_dataframe(pricelist_df, client, cache, dimension)
+
+        with open(pricelist_path, 'rb') as f:
+            index.manifest['source_sha256'] = hashlib.sha256(f.read()).hexdigest()
+        index.manifest['source_file'] = os.path.basename(pricelist_path)
+        return index
+
+    @property
+    def features(self) -> 'PricelistFeatures':
+        """Rerank features, built on first use and kept for the lifetime of the index"""
+        if self._features is None:
+            self._features = PricelistFeatures(self.descriptions, self.units)
+        return self._features
+
+    @property
+    def bm25(self) -> 'BM25Index':
+        """Lexical index, built on first use unless the index was saved with it"""
+        if self._bm25 is None:
+            logger.info(f"Building BM25 index for {len(self)} pricelist items")
+            # Tombstoned rows get no postings, so lexical search can't return them either
+            self._bm25 = BM25Index.build([lexical_text(desc) if live else ''
+                                          for desc, live in zip(self.descriptions, self.live)])
+            self.manifest['bm25'] = True
+        return self._bm25
+
+    def train_ivf(self, n_lists: int):
+        self.ivf = IVFIndex.train(self.embeddings, n_lists)
+        self.manifest['ivf_lists'] = self.ivf.n_lists
+
+    def quantize(self, embedding_type: str) -> 'QuantizedEmbeddings':
+        """Quantized copy of the embeddings, encoded on first use unless the index was saved with it"""
+        if embedding_type not in self.quantized:
+            logger.info(f"Encoding {embedding_type} embeddings for {len(self)} pricelist items")
+            self.quantized[embedding_type] = QuantizedEmbeddings.encode(self.embeddings, embedding_type)
+            self.manifest['quantized'] = sorted(self.quantized)
+        return self.quantized[embedding_type]
+
+    def search(self, query_norm: np.ndarray, k: int = TOP_K, method: str = 'exact',
+               nprobe: int = IVF_NPROBE, rescore: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k pricelist indices and scores per query: exact, through the IVF index, or a two-stage quantized scan"""
+        if method == 'ivf':
+            if self.ivf is not None:
+                return self.ivf.search(query_norm, self.embeddings, k, nprobe)  # Lists hold live rows only
+            logger.warning("No IVF index available for this pricelist, using exact search")
+        elif method in QuantizedEmbeddings.TYPES:
+            return self.quantize(method).search(query_norm, self.embeddings, k, rescore, exclude=self.dead_rows)
+        return top_k_similarities(query_norm, self.embeddings, k, exclude=self.dead_rows)
+
+    def fuse_lexical(self, query_norm: np.ndarray, lexical_texts: List[str], dense_indices: np.ndarray,
+                     k: int = TOP_K, method: str = 'rrf', weight: float = HYBRID_WEIGHT,
+                     chunk_mb: int = SCORING_CHUNK_MB) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Merge the BM25 top-k for each lexical text into that query's dense candidates.
+
+        'rrf' orders the union by reciprocal rank fusion; 'weighted' by
+        weight * cosine + (1 - weight) * BM25 relative to the query's best BM25 score.
+        Returned scores stay on the cosine scale (the fused score for 'weighted', the
+        candidate's cosine for 'rrf') so the similarity threshold and rerank boosts
+        keep their meaning.
+        """
+        lexical_indices, lexical_scores = self.bm25.search(lexical_texts, k)
+        candidates = np.concatenate([dense_indices, lexical_indices], axis=1)
+        n_queries, width = candidates.shape
+        valid = candidates >= 0
+        same = candidates[:, :, None] == candidates[:, None, :]
+        # Ids found by both searches are scored once, at their first position
+        keep = valid & ~(same & np.tri(width, k=-1, dtype=bool)).any(axis=2)
+        safe = np.where(valid, candidates, 0)
+
+        # Cosine of every candidate, including the ones only BM25 found
+        cosine_scores = np.empty((n_queries, width), dtype=np.float32)
+        rows_per_chunk = max(1, (chunk_mb * 1024 * 1024) // (width * self.dimension * 4))
+        for start in range(0, n_queries, rows_per_chunk):
+            end = min(start + rows_per_chunk, n_queries)
+            vectors = np.asarray(self.embeddings[safe[start:end].ravel()], dtype=np.float32)
+            cosine_scores[start:end] = np.einsum('qd,qcd->qc', np.asarray(query_norm[start:end], dtype=np.float32),
+                                                 vectors.reshape(end - start, width, -1))
+
+        if method == 'rrf':
+            ranks = np.concatenate([np.arange(dense_indices.shape[1]), np.arange(lexical_indices.shape[1])])
+            contributions = np.where(valid, 1.0 / (RRF_K + 1 + ranks), 0.0)
+            fused = (same * contributions[:, None, :]).sum(axis=2)
+            reported = cosine_scores
+        elif method == 'weighted':
+            lexical = self.bm25.pair_scores(lexical_texts, np.repeat(np.arange(n_queries), width),
+                                            safe.ravel()).reshape(n_queries, width)
+            best = lexical_scores[:, :1]
+            best = np.where(np.isfinite(best) & (best > 0), best, 1.0)
+            fused = weight * cosine_scores + (1 - weight) * lexical / best
+            reported = fused
+        else:
+            raise ValueError(f"Unknown fusion method '{method}' (expected 'rrf' or 'weighted')")
+
+        fused = np.where(keep, fused, -np.inf)
+        positions, _ = select_top_k(np.broadcast_to(np.arange(width), fused.shape), fused, k)
+        indices = np.take_along_axis(np.where(keep, candidates, -1), positions, axis=1)
+        scores = np.where(indices >= 0, np.take_along_axis(reported, positions, axis=1), -np.inf)
+        return indices, scores.astype(np.float32)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Live pricelist rows"""
+        df = pd.DataFrame({
+            'id': self.ids,
+            'description': self.descriptions,
+            'rate': self.rates,
+            'unit': self.units
+        })
+        return df if self.tombstones is None else df[self.live].reset_index(drop=True)
+
+    def update(self, pricelist_df: pd.DataFrame, client: Embedder,
+               cache: Optional[EmbeddingCache] = None) -> Tuple['PricelistIndex', Dict[str, int]]:
+        """
+        New index for a revised pricelist, embedding only new or changed descriptions.
+
+        Rows are paired by id, or by processed description for ids that are blank or repeated.
+        A paired row with the same processed description keeps its vector and position and takes
+        the revision's description text, rate and unit. Rows whose description changed, and rows
+        missing from the revision, are tombstoned; new and changed descriptions are embedded and
+        appended. Positions never move, so the IVF lists and quantized codes are patched rather
+        than retrained; the BM25 index is rebuilt, which needs no API calls.
+
+        Returns: (updated index, counts of unchanged / patched / changed / added / removed rows)
+        """
+        provider = as_embedding_provider(client)
+        if self.manifest.get('model', provider.model) != provider.model:
+            raise ValueError(f"Index was built with {self.manifest.get('model')}, updater uses {provider.model}")
+
+        live_rows = np.flatnonzero(self.live)
+        old_processed = preprocess_batch([self.descriptions[row] for row in live_rows])
+        new_ids = [str(i) for i in pricelist_df['id'].tolist()]
+        new_descriptions = pricelist_df['description'].tolist()
+        new_rates = [float(r) for r in pricelist_df['rate'].tolist()]
+        new_units = pricelist_df['unit'].tolist()
+        new_processed = preprocess_batch(new_descriptions)
+
+        old_id_counts = defaultdict(int)
+        for row in live_rows:
+            old_id_counts[self.ids[row]] += 1
+        new_id_counts = defaultdict(int)
+        for item_id in new_ids:
+            new_id_counts[item_id] += 1
+        old_by_id, old_by_text = {}, defaultdict(list)
+        for row, processed in zip(live_rows, old_processed):
+            item_id = self.ids[row]
+            if item_id and old_id_counts[item_id] == 1:
+                old_by_id[item_id] = (row, processed)
+            else:
+                old_by_text[processed].append((row, processed))
+
+        ids, descriptions, rates, units = list(self.ids), list(self.descriptions), list(self.rates), list(self.units)
+        tombstones = ~self.live
+        claimed = np.zeros(len(self), dtype=bool)
+        appended = []
+        stats = dict.fromkeys(('unchanged', 'patched', 'changed', 'added', 'removed'), 0)
+
+        for position, (item_id, processed) in enumerate(zip(new_ids, new_processed)):
+            if item_id and new_id_counts[item_id] == 1 and item_id in old_by_id:
+                row, old_text = old_by_id.pop(item_id)
+            elif old_by_text.get(processed):
+                row, old_text = old_by_text[processed].pop()
+            else:
+                row, old_text = None, None
+
+            if row is not None:
+                claimed[row] = True
+            if row is not None and old_text == processed:
+                revised = (item_id, new_descriptions[position], new_rates[position], new_units[position])
+                if revised == (ids[row], descriptions[row], rates[row], units[row]):
+                    stats['unchanged'] += 1
+                else:
+                    ids[row], descriptions[row], rates[row], units[row] = revised
+                    stats['patched'] += 1
+                continue
+
+            if row is not None:
+                tombstones[row] = True
+                stats['changed'] += 1
+            else:
+                stats['added'] += 1
+            appended.append(position)
+
+        removed = self.live & ~claimed
+        tombstones |= removed
+        stats['removed'] = int(removed.sum())
+
+        if provider.corpus_dependent and (appended or stats['removed']):
+            # Vectors embedded on their own would not match the rest; re-embedding is offline anyway
+            logger.info(f"{provider.model} vectors depend on the whole pricelist; re-embedding it")
+            return self.rebuilt(pricelist_df, provider, cache), stats
+
+        embeddings = self.embeddings
+        if appended:
+            unique_processed, text_ids = unique_text_table([new_processed[position] for position in appended])
+            logger.info(f"Embedding {len(unique_processed)} new or changed pricelist descriptions")
+            fresh = embed_texts_cached(provider, unique_processed, "search_document", cache, self.dimension)[text_ids]
+            fresh = (fresh / np.linalg.norm(fresh, axis=1, keepdims=True)).astype(np.float32)
+            embeddings = np.concatenate([np.asarray(self.embeddings, dtype=np.float32), fresh])
+            tombstones = np.concatenate([tombstones, np.zeros(len(appended), dtype=bool)])
+            for position in appended:
+                ids.append(new_ids[position])
+                descriptions.append(new_descriptions[position])
+                rates.append(new_rates[position])
+                units.append(new_units[position])
+            quantized = {embedding_type: codes.append(fresh) for embedding_type, codes in self.quantized.items()}
+        else:
+            quantized = dict(self.quantized)
+
+        manifest = {key: value for key, value in self.manifest.items() if key not in ('version', 'created_at')}
+        manifest.update(tombstones=int(tombstones.sum()), updated_from=self.manifest.get('version'))
+        index = PricelistIndex(ids, descriptions, rates, units, embeddings, manifest,
+                               quantized=quantized, tombstones=tombstones)
+        if self.ivf is not None:
+            index.ivf = self.ivf.updated(embeddings, tombstones)
+        if self.manifest.get('bm25'):
+            index.bm25  # Rebuilt for the new texts and tombstones
+        logger.info(f"Pricelist update: {stats}")
+        return index, stats
+
+    def rebuilt(self, pricelist_df: pd.DataFrame, client: Embedder,
+                cache: Optional[EmbeddingCache] = None) -> 'PricelistIndex':
+        """Fresh index for pricelist_df with the same dimension and search structures as this one"""
+        index = PricelistIndex.from_dataframe(pricelist_df, client, cache, self.dimension)
+        index.manifest['updated_from'] = self.manifest.get('version')
+        if self.ivf is not None:
+            index.train_ivf(self.ivf.n_lists)
+        for embedding_type in self.manifest.get('quantized', []):
+            index.quantize(embedding_type)
+        if self.manifest.get('bm25'):
+            index.bm25
+        return index
+
+    def compact(self) -> 'PricelistIndex':
+        """Copy of the index without its tombstoned rows; cell centroids and quantizer parameters are kept"""
+        live = self.live
+        keep = np.flatnonzero(live)
+        manifest = {key: value for key, value in self.manifest.items()
+                    if key not in ('version', 'created_at', 'tombstones')}
+        manifest['compacted_from'] = self.manifest.get('version')
+        quantized = {embedding_type: QuantizedEmbeddings(embedding_type, codes.codes[keep], codes.scale, codes.center)
+                     for embedding_type, codes in self.quantized.items()}
+        index = PricelistIndex([self.ids[row] for row in keep], [self.descriptions[row] for row in keep],
+                               [self.rates[row] for row in keep], [self.units[row] for row in keep],
+                               np.asarray(self.embeddings[keep], dtype=np.float32), manifest, quantized=quantized)
+        if self.ivf is not None:
+            index.ivf = IVFIndex.from_assignments(self.ivf.centroids, self.ivf.assignments(len(self))[keep])
+        if self.manifest.get('bm25'):
+            index.bm25
+        logger.info(f"Compacted pricelist index: dropped {len(self) - len(keep)} tombstoned rows, {len(keep)} remain")
+        return index
+
+    def save(self, index_root: str, expected_version: Optional[str] = None) -> str:
+        """Write a new version under index_root and point CURRENT at it
+
+        With expected_version the version is only published if CURRENT still names that version,
+        so an update or compaction never overwrites a version it didn't start from.
+        """
+        os.makedirs(index_root, exist_ok=True)
+        version = f"v{datetime.now().strftime('%Y%m%d_%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        staging_dir = os.path.join(index_root, f".staging-{version}")
+        os.makedirs(staging_dir)
+
+        self.manifest.update({
+            'version': version,
+            'created_at': datetime.now().isoformat(),
+            'count': len(self),
+            'dimension': int(self.embeddings.shape[1]),
+        })
+
+        np.save(os.path.join(staging_dir, self.EMBEDDINGS_FILE), np.ascontiguousarray(self.embeddings, dtype=np.float32))
+        with open(os.path.join(staging_dir, self.METADATA_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'descriptions': self.descriptions, 'rates': self.rates, 'units': self.units},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        if self.ivf is not None:
+            self.ivf.save(staging_dir)
+        for quantized in self.quantized.values():
+            quantized.save(staging_dir)
+        if self._bm25 is not None:
+            self._bm25.save(staging_dir)
+        if self.tombstones is not None:
+            np.save(os.path.join(staging_dir, self.TOMBSTONES_FILE), self.tombstones)
+        with open(os.path.join(staging_dir, self.MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+
+        current_version = os.path.basename(self.resolve_version_dir(index_root))
+        if expected_version is not None and current_version != expected_version:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise RuntimeError(f"Index {index_root} moved from {expected_version} to {current_version}; "
+                               f"not publishing {version}")
+
+        # Publish the finished version, then switch CURRENT atomically
+        version_dir = os.path.join(index_root, version)
+        os.rename(staging_dir, version_dir)
+        current_tmp = os.path.join(index_root, f".{self.CURRENT_FILE}.{uuid.uuid4().hex[:8]}")
+        with open(current_tmp, 'w') as f:
+            f.write(version)
+        os.replace(current_tmp, os.path.join(index_root, self.CURRENT_FILE))
+
+        self.path = version_dir
+        logger.info(f"Saved pricelist index {version} with {len(self)} items to: {version_dir}")
+        return version_dir
+
+    @classmethod
+    def resolve_version_dir(cls, path: str) -> str:
+        """Accept either an index root (follows CURRENT) or a specific version directory"""
+        current_file = os.path.join(path, cls.CURRENT_FILE)
+        if os.path.exists(current_file):
+            with open(current_file) as f:
+                return os.path.join(path, f.read().strip())
+        return path
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'PricelistIndex':
+        version_dir = cls.resolve_version_dir(path)
+
+        with open(os.path.join(version_dir, cls.MANIFEST_FILE), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported pricelist index format: {manifest.get('format_version')}")
+        if manifest.get('model') not in (EMBED_MODEL, LOCAL_EMBED_MODEL):
+            raise ValueError(f"Index was built with unsupported embedding model {manifest.get('model')}")
+
+        with open(os.path.join(version_dir, cls.METADATA_FILE), encoding='utf-8') as f:
+            metadata = json.load(f)
+        embeddings = np.load(os.path.join(version_dir, cls.EMBEDDINGS_FILE), mmap_mode='r' if mmap else None)
+
+        ivf = IVFIndex.load(version_dir)
+        quantized = {embedding_type: QuantizedEmbeddings.load(version_dir, embedding_type)
+                     for embedding_type in manifest.get('quantized', [])}
+        bm25 = BM25Index.load(version_dir)
+        tombstones_path = os.path.join(version_dir, cls.TOMBSTONES_FILE)
+        tombstones = np.load(tombstones_path) if os.path.exists(tombstones_path) else None
+
+        logger.info(f"Loaded pricelist index {manifest.get('version')} with {len(metadata['descriptions'])} items "
+                    f"(dimension {embeddings.shape[1]}, IVF lists: {ivf.n_lists if ivf else 'none'}, "
+                    f"quantized: {', '.join(quantized) or 'none'}, BM25: {'yes' if bm25 else 'no'}, "
+                    f"tombstones: {manifest.get('tombstones', 0)})")
+        return cls(metadata['ids'], metadata['descriptions'], metadata['rates'], metadata['units'],
+                   embeddings, manifest, version_dir, ivf, quantized, bm25, tombstones)
+
+def row_value(row: Sequence[Any], col: int) -> Any:
+    """Value of a 1-based column in a row tuple (None past the end of the row)"""
+    return row[col - 1] if 0 < col <= len(row) else None
+
+def find_headers_enhanced(rows: List[Sequence[Any]]) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+    """Enhanced header detection with comprehensive format support
+
+    Works on the first HEADER_BUFFER_ROWS row tuples of a sheet so the rest
+    of the sheet can be streamed afterwards.
+    """
+    header_row = None
+    desc_col = None
+    qty_col = None
+    
+    logger.info("=== ADAPTIVE HEADER DETECTION ===")
+    
+    # Search in first 15 rows for headers (more comprehensive)
+    for row_num, row in enumerate(rows[:HEADER_SCAN_ROWS], start=1):
+        
+        # Debug: Print all headers in this row
+        row_headers = []
+        for col_num, value in enumerate(row, start=1):
+            if value:
+                row_headers.append(f"Col {col_num}: '{value}'")
+        
+        if len(row_headers) >= 2:  # Only log rows with multiple headers
+            logger.info(f"Row {row_num} headers: {', '.join(row_headers)}")
+        
+        # Check if this row has header-like characteristics
+        header_indicators = 0
+        potential_desc_col = None
+        potential_qty_col = None
+        
+        for col_num, value in enumerate(row, start=1):
+            if not value:
+                continue
+                
+            cell_value = str(value).lower().strip()
+            
+            # DESCRIPTION COLUMN - Very comprehensive patterns
+            desc_patterns = [
+                'description', 'desc', 'item', 'work', 'activity', 'task', 'operation',
+                'specification', 'spec', 'details', 'particulars', 'trade', 'element',
+                'component', 'material', 'labor', 'labour', 'service', 'works',
+                'ref', 'reference', 'code', 'product', 'title', 'name', 'category'
             ]
             
             if any(pattern in cell_value for pattern in desc_patterns):
@@ -450,7 +1812,7 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
                 if not any(exclude in cell_value for exclude in ['note', 'remark', 'comment', 'total', 'sum', 'page']):
                     potential_desc_col = col_num
                     header_indicators += 2
-                    logger.info(f"Found DESCRIPTION pattern in col {col_num}: '{cell.value}'")
+                    logger.info(f"Found DESCRIPTION pattern in col {col_num}: '{value}'")
             
             # QUANTITY COLUMN - Ultra comprehensive patterns
             qty_patterns = [
@@ -474,7 +1836,7 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
                 if not any(exclude in cell_value for exclude in ['description', 'note', 'remark', 'comment', 'page']):
                     potential_qty_col = col_num
                     header_indicators += 1
-                    logger.info(f"Found QUANTITY pattern in col {col_num}: '{cell.value}'")
+                    logger.info(f"Found QUANTITY pattern in col {col_num}: '{value}'")
             
             # Other header indicators
             other_patterns = ['rate', 'price', 'cost', 'value', 'total', 'unit', 'measure']
@@ -503,7 +1865,8 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
         logger.warning("No quantity column found by pattern matching, performing ADAPTIVE SEARCH...")
         
         # Expanded search range - check more columns
-        search_range = list(range(1, min(ws.max_column + 1, 20)))  # Search first 20 columns
+        max_column = max((len(row) for row in rows), default=0)
+        search_range = list(range(1, min(max_column + 1, 20)))  # Search first 20 columns
         logger.info(f"Searching for numeric columns in range: {search_range}")
         
         best_qty_col = None
@@ -519,11 +1882,11 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
             has_decimals = 0
             sample_values = []
             
-            for test_row in range(header_row + 1, min(header_row + 31, ws.max_row + 1)):  # Check more rows
-                cell = ws.cell(row=test_row, column=test_col)
-                if cell.value is not None and str(cell.value).strip():
+            for row in rows[header_row:header_row + QTY_SCAN_ROWS]:  # Check more rows
+                value = row_value(row, test_col)
+                if value is not None and str(value).strip():
                     total_count += 1
-                    val_str = str(cell.value).strip()
+                    val_str = str(value).strip()
                     sample_values.append(val_str[:15])
                     
                     # Check if numeric
@@ -547,7 +1910,7 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
                 if total_count >= 5:
                     score += 0.1  # Bonus for having enough data
                 
-                header_name = ws.cell(row=header_row, column=test_col).value or f"Column_{test_col}"
+                header_name = row_value(rows[header_row - 1], test_col) or f"Column_{test_col}"
                 
                 if score > best_score and score > 0.2:  # Minimum 20% numeric
                     best_score = score
@@ -557,21 +1920,21 @@ def find_headers_enhanced(ws) -> Tuple[Optional[int], Optional[int], Optional[in
         
         if best_qty_col:
             qty_col = best_qty_col
-            header_name = ws.cell(row=header_row, column=qty_col).value
+            header_name = row_value(rows[header_row - 1], qty_col)
             logger.info(f"AUTO-DETECTED quantity column {qty_col} ('{header_name}') with score {best_score:.2f}")
     
     # Final validation and fallback
     if not desc_col:
         logger.warning("No description column found! Trying fallback detection...")
         # Try to find the first text-heavy column
-        for col_num in range(1, min(10, ws.max_column + 1)):
+        for col_num in range(1, 10):
             text_count = 0
             total_count = 0
-            for row_num in range(1, min(20, ws.max_row + 1)):
-                cell = ws.cell(row=row_num, column=col_num)
-                if cell.value:
+            for row in rows[:19]:
+                value = row_value(row, col_num)
+                if value:
                     total_count += 1
-                    if isinstance(cell.value, str) and len(str(cell.value)) > 10:
+                    if isinstance(value, str) and len(str(value)) > 10:
                         text_count += 1
             
             if total_count > 0 and (text_count / total_count) > 0.7:
@@ -629,140 +1992,692 @@ def calculate_match_quality(similarity: float) -> str:
     else:
         return "Very Poor"
 
-def hierarchical_match_scoring(inquiry_item: dict, price_descriptions: List[str], price_rates: List[float], 
-                             price_units: List[str], similarities: np.ndarray) -> Tuple[int, float, dict]:
+def select_top_k(candidate_ids: np.ndarray, candidate_scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Pick the k best candidates per row, best first; equal scores keep the lower id like np.argmax"""
+    width = candidate_scores.shape[1]
+    k = min(k, width)
+
+    if k == 1:
+        picks = np.argmax(candidate_scores, axis=1)[:, None]
+    elif k < width:
+        picks = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+    else:
+        picks = np.broadcast_to(np.arange(width), candidate_scores.shape)
+
+    ids = np.take_along_axis(candidate_ids, picks, axis=1)
+    scores = np.take_along_axis(candidate_scores, picks, axis=1)
+    order = np.lexsort((ids, -scores), axis=1)
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def top_k_similarities(query_norm: np.ndarray, price_norm: np.ndarray, k: int = TOP_K,
+                        chunk_mb: int = SCORING_CHUNK_MB,
+                        exclude: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score every query against every price item and keep the k best per query.
+
+    Queries are processed in row blocks sized so one (block x n_price) float32
+    similarity matrix stays under chunk_mb; each block is a single GEMM followed
+    by argpartition, so there is no per-row Python work. Items in `exclude`
+    (tombstoned rows) are never returned; slots they would fill get index -1.
+
+    Returns: (indices, scores), both shaped (n_queries, k) and sorted best first
+    """
+    n_queries = query_norm.shape[0]
+    n_price = price_norm.shape[0]
+    k = max(1, min(k, n_price))
+
+    rows_per_chunk = max(1, (chunk_mb * 1024 * 1024) // (n_price * 4))
+    top_indices = np.empty((n_queries, k), dtype=np.int64)
+    top_scores = np.empty((n_queries, k), dtype=np.float32)
+
+    price_t = np.asarray(price_norm, dtype=np.float32).T
+    price_ids = np.arange(n_price)
+    for start in range(0, n_queries, rows_per_chunk):
+        end = min(start + rows_per_chunk, n_queries)
+        sims = np.asarray(query_norm[start:end], dtype=np.float32) @ price_t
+        if exclude is not None:
+            sims[:, exclude] = -np.inf
+        top_indices[start:end], top_scores[start:end] = select_top_k(
+            np.broadcast_to(price_ids, sims.shape), sims, k
+        )
+
+    if exclude is not None:
+        top_indices[np.isneginf(top_scores)] = -1
+    return top_indices, top_scores
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over normalized embeddings.
+
+    Spherical k-means splits the pricelist into n_lists cells. A search scores the
+    queries against the centroids, probes the nprobe closest cells and runs exact
+    cosine only over their members, so cost scales with nprobe/n_lists of the
+    pricelist. Raising nprobe trades latency for recall; nprobe == n_lists is exact.
+    """
+
+    FILE_NAME = 'ivf.npz'
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order  # Pricelist indices grouped by cell
+        self.offsets = offsets  # Cell l holds order[offsets[l]:offsets[l + 1]]
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, n_lists: int, n_iter: int = 20, seed: int = 0) -> 'IVFIndex':
+        n_items = embeddings.shape[0]
+        n_lists = max(1, min(n_lists, n_items))
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample; 64 points per cell is plenty for a coarse quantizer
+        sample_size = min(n_items, n_lists * 64)
+        sample = np.asarray(embeddings[np.sort(rng.choice(n_items, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        logger.info(f"Training IVF index: {n_lists} lists on {sample_size} of {n_items} vectors")
+        for _ in range(n_iter):
+            assignments = top_k_similarities(sample, centroids, 1)[0][:, 0]
+            membership = sparse.csr_matrix(
+                (np.ones(sample_size, dtype=np.float32), (assignments, np.arange(sample_size))),
+                shape=(n_lists, sample_size)
+            )
+            sums = np.asarray(membership @ sample)
+            counts = np.bincount(assignments, minlength=n_lists)
+
+            # Re-seed empty cells from random sample points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+
+        assignments = top_k_similarities(embeddings, centroids, 1)[0][:, 0]
+        return cls.from_assignments(centroids.astype(np.float32), assignments)
+
+    @classmethod
+    def from_assignments(cls, centroids: np.ndarray, assignments: np.ndarray) -> 'IVFIndex':
+        """Inverted lists for per-item cell assignments; items assigned -1 are left out"""
+        members = np.flatnonzero(assignments >= 0)
+        order = members[np.argsort(assignments[members], kind='stable')].astype(np.int64)
+        counts = np.bincount(assignments[members], minlength=centroids.shape[0])
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, order, offsets)
+
+    def assignments(self, n_items: int) -> np.ndarray:
+        """Cell of each of n_items items, -1 for items not in any list"""
+        assignments = np.full(n_items, -1, dtype=np.int64)
+        assignments[self.order] = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+        return assignments
+
+    def updated(self, embeddings: np.ndarray, tombstones: np.ndarray) -> 'IVFIndex':
+        """Lists for an index grown by appended rows: new rows join their nearest existing cell,
+        tombstoned rows leave their lists and the centroids are kept (no retraining)"""
+        assignments = self.assignments(embeddings.shape[0])
+        assignments[tombstones] = -1
+        unassigned = np.flatnonzero((assignments < 0) & ~tombstones)
+        if len(unassigned):
+            assignments[unassigned] = top_k_similarities(np.asarray(embeddings[unassigned], dtype=np.float32),
+                                                         self.centroids, 1)[0][:, 0]
+        return self.from_assignments(self.centroids, assignments)
+
+    def search(self, query_norm: np.ndarray, embeddings: np.ndarray, k: int = TOP_K,
+               nprobe: int = IVF_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k; rows with fewer than k candidates are padded with index -1"""
+        n_queries = query_norm.shape[0]
+        nprobe = max(1, min(nprobe, self.n_lists))
+        query_norm = np.asarray(query_norm, dtype=np.float32)
+
+        probes = top_k_similarities(query_norm, self.centroids, nprobe)[0]
+
+        best_indices = np.full((n_queries, k), -1, dtype=np.int64)
+        best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+
+        # Visit each probed cell once and score every query that probes it in one GEMM
+        probed_cells = probes.ravel()
+        probing_queries = np.repeat(np.arange(n_queries), nprobe)
+        by_cell = np.argsort(probed_cells, kind='stable')
+        probed_cells = probed_cells[by_cell]
+        probing_queries = probing_queries[by_cell]
+        bounds = np.searchsorted(probed_cells, np.arange(self.n_lists + 1))
+
+        for cell in np.unique(probed_cells):
+            members = self.order[self.offsets[cell]:self.offsets[cell + 1]]
+            if len(members) == 0:
+                continue
+            queries = probing_queries[bounds[cell]:bounds[cell + 1]]
+            sims = query_norm[queries] @ np.asarray(embeddings[members], dtype=np.float32).T
+
+            merged_ids = np.concatenate([best_indices[queries], np.broadcast_to(members, sims.shape)], axis=1)
+            merged_scores = np.concatenate([best_scores[queries], sims], axis=1)
+            best_indices[queries], best_scores[queries] = select_top_k(merged_ids, merged_scores, k)
+
+        return best_indices, best_scores
+
+    def save(self, directory: str):
+        np.savez(os.path.join(directory, self.FILE_NAME),
+                 centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['IVFIndex']:
+        path = os.path.join(directory, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data['centroids'], data['order'], data['offsets'])
+
+class QuantizedEmbeddings:
+    """
+    Compact copy of the pricelist embeddings for two-stage search.
+
+    'ubinary' keeps one bit per dimension, packed eight to a byte (the layout
+    embed-v4.0 returns for embedding_types=["ubinary"]), 32x smaller than
+    float32. Bits are taken against the pricelist's per-dimension mean rather
+    than zero, which matches the API's sign bits for centred embeddings and
+    stays informative when they are not. The scan scores the float query
+    against the bits (asymmetric distance), which ranks better than Hamming
+    distance between binarized queries and runs as a BLAS product. 'int8' keeps each dimension as a
+    byte scaled by the pricelist's per-dimension maximum, 4x smaller, and scans by
+    dot product. The scan shortlists k * rescore candidates per query, which are
+    rescored against the float vectors, so returned scores are exact cosine.
+
+    Both modes save memory, not time: the codes are widened to float32 and
+    scanned with the same BLAS product as exact search (an int8 dot or a
+    popcount scan in numpy is several times slower than that), and the
+    rescore stage comes on top of the scan.
+    """
+
+    TYPES = ('int8', 'ubinary')
+
+    def __init__(self, embedding_type: str, codes: np.ndarray, scale: Optional[np.ndarray] = None,
+                 center: Optional[np.ndarray] = None):
+        self.embedding_type = embedding_type
+        self.codes = codes
+        self.scale = scale  # int8 only: float value of one code step per dimension
+        self.center = center  # ubinary only: per-dimension threshold of the bits
+
+    @classmethod
+    def encode(cls, embeddings: np.ndarray, embedding_type: str) -> 'QuantizedEmbeddings':
+        if embedding_type == 'ubinary':
+            center = np.asarray(embeddings.mean(axis=0), dtype=np.float32)
+            return cls(embedding_type, np.packbits(np.asarray(embeddings) > center, axis=1), center=center)
+        if embedding_type == 'int8':
+            scale = np.maximum(np.abs(embeddings).max(axis=0), 1e-12).astype(np.float32) / 127
+            codes = np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8)
+            return cls(embedding_type, codes, scale)
+        raise ValueError(f"Unknown embedding type '{embedding_type}' (expected one of {cls.TYPES})")
+
+    def append(self, embeddings: np.ndarray) -> 'QuantizedEmbeddings':
+        """Codes extended with appended rows, encoded against the existing scale / center"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.embedding_type == 'ubinary':
+            codes = np.packbits(embeddings > self.center, axis=1)
+        else:
+            codes = np.clip(np.rint(embeddings / self.scale), -127, 127).astype(np.int8)
+        return QuantizedEmbeddings(self.embedding_type, np.concatenate([self.codes, codes]), self.scale, self.center)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + sum(a.nbytes for a in (self.scale, self.center) if a is not None)
+
+    def scan_scores(self, query_norm: np.ndarray) -> np.ndarray:
+        """Approximate similarity of a block of queries to every item (higher is closer)"""
+        if self.embedding_type == 'int8':
+            # q . (codes * scale) == (q * scale) . codes, so only the query is rescaled
+            query = query_norm * self.scale
+        else:
+            # (q - center) . (2 * bits - 1) ranks items the same as (q - center) . bits
+            query = query_norm - self.center
+
+        # Codes are widened to float32 a block at a time to keep the footprint small
+        scores = np.empty((query_norm.shape[0], self.codes.shape[0]), dtype=np.float32)
+        dimension = query_norm.shape[1]
+        block = max(1, (SCORING_CHUNK_MB * 1024 * 1024) // (dimension * 4))
+        for start in range(0, self.codes.shape[0], block):
+            codes = self.codes[start:start + block]
+            if self.embedding_type == 'ubinary':
+                codes = np.unpackbits(codes, axis=1, count=dimension)
+            scores[:, start:start + block] = query @ codes.T.astype(np.float32)
+        return scores
+
+    def search(self, query_norm: np.ndarray, embeddings: np.ndarray, k: int = TOP_K,
+               rescore: Optional[int] = None, chunk_mb: int = SCORING_CHUNK_MB,
+               exclude: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Shortlist k * rescore candidates with the quantized scan, then rank them by float cosine
+
+        Items in `exclude` (tombstoned rows) are never returned; slots they would fill get index -1.
+        """
+        n_queries = query_norm.shape[0]
+        n_items = self.codes.shape[0]
+        k = max(1, min(k, n_items))
+        rescore = rescore or QUANTIZED_RESCORE[self.embedding_type]
+        shortlist = max(k, min(k * rescore, n_items))
+        query_norm = np.asarray(query_norm, dtype=np.float32)
+
+        rows_per_chunk = max(1, (chunk_mb * 1024 * 1024) // (n_items * 4))
+
+        top_indices = np.empty((n_queries, k), dtype=np.int64)
+        top_scores = np.empty((n_queries, k), dtype=np.float32)
+        for start in range(0, n_queries, rows_per_chunk):
+            end = min(start + rows_per_chunk, n_queries)
+            queries = query_norm[start:end]
+            approx = self.scan_scores(queries)
+            if exclude is not None:
+                approx[:, exclude] = -np.inf
+            if shortlist < n_items:
+                candidates = np.argpartition(-approx, shortlist - 1, axis=1)[:, :shortlist]
+            else:
+                candidates = np.broadcast_to(np.arange(n_items), approx.shape)
+
+            # Rescore only the shortlisted rows (a memory-mapped index pages in just these)
+            vectors = np.asarray(embeddings[candidates.ravel()], dtype=np.float32).reshape(*candidates.shape, -1)
+            exact = np.einsum('qd,qsd->qs', queries, vectors)
+            if exclude is not None:
+                exact[np.isneginf(np.take_along_axis(approx, candidates, axis=1))] = -np.inf
+            top_indices[start:end], top_scores[start:end] = select_top_k(candidates, exact, k)
+
+        if exclude is not None:
+            top_indices[np.isneginf(top_scores)] = -1
+        return top_indices, top_scores
+
+    @staticmethod
+    def file_name(embedding_type: str) -> str:
+        return f'quantized_{embedding_type}.npz'
+
+    def save(self, directory: str):
+        arrays = {'codes': self.codes}
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        if self.center is not None:
+            arrays['center'] = self.center
+        np.savez(os.path.join(directory, self.file_name(self.embedding_type)), **arrays)
+
+    @classmethod
+    def load(cls, directory: str, embedding_type: str) -> 'QuantizedEmbeddings':
+        with np.load(os.path.join(directory, cls.file_name(embedding_type))) as data:
+            return cls(embedding_type, data['codes'], data['scale'] if 'scale' in data else None,
+                       data['center'] if 'center' in data else None)
+
+# Mixed letter/digit tokens such as "PVC-110/A" or "XJ4421"; preprocessing reduces their digits to NUM
+PRODUCT_CODE_PATTERN = re.compile(r'(?<![\w./-])(?=[\w./-]*\d)(?=[\w./-]*[a-z])[a-z0-9][\w./-]*[a-z0-9]',
+                                  re.IGNORECASE)
+PRODUCT_CODE_SEPARATORS = re.compile(r'[^a-z0-9]')
+
+def lexical_text(text: Any) -> str:
+    """Token stream of the BM25 index: the preprocessed text plus '#'-prefixed product codes"""
+    codes = ['#' + PRODUCT_CODE_SEPARATORS.sub('', code.lower()) for code in PRODUCT_CODE_PATTERN.findall(str(text))]
+    processed = enhanced_preprocess(text)
+    return ' '.join([processed, *codes]) if codes else processed
+
+class BM25Index:
+    """
+    Inverted index over the pricelist's lexical tokens with BM25 scoring.
+
+    Postings are stored term-major as a CSR matrix holding each item's precomputed
+    BM25 weight for the term, so scoring a block of queries is one sparse product
+    of their term indicators with the postings, touching only the items that share
+    a term with each query.
+    """
+
+    FILE_NAME = 'bm25.npz'
+
+    def __init__(self, terms: List[str], postings: sparse.csr_matrix):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.postings = postings  # (terms x items) BM25 term weights
+        self._item_weights = None
+
+    @classmethod
+    def build(cls, texts: List[str], k1: float = BM25_K1, b: float = BM25_B) -> 'BM25Index':
+        terms = {}
+        items, columns = [], []
+        for item, text in enumerate(texts):
+            for token in text.split():
+                items.append(item)
+                columns.append(terms.setdefault(token, len(terms)))
+
+        n_items = len(texts)
+        tf = sparse.csr_matrix((np.ones(len(columns), dtype=np.float32), (items, columns)),
+                               shape=(n_items, max(len(terms), 1)))
+        tf.sum_duplicates()
+
+        lengths = np.asarray(tf.sum(axis=1)).ravel()
+        avg_length = max(float(lengths.mean()), 1.0) if n_items else 1.0
+        document_frequency = np.bincount(tf.indices, minlength=tf.shape[1])
+        idf = np.log(1 + (n_items - document_frequency + 0.5) / (document_frequency + 0.5))
+        item_lengths = np.repeat(lengths, np.diff(tf.indptr))
+        tf.data = (idf[tf.indices] * tf.data * (k1 + 1)
+                   / (tf.data + k1 * (1 - b + b * item_lengths / avg_length))).astype(np.float32)
+        return cls(list(terms), tf.T.tocsr())
+
+    @property
+    def item_weights(self) -> sparse.csr_matrix:
+        """Item-major copy of the postings, for scoring given (query, item) pairs"""
+        if self._item_weights is None:
+            self._item_weights = self.postings.T.tocsr()
+        return self._item_weights
+
+    def encode(self, texts: List[str]) -> sparse.csr_matrix:
+        """Binary term indicators of query texts; terms missing from the pricelist are dropped"""
+        rows = [sorted({self.terms[t] for t in text.split() if t in self.terms}) for text in texts]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(r) for r in rows])
+        indices = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=int(indptr[-1]))
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                 shape=(len(texts), self.postings.shape[0]))
+
+    def search(self, texts: List[str], k: int = TOP_K, block: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k items by BM25 per query text; rows with fewer than k matching items are padded with index -1"""
+        n_queries = len(texts)
+        best_indices = np.full((n_queries, k), -1, dtype=np.int64)
+        best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+
+        queries = self.encode(texts)
+        for start in range(0, n_queries, block):
+            scores = (queries[start:start + block] @ self.postings).tocsr()
+            for row in range(scores.shape[0]):
+                lo, hi = scores.indptr[row], scores.indptr[row + 1]
+                if lo == hi:
+                    continue
+                ids, values = select_top_k(scores.indices[None, lo:hi].astype(np.int64), scores.data[None, lo:hi], k)
+                best_indices[start + row, :ids.shape[1]] = ids[0]
+                best_scores[start + row, :ids.shape[1]] = values[0]
+
+        return best_indices, best_scores
+
+    def pair_scores(self, texts: List[str], query_idx: np.ndarray, item_idx: np.ndarray) -> np.ndarray:
+        """BM25 score of item_idx[i] for texts[query_idx[i]]"""
+        return _pairwise_overlap(self.encode(texts), self.item_weights, query_idx, item_idx)
+
+    def save(self, directory: str):
+        np.savez(os.path.join(directory, self.FILE_NAME), terms=np.array(list(self.terms), dtype=str),
+                 data=self.postings.data, indices=self.postings.indices, indptr=self.postings.indptr,
+                 shape=np.array(self.postings.shape))
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['BM25Index']:
+        path = os.path.join(directory, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            postings = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return cls(data['terms'].tolist(), postings)
+
+def recall_at_k(approx_indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    """Fraction of the exact top-k found by an approximate search, averaged over queries"""
+    k = exact_indices.shape[1]
+    found = [len(set(a.tolist()) & set(e.tolist())) for a, e in zip(approx_indices, exact_indices)]
+    return float(np.mean(found)) / k if found else 1.0
+
+# Unit families recognised in inquiry text and pricelist units, used by the rerank unit boost
+UNIT_TAG_PATTERNS = [
+    ('area', re.compile(r'\b(m2|m²|sqm|square\s*meter?s?)\b')),
+    ('volume', re.compile(r'\b(m3|m³|cubic\s*meter?s?)\b')),
+    ('mass', re.compile(r'\b(kg|kilogram?s?)\b')),
+    ('tonne', re.compile(r'\b(ton?s?|tonne?s?)\b')),
+    ('liquid', re.compile(r'\b(liter?s?|litre?s?|l)\b')),
+    ('count', re.compile(r'\b(piece?s?|pcs?|each|no\.?|nr|number?s?)\b')),
+    ('hour', re.compile(r'\b(hour?s?|hr?s?)\b')),
+    ('day', re.compile(r'\b(day?s?)\b')),
+    ('week', re.compile(r'\b(week?s?)\b')),
+    ('month', re.compile(r'\b(month?s?)\b')),
+]
+
+def description_tokens(text: str, min_length: int = 3) -> List[str]:
+    """Lowercased whitespace tokens used by the rerank keyword, phrase and category boosts"""
+    return [word for word in str(text).lower().split() if len(word) >= min_length]
+
+def unit_tags(text: str) -> List[int]:
+    """Indices into UNIT_TAG_PATTERNS of every unit family mentioned in text"""
+    lowered = str(text).lower()
+    return [tag for tag, (_, pattern) in enumerate(UNIT_TAG_PATTERNS) if pattern.search(lowered)]
+
+class PricelistFeatures:
+    """
+    Precomputed lexical features of the pricelist for the rerank stage.
+
+    Tokens and word bigrams are stored as binary sparse rows over a pricelist
+    vocabulary, and each item's unit is reduced to one unit family, so boosts for
+    any set of (inquiry, candidate) pairs come from a few sparse products.
+    """
+
+    def __init__(self, descriptions: List[str], units: List[str]):
+        self.token_vocab = {}
+        self.bigram_vocab = {}
+        token_rows, bigram_rows = [], []
+        for desc in descriptions:
+            tokens = description_tokens(desc)
+            token_rows.append({self.token_vocab.setdefault(t, len(self.token_vocab)) for t in tokens})
+            bigram_rows.append({self.bigram_vocab.setdefault(b, len(self.bigram_vocab))
+                                for b in zip(tokens, tokens[1:])})
+
+        self.tokens = self._binary_matrix(token_rows, len(self.token_vocab))
+        self.bigrams = self._binary_matrix(bigram_rows, len(self.bigram_vocab))
+
+        self.unit_tag = np.full(len(units), -1, dtype=np.int64)
+        for i, unit in enumerate(units):
+            tags = unit_tags(unit) if unit else []
+            if tags:
+                self.unit_tag[i] = tags[0]
+
+    @staticmethod
+    def _binary_matrix(rows: List[set], width: int) -> sparse.csr_matrix:
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(r) for r in rows])
+        indices = np.fromiter((c for r in rows for c in sorted(r)), dtype=np.int64, count=int(indptr[-1]))
+        data = np.ones(len(indices), dtype=np.float32)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), max(width, 1)))
+
+    def encode_tokens(self, token_lists: List[List[str]]) -> sparse.csr_matrix:
+        rows = [{self.token_vocab[t] for t in tokens if t in self.token_vocab} for tokens in token_lists]
+        return self._binary_matrix(rows, len(self.token_vocab))
+
+    def encode_bigrams(self, token_lists: List[List[str]]) -> sparse.csr_matrix:
+        rows = [{self.bigram_vocab[b] for b in zip(tokens, tokens[1:]) if b in self.bigram_vocab}
+                for tokens in token_lists]
+        return self._binary_matrix(rows, len(self.bigram_vocab))
+
+def _pairwise_overlap(query_rows: sparse.csr_matrix, price_rows: sparse.csr_matrix,
+                      query_idx: np.ndarray, price_idx: np.ndarray) -> np.ndarray:
+    """Number of shared features (summed weights for weighted rows) for each (query_idx[i], price_idx[i]) pair"""
+    return np.asarray(query_rows[query_idx].multiply(price_rows[price_idx]).sum(axis=1)).ravel()
+
+def hierarchical_match_scoring(inquiry_items: List[dict], features: PricelistFeatures,
+                               candidate_indices: np.ndarray,
+                               candidate_scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Rerank the embedding top-k candidates with hierarchical matching logic:
+    1. Category identification (section head title words found in the item)
+    2. Item description keyword overlap
+    3. Related phrases (shared word bigrams)
+    4. Unit matching
+    5. Full context matching (the base embedding similarity)
+
+    All boosts are computed for the (n_inquiries x k) candidate grid at once.
+
+    Returns: (reranked_indices, reranked_scores, score_components), arrays shaped like the input
     """
-    Implement hierarchical matching logic:
-    1. Category identification
-    2. Item description matching
-    3. Related keywords
-    4. Related phrases
-    5. Unit matching
-    6. Full context matching
-    
-    Returns: (best_index, best_score, match_details)
+    n_queries, k = candidate_indices.shape
+    valid = candidate_indices >= 0
+    query_idx = np.repeat(np.arange(n_queries), k)
+    price_idx = np.where(valid, candidate_indices, 0).ravel()
+
+    desc_tokens = [description_tokens(item.get('description', '')) for item in inquiry_items]
+    title_tokens = [description_tokens(item.get('head_title') or '', 4) for item in inquiry_items]
+    inquiry_word_counts = np.array([len(set(tokens)) for tokens in desc_tokens], dtype=np.float32)
+
+    # 1. Category identification boost
+    category_hits = _pairwise_overlap(features.encode_tokens(title_tokens), features.tokens, query_idx, price_idx)
+    category_boost = np.where(category_hits > 0, 0.1, 0.0)
+
+    # 2. Item description keyword matching
+    keyword_hits = _pairwise_overlap(features.encode_tokens(desc_tokens), features.tokens, query_idx, price_idx)
+    keyword_ratio = keyword_hits / np.maximum(inquiry_word_counts[query_idx], 1)
+    keyword_boost = keyword_ratio * 0.15
+
+    # 3. Related phrases boost
+    phrase_hits = _pairwise_overlap(features.encode_bigrams(desc_tokens), features.bigrams, query_idx, price_idx)
+    phrase_boost = np.minimum(phrase_hits * 0.05, 0.1)
+
+    # 4. Unit matching boost
+    inquiry_units = np.zeros((n_queries, len(UNIT_TAG_PATTERNS) + 1), dtype=bool)
+    for row, item in enumerate(inquiry_items):
+        inquiry_units[row, unit_tags(item.get('enhanced_description') or item.get('description', ''))] = True
+    # Column -1 stays False for price items without a recognised unit
+    unit_boost = np.where(inquiry_units[query_idx, features.unit_tag[price_idx]], 0.1, 0.0)
+
+    components = {
+        'base_similarity': candidate_scores,
+        'category_boost': category_boost.reshape(n_queries, k),
+        'keyword_boost': keyword_boost.reshape(n_queries, k),
+        'phrase_boost': phrase_boost.reshape(n_queries, k),
+        'unit_boost': unit_boost.reshape(n_queries, k),
+    }
+    total_boost = sum(v for name, v in components.items() if name != 'base_similarity')
+    enhanced = np.minimum(candidate_scores + total_boost, 1.0).astype(np.float32)
+    enhanced[~valid] = -np.inf
+
+    order = np.lexsort((np.where(valid, candidate_indices, np.iinfo(np.int64).max), -enhanced), axis=1)
+    components = {name: np.take_along_axis(v, order, axis=1) for name, v in components.items()}
+    return (np.take_along_axis(candidate_indices, order, axis=1),
+            np.take_along_axis(enhanced, order, axis=1),
+            components)
+
+def extract_workbook_items(workbook_path: str, workers: int = 1) -> List[Dict]:
+    """Extract items from every sheet of an inquiry workbook with adaptive detection
+
+    The workbook is opened read-only and each sheet is read in a single
+    forward pass: the first HEADER_BUFFER_ROWS rows are buffered for header
+    detection and the remaining rows are streamed straight into extraction.
+    With workers > 1 sheets are extracted in a process pool and merged back
+    in workbook order, so the result is identical to the serial path.
     """
-    inquiry_desc = inquiry_item['description'].lower()
-    inquiry_enhanced = inquiry_item['enhanced_description'].lower()
+    with metric_span('extract'):
+        return _extract_workbook_items(workbook_path, workers)
+
+def _extract_workbook_items(workbook_path: str, workers: int) -> List[Dict]:
+    all_items = list(chain.from_iterable(iter_workbook_items(workbook_path, workers)))
     
-    # Extract potential unit from inquiry
-    import re
-    unit_patterns = [r'\b(m2|m²|sqm|square\s*meter?s?)\b', r'\b(m3|m³|cubic\s*meter?s?)\b', 
-                    r'\b(kg|kilogram?s?)\b', r'\b(ton?s?|tonne?s?)\b', r'\b(liter?s?|litre?s?|l)\b',
-                    r'\b(piece?s?|pcs?|each|no\.?|number?s?)\b', r'\b(hour?s?|hr?s?)\b',
-                    r'\b(day?s?)\b', r'\b(week?s?)\b', r'\b(month?s?)\b']
-    
-    inquiry_units = []
-    for pattern in unit_patterns:
-        matches = re.findall(pattern, inquiry_enhanced)
-        inquiry_units.extend(matches)
-    
-    # Score each price item using hierarchical criteria
-    enhanced_scores = []
-    
-    for i, base_similarity in enumerate(similarities):
-        score_components = {
-            'base_similarity': base_similarity,
-            'category_boost': 0.0,
-            'keyword_boost': 0.0,
-            'phrase_boost': 0.0,
-            'unit_boost': 0.0,
-            'context_boost': 0.0
-        }
-        
-        price_desc = price_descriptions[i].lower()
-        price_unit = price_units[i].lower() if i < len(price_units) else ''
-        
-        # 1. Category identification boost
-        if inquiry_item.get('head_title'):
-            head_title = inquiry_item['head_title'].lower()
-            if any(word in price_desc for word in head_title.split() if len(word) > 3):
-                score_components['category_boost'] = 0.1
-        
-        # 2. Item description keyword matching
-        inquiry_words = set(word for word in inquiry_desc.split() if len(word) > 2)
-        price_words = set(word for word in price_desc.split() if len(word) > 2)
-        common_words = inquiry_words.intersection(price_words)
-        if common_words:
-            keyword_ratio = len(common_words) / len(inquiry_words) if inquiry_words else 0
-            score_components['keyword_boost'] = keyword_ratio * 0.15
-        
-        # 3. Related phrases boost
-        inquiry_phrases = [inquiry_desc[j:j+10] for j in range(len(inquiry_desc)-9)]
-        for phrase in inquiry_phrases:
-            if len(phrase) > 5 and phrase in price_desc:
-                score_components['phrase_boost'] = min(score_components['phrase_boost'] + 0.05, 0.1)
-        
-        # 4. Unit matching boost
-        if inquiry_units and price_unit:
-            for inq_unit in inquiry_units:
-                if inq_unit in price_unit or price_unit in inq_unit:
-                    score_components['unit_boost'] = 0.1
-                    break
-        
-        # Calculate final enhanced score
-        total_boost = sum(score_components[k] for k in score_components if k != 'base_similarity')
-        enhanced_score = base_similarity + total_boost
-        enhanced_score = min(enhanced_score, 1.0)  # Cap at 1.0
-        
-        enhanced_scores.append((enhanced_score, score_components))
+    logger.info(f"\n=== WORKBOOK PROCESSING COMPLETE ===")
+    logger.info(f"Total items extracted from all sheets: {len(all_items)}")
+    
+    return all_items
+
+def iter_workbook_items(workbook_path: str, workers: int = 1) -> Iterator[List[Dict]]:
+    """Items of each sheet in workbook order, yielded as soon as the sheet is extracted"""
+    with metric_span('extract.workbook_load'):
+        workbook = load_workbook(workbook_path, read_only=True, data_only=True)
     
-    # Find best match
-    best_idx = int(np.argmax([score[0] for score in enhanced_scores]))  # Convert numpy int to Python int
-    best_score = enhanced_scores[best_idx][0]
-    match_details = enhanced_scores[best_idx][1]
+    logger.info(f"=== PROCESSING WORKBOOK WITH {len(workbook.sheetnames)} SHEETS ===")
     
-    return best_idx, best_score, match_details
+    try:
+        sheet_names = workbook.sheetnames
+        workers = min(workers, len(sheet_names))
+        if workers <= 1:
+            for sheet_name in sheet_names:
+                yield extract_sheet_items(workbook, sheet_name)
+    finally:
+        workbook.close()
+    
+    if workers > 1:
+        logger.info(f"Extracting {len(sheet_names)} sheets with {workers} worker processes")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(EXTRACT_START_METHOD),
+                                 initializer=open_extract_workbook, initargs=(workbook_path,)) as executor:
+            # map() yields in submission order, which keeps sheet order deterministic
+            metrics = _job_metrics.get()
+            for records, sheet_metrics in executor.map(extract_sheet_records, sheet_names):
+                if metrics is not None:
+                    metrics.merge(sheet_metrics)
+                yield [dict(zip(ITEM_FIELDS, record)) for record in records]
 
-def process_all_sheets(workbook_path: str, pricelist_df: pd.DataFrame, job_id: str, client: cohere.Client) -> Optional[str]:
-    """Process all sheets in the workbook with adaptive detection"""
+_extract_workbook = None  # Read-only workbook opened once per extraction worker process
+
+def open_extract_workbook(workbook_path: str):
+    """Process pool initializer: open the inquiry workbook once for all sheets this worker handles"""
+    global _extract_workbook
+    _extract_workbook = load_workbook(workbook_path, read_only=True, data_only=True)
+
+def extract_sheet_records(sheet_name: str) -> Tuple[List[tuple], Dict[str, Any]]:
+    """Process pool entry point: extract one sheet as compact ITEM_FIELDS tuples, with its metrics"""
+    with collect_metrics(JobMetrics()) as metrics:
+        items = extract_sheet_items(_extract_workbook, sheet_name)
+    return [tuple(item[field] for field in ITEM_FIELDS) for item in items], metrics.to_dict()
+
+def extract_sheet_items(workbook, sheet_name: str) -> List[Dict]:
+    """Stream one sheet of a read-only workbook into item dicts"""
+    logger.info(f"\n=== PROCESSING SHEET: {sheet_name} ===")
     try:
-        workbook = load_workbook(workbook_path, data_only=True)
-        all_items = []
-        total_processed = 0
+        worksheet = workbook[sheet_name]
+        # Read-only mode trusts the stored <dimension> record, which some exporters omit or get
+        # wrong; without it rows come back truncated, so read the cells that are actually there
+        worksheet.reset_dimensions()
+        rows = worksheet.iter_rows(values_only=True)
+        prefix = list(islice(rows, HEADER_BUFFER_ROWS))
+        max_column = max((len(row) for row in prefix), default=0)
         
-        logger.info(f"=== PROCESSING WORKBOOK WITH {len(workbook.sheetnames)} SHEETS ===")
+        # Skip empty or very small sheets
+        if len(prefix) < 3 or max_column < 2:
+            logger.info(f"Skipping sheet '{sheet_name}' - too small ({len(prefix)} rows, {max_column} cols)")
+            return []
         
-        for sheet_name in workbook.sheetnames:
-            logger.info(f"\n=== PROCESSING SHEET: {sheet_name} ===")
-            try:
-                ws = workbook[sheet_name]
-                
-                # Skip empty or very small sheets
-                if ws.max_row < 3 or ws.max_column < 2:
-                    logger.info(f"Skipping sheet '{sheet_name}' - too small ({ws.max_row} rows, {ws.max_column} cols)")
-                    continue
-                
-                # Use enhanced header detection
-                header_row, desc_col, qty_col = find_headers_enhanced(ws)
-                
-                if not desc_col:
-                    logger.warning(f"No description column found in sheet '{sheet_name}', trying basic fallback...")
-                    # Last resort: use first column as description
-                    header_row = 1
-                    desc_col = 1
-                    logger.info(f"Using fallback: column 1 as description in sheet '{sheet_name}'")
-                
-                # Process items from this sheet
-                if header_row is not None and desc_col is not None:
-                    sheet_items = extract_items_from_sheet(ws, header_row, desc_col, qty_col, sheet_name)
-                else:
-                    logger.warning(f"Invalid header detection in sheet '{sheet_name}' - skipping")
-                    continue
-                
-                if sheet_items:
-                    all_items.extend(sheet_items)
-                    total_processed += len(sheet_items)
-                    logger.info(f"Sheet '{sheet_name}' contributed {len(sheet_items)} items")
-                else:
-                    logger.warning(f"No items extracted from sheet '{sheet_name}'")
-                
-            except Exception as e:
-                logger.error(f"Error processing sheet '{sheet_name}': {e}")
-                continue
+        # Use enhanced header detection
+        with metric_span('extract.header_detection'):
+            header_row, desc_col, qty_col = find_headers_enhanced(prefix)
+        
+        if not desc_col:
+            logger.warning(f"No description column found in sheet '{sheet_name}', trying basic fallback...")
+            # Last resort: use first column as description
+            header_row = 1
+            desc_col = 1
+            logger.info(f"Using fallback: column 1 as description in sheet '{sheet_name}'")
         
-        logger.info(f"\n=== WORKBOOK PROCESSING COMPLETE ===")
-        logger.info(f"Total items extracted from all sheets: {total_processed}")
+        # Process items from this sheet, continuing the same row stream after the buffered prefix
+        if header_row is None or desc_col is None:
+            logger.warning(f"Invalid header detection in sheet '{sheet_name}' - skipping")
+            return []
+        with metric_span('extract.rows'):
+            sheet_items = extract_items_from_sheet(chain(prefix, rows), header_row, desc_col, qty_col, sheet_name)
+        count_metric('sheets')
+        
+        if sheet_items:
+            logger.info(f"Sheet '{sheet_name}' contributed {len(sheet_items)} items")
+        else:
+            logger.warning(f"No items extracted from sheet '{sheet_name}'")
+        return sheet_items
+        
+    except Exception as e:
+        logger.error(f"Error processing sheet '{sheet_name}': {e}")
+        return []
+
+def process_all_sheets(workbook_path: str, pricelist_df: pd.DataFrame, job_id: str, client: Embedder,
+                       cache: Optional[EmbeddingCache] = None,
+                       price_index: Optional[PricelistIndex] = None,
+                       options: Optional[Dict[str, Any]] = None,
+                       progress: Optional[ProgressTracker] = None,
+                       output_format: str = 'xlsx',
+                       output_path: Optional[str] = None,
+                       checkpoint: Optional[JobCheckpoint] = None,
+                       previous: Optional[MatchState] = None,
+                       state_path: Optional[str] = None) -> Optional[str]:
+    """Process all sheets in the workbook with adaptive detection"""
+    try:
+        all_items = checkpoint.load_items() if checkpoint else None
+        matches = None
+        if all_items is not None:
+            logger.info(f"Reusing {len(all_items)} extracted items from the job checkpoint")
+        elif (options or {}).get('pipeline') and previous is None:
+            all_items, matches = match_workbook_pipelined(workbook_path, pricelist_df, client, cache, price_index,
+                                                          options, progress)
+            if checkpoint:
+                checkpoint.save_items(all_items)
+        else:
+            extract_workers = (options or {}).get('extract_workers', DEFAULT_MATCH_OPTIONS['extract_workers'])
+            all_items = extract_workbook_items(workbook_path, extract_workers)
+            if checkpoint:
+                checkpoint.save_items(all_items)
+        if progress and matches is None:
+            progress.update(20, f"Extracted {len(all_items)} items")
         
         if not all_items:
             logger.error("No items found in any sheet of the workbook!")
@@ -773,7 +2688,8 @@ def process_all_sheets(workbook_path: str, pricelist_df: pd.DataFrame, job_id: s
         logger.info(f"Created DataFrame with {len(items_df)} total items")
         
         # Process matches
-        return process_item_matching(items_df, pricelist_df, job_id, client)
+        return process_item_matching(items_df, pricelist_df, job_id, client, cache, price_index, options, progress,
+                                     output_format, output_path, checkpoint, previous, state_path, matches)
         
     except Exception as e:
         logger.error(f"Error processing workbook: {e}")
@@ -781,8 +2697,12 @@ def process_all_sheets(workbook_path: str, pricelist_df: pd.DataFrame, job_id: s
         logger.error(traceback.format_exc())
         return None
 
-def extract_items_from_sheet(ws, header_row: int, desc_col: int, qty_col: Optional[int], sheet_name: str) -> List[Dict]:
-    """Extract items from a single sheet with robust BOQ format handling and deduplication"""
+def extract_items_from_sheet(rows: Iterable[Sequence[Any]], header_row: int, desc_col: int, qty_col: Optional[int],
+                             sheet_name: str) -> List[Dict]:
+    """Extract items from a single sheet with robust BOQ format handling and deduplication
+
+    `rows` yields the sheet's row value tuples from row 1 onwards and is read once.
+    """
     import re
     items = []
     section_stack = []  # Track hierarchy of sections
@@ -796,14 +2716,16 @@ def extract_items_from_sheet(ws, header_row: int, desc_col: int, qty_col: Option
     total_rows_scanned = 0
     unique_items_added = 0
     
-    for row_num in range(header_row + 1, ws.max_row + 1):
+    for row_num, row in enumerate(rows, start=1):
+        if row_num <= header_row:
+            continue
         total_rows_scanned += 1
-        desc_cell = ws.cell(row=row_num, column=desc_col)
+        desc_value = row_value(row, desc_col)
         
-        if not desc_cell.value or str(desc_cell.value).strip() == "":
+        if not desc_value or str(desc_value).strip() == "":
             continue
             
-        description = str(desc_cell.value).strip()
+        description = str(desc_value).strip()
         
         # Skip completely empty rows
         if len(description) < 1:
@@ -812,9 +2734,9 @@ def extract_items_from_sheet(ws, header_row: int, desc_col: int, qty_col: Option
         # Get quantity - more flexible handling with scanning
         quantity = None
         if qty_col:
-            qty_cell = ws.cell(row=row_num, column=qty_col)
-            if qty_cell.value is not None:
-                qty_str = str(qty_cell.value).strip()
+            qty_value = row_value(row, qty_col)
+            if qty_value is not None:
+                qty_str = str(qty_value).strip()
                 try:
                     # Handle various formats: "5.00", "5,000.00", "5.00 m2", etc.
                     number_match = re.search(r'[\d,]+\.?\d*', qty_str.replace(',', ''))
@@ -827,13 +2749,13 @@ def extract_items_from_sheet(ws, header_row: int, desc_col: int, qty_col: Option
         
         # If no quantity column detected, scan nearby columns for numeric values
         if quantity is None and qty_col is None:
-            for scan_col in range(max(1, desc_col - 2), min(ws.max_column + 1, desc_col + 5)):
+            for scan_col in range(max(1, desc_col - 2), min(len(row) + 1, desc_col + 5)):
                 if scan_col == desc_col:
                     continue
                 try:
-                    scan_cell = ws.cell(row=row_num, column=scan_col)
-                    if scan_cell.value is not None:
-                        test_qty = float(scan_cell.value)
+                    scan_value = row_value(row, scan_col)
+                    if scan_value is not None:
+                        test_qty = float(scan_value)
                         if test_qty > 0:
                             quantity = test_qty
                             data_rows_found += 1
@@ -842,7 +2764,7 @@ def extract_items_from_sheet(ws, header_row: int, desc_col: int, qty_col: Option
                     continue
         
         # Enhanced section detection for BOQ formats
-        is_section = detect_boq_section_header(description, quantity, row_num, ws)
+        is_section = detect_boq_section_header(description, quantity, row_num)
         
         if is_section:
             update_section_stack(section_stack, description)
@@ -980,7 +2902,7 @@ def should_skip_item(description: str, quantity: Optional[float] = None) -> bool
     
     return False
 
-def detect_boq_section_header(description: str, quantity: Optional[float], row_num: int, ws) -> bool:
+def detect_boq_section_header(description: str, quantity: Optional[float], row_num: int) -> bool:
     """Enhanced BOQ section detection for different formats"""
     desc_upper = description.upper().strip()
     
@@ -1055,70 +2977,750 @@ def should_skip_boq_item(description: str, quantity: Optional[float], seen_descr
     
     return False
 
+DEDUP_PUNCTUATION = re.compile(r'[^\w\s]')
+DEDUP_STOP_WORDS = frozenset({'the', 'and', 'or', 'of', 'in', 'to', 'for', 'with', 'by', 'at', 'on', 'as', 'per'})
+
 def normalize_description_for_dedup(description: str) -> str:
     """Normalize description for deduplication"""
-    # Convert to lowercase and remove extra whitespace
-    normalized = re.sub(r'\s+', ' ', description.lower().strip())
-    
-    # Remove common BOQ formatting characters
-    normalized = re.sub(r'[^\w\s]', '', normalized)
+    # Lowercase and remove common BOQ formatting characters; split() also collapses whitespace
+    normalized = DEDUP_PUNCTUATION.sub('', description.lower())
     
     # Remove very common words that don't affect meaning
-    stop_words = {'the', 'and', 'or', 'of', 'in', 'to', 'for', 'with', 'by', 'at', 'on', 'as', 'per'}
-    words = [word for word in normalized.split() if word not in stop_words]
+    words = [word for word in normalized.split() if word not in DEDUP_STOP_WORDS]
     
     return ' '.join(words)
 
-def main():
-    parser = argparse.ArgumentParser(description="Enhanced Cohere Excel Price Matching")
-    parser.add_argument('--inquiry', required=True, help='Path to inquiry Excel file')
-    parser.add_argument('--pricelist', required=True, help='Path to pricelist Excel file')
-    parser.add_argument('--output', required=True, help='Path for output Excel file')
-    parser.add_argument('--api-key', required=True, help='Cohere API key')
-    parser.add_argument('--similarity-threshold', type=float, default=SIMILARITY_THRESHOLD, 
-                       help='Minimum similarity threshold for matches')
-    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+def add_embedding_arguments(parser: argparse.ArgumentParser):
+    """Embedder, cache and request-dispatch flags shared by every subcommand that embeds"""
+    parser.add_argument('--embedder', choices=EMBEDDERS, default='cohere',
+                       help='cohere calls the embed API; local uses offline hashed character n-gram TF-IDF '
+                            'vectors; auto uses Cohere and falls back to local when it fails or has no key')
+    parser.add_argument('--cache-dir', default=EMBED_CACHE_DIR,
+                       help='Directory of the persistent embedding cache')
+    parser.add_argument('--cache-max-mb', type=int, default=EMBED_CACHE_MAX_MB,
+                       help='Size bound of the embedding cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the persistent embedding cache')
+    parser.add_argument('--embed-concurrency', type=int, default=EMBED_CONCURRENCY,
+                       help='Embedding batches kept in flight at once')
+    parser.add_argument('--requests-per-minute', type=float, default=EMBED_REQUESTS_PER_MINUTE,
+                       help='Embedding request rate limit')
+    parser.add_argument('--tokens-per-minute', type=float, default=EMBED_TOKENS_PER_MINUTE,
+                       help='Embedding input token rate limit (0 = unlimited)')
+    parser.add_argument('--embed-broker', default=EMBED_BROKER_SOCKET,
+                       help='Send Cohere embedding requests through the embed-broker on this Unix socket')
+
+def create_embedder(args: argparse.Namespace) -> EmbeddingProvider:
+    """Embedding provider selected by --embedder / --api-key / --embed-broker"""
+    if args.embedder == 'local':
+        return LocalNgramProvider()
+    fallback = LocalNgramProvider() if args.embedder == 'auto' else None
+    direct = CohereProvider(cohere.Client(args.api_key), fallback) if args.api_key else None
+    if args.embed_broker:
+        # The broker holds the API key; one here only serves as a fallback if the broker is down
+        return BrokerProvider(args.embed_broker, direct, fallback)
+    if direct is None:
+        if args.embedder == 'auto':
+            logger.warning("No Cohere API key given, using local embeddings")
+            return LocalNgramProvider()
+        raise ValueError("A Cohere API key (--api-key or COHERE_API_KEY) is required for the cohere embedder")
+    return direct
+
+def open_embedding_cache(args: argparse.Namespace) -> Optional[EmbeddingCache]:
+    """Apply the dispatch flags and open the shared embedding cache; matching still works without the cache"""
+    configure_embedding_dispatch(args.embed_concurrency, args.requests_per_minute, args.tokens_per_minute)
+    if args.no_cache:
+        return None
+    try:
+        cache = EmbeddingCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+        logger.info(f"Using embedding cache at: {cache.db_path}")
+        return cache
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Embedding cache unavailable, continuing without it: {e}")
+        return None
+
+def build_index_main(argv: Optional[List[str]] = None) -> int:
+    """build-index subcommand: embed a pricelist workbook into a versioned index directory"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py build-index",
+                                     description="Build a memory-mappable pricelist index")
+    parser.add_argument('--pricelist', required=True, help='Path to pricelist Excel file')
+    parser.add_argument('--index', required=True, help='Index root directory; a new version is written inside it')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--ivf-lists', type=int, default=0,
+                        help='Also build an IVF ANN index with this many cells (about 4*sqrt(rows); 0 = none)')
+    parser.add_argument('--quantize', action='append', choices=QuantizedEmbeddings.TYPES, default=[],
+                        help='Also store int8 / ubinary codes for two-stage quantized search (repeatable)')
+    parser.add_argument('--bm25', action='store_true',
+                        help='Also store the BM25 inverted index used by hybrid (--fusion) matching')
+    parser.add_argument('--dimension', type=int, choices=EMBED_DIMENSIONS, default=OUTPUT_DIMENSION,
+                        help='Embedding output dimension stored in the index')
+    add_embedding_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        logger.info("=== Building Pricelist Index ===")
+        client = create_embedder(args)
+        cache = open_embedding_cache(args)
+
+        price_index = PricelistIndex.build(args.pricelist, client, cache, args.dimension)
+        if args.ivf_lists > 0:
+            price_index.train_ivf(args.ivf_lists)
+        for embedding_type in args.quantize:
+            price_index.quantize(embedding_type)
+        if args.bm25:
+            price_index.bm25  # Built on first access
+        version_dir = price_index.save(args.index)
+        print(json.dumps({'index': version_dir, 'version': price_index.manifest['version'],
+                          'count': len(price_index)}), flush=True)
+    except Exception as e:
+        logger.error(f"Error building index: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+def update_index_main(argv: Optional[List[str]] = None) -> int:
+    """update-index subcommand: apply a revised pricelist workbook to an index, embedding only what changed"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py update-index",
+                                     description="Update a pricelist index from a revised pricelist")
+    parser.add_argument('--pricelist', required=True, help='Path to the revised pricelist Excel file')
+    parser.add_argument('--index', required=True, help='Index root directory to update')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--compact-ratio', type=float, default=COMPACT_TOMBSTONE_RATIO,
+                        help='Compact once this share of index rows is tombstoned (0 = never)')
+    parser.add_argument('--compact-foreground', action='store_true',
+                        help='Compact before returning instead of in a background process')
+    add_embedding_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        logger.info("=== Updating Pricelist Index ===")
+        client = create_embedder(args)
+        cache = open_embedding_cache(args)
+
+        price_index = PricelistIndex.load(args.index)
+        base_version = price_index.manifest['version']
+        descriptions, rates, units, ids = load_pricelist_enhanced(args.pricelist)
+        pricelist_df = pd.DataFrame({'id': ids, 'description': descriptions, 'rate': rates, 'unit': units})
+
+        updated, stats = price_index.update(pricelist_df, client, cache)
+        if stats['patched'] == stats['changed'] == stats['added'] == stats['removed'] == 0:
+            logger.info(f"Index {base_version} already matches {args.pricelist}")
+            print(json.dumps({'index': price_index.path, 'version': base_version, **stats}), flush=True)
+            return 0
+
+        updated.manifest['source_sha256'] = file_sha256(args.pricelist)
+        updated.manifest['source_file'] = os.path.basename(args.pricelist)
+        version_dir = updated.save(args.index, expected_version=base_version)
+
+        tombstone_ratio = updated.manifest.get('tombstones', 0) / max(len(updated), 1)
+        compaction = None
+        if args.compact_ratio > 0 and tombstone_ratio >= args.compact_ratio:
+            if args.compact_foreground:
+                version_dir = updated.compact().save(args.index, expected_version=updated.manifest['version'])
+                compaction = 'done'
+            else:
+                # Detached, so the update returns now; the compactor publishes only if no newer update landed
+                subprocess.Popen([sys.executable, os.path.abspath(__file__), 'compact-index', '--index', args.index,
+                                  '--version', updated.manifest['version']],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                 start_new_session=True)
+                compaction = 'started'
+                logger.info(f"{tombstone_ratio:.0%} of rows tombstoned; compacting in the background")
+        print(json.dumps({'index': version_dir, 'version': os.path.basename(version_dir), **stats,
+                          'tombstones': updated.manifest.get('tombstones', 0), 'compaction': compaction}), flush=True)
+    except Exception as e:
+        logger.error(f"Error updating index: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+def compact_index_main(argv: Optional[List[str]] = None) -> int:
+    """compact-index subcommand: rewrite the current index version without its tombstoned rows"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py compact-index",
+                                     description="Drop tombstoned rows from a pricelist index")
+    parser.add_argument('--index', required=True, help='Index root directory to compact')
+    parser.add_argument('--version', help='Only compact if CURRENT still names this version')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        price_index = PricelistIndex.load(args.index)
+        version = price_index.manifest['version']
+        if args.version and version != args.version:
+            logger.info(f"Index moved on to {version} since {args.version}; skipping compaction")
+            return 0
+        if price_index.tombstones is None:
+            logger.info(f"Index {version} has no tombstoned rows")
+            return 0
+        version_dir = price_index.compact().save(args.index, expected_version=version)
+        print(json.dumps({'index': version_dir, 'version': os.path.basename(version_dir),
+                          'count': int(price_index.live.sum())}), flush=True)
+    except Exception as e:
+        logger.error(f"Error compacting index: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+class MatcherWorker:
+    """
+    Long-lived matcher that keeps the Cohere client, embedding cache and pricelist
+    index (embeddings plus rerank features) warm between jobs.
+
+    Requests are JSON objects, one per line:
+        {"command": "match", "job_id": "...", "inquiry": "in.xlsx", "output": "out.xlsx",
+         "options": {...}, "return_matches": false}
+        {"command": "ping"} / {"command": "reload"}
+    Each job streams "progress" events and ends with a "result" (including its stage metrics) or "error" event.
+    """
+
+    def __init__(self, client: Embedder, cache: Optional[EmbeddingCache],
+                 pricelist_path: Optional[str] = None, index_path: Optional[str] = None,
+                 dimension: int = OUTPUT_DIMENSION):
+        self.client = client
+        self.cache = cache
+        self.pricelist_path = pricelist_path
+        self.index_path = index_path
+        self.dimension = dimension
+        self.reload_lock = threading.Lock()
+        self.price_index = None
+        self.pricelist_df = None
+        self.jobs_lock = threading.Lock()  # Socket connections run jobs on their own threads
+        self.jobs_completed = 0
+        self.reload()
+
+    def reload(self):
+        """(Re)load the pricelist; an index root picks up its CURRENT version"""
+        if self.index_path:
+            price_index = PricelistIndex.load(self.index_path)
+        else:
+            price_index = PricelistIndex.build(self.pricelist_path, self.client, self.cache, self.dimension)
+        price_index.features  # Build rerank features now rather than inside the first job
+
+        with self.reload_lock:
+            self.price_index = price_index
+            self.pricelist_df = price_index.to_dataframe()
+        logger.info(f"Worker pricelist ready with {len(price_index)} items")
+
+    def handle(self, request: Dict[str, Any], emit: Callable[[Dict[str, Any]], None]):
+        command = request.get('command', 'match')
+        try:
+            if command == 'ping':
+                emit({'event': 'pong', 'pricelist_items': len(self.price_index), 'jobs_completed': self.jobs_completed})
+            elif command == 'reload':
+                self.reload()
+                emit({'event': 'reloaded', 'pricelist_items': len(self.price_index)})
+            elif command == 'match':
+                self.run_job(request, emit)
+            else:
+                emit({'event': 'error', 'message': f"Unknown command: {command}"})
+        except Exception as e:
+            logger.error(f"Worker request failed: {e}")
+            logger.error(traceback.format_exc())
+            emit({'event': 'error', 'job_id': request.get('job_id'), 'message': str(e)})
+
+    def run_job(self, request: Dict[str, Any], emit: Callable[[Dict[str, Any]], None]):
+        job_id = request.get('job_id') or str(uuid.uuid4())
+        start = time.time()
+
+        def report(percentage: float, message: str):
+            emit({'event': 'progress', 'job_id': job_id, 'percent': round(percentage, 1), 'message': message})
+
+        options = request.get('options') or {}
+        unknown = sorted(set(options) - set(DEFAULT_MATCH_OPTIONS))
+        if unknown:
+            raise ValueError(f"Unknown match options: {', '.join(unknown)}")
+        options = {**DEFAULT_MATCH_OPTIONS, **options}
+
+        progress = ProgressTracker(callback=report)
+        with self.reload_lock:
+            price_index, pricelist_df = self.price_index, self.pricelist_df
+
+        with collect_metrics(JobMetrics(job_id)) as metrics:
+            if options['pipeline']:
+                items, matches = match_workbook_pipelined(request['inquiry'], pricelist_df, self.client, self.cache,
+                                                          price_index, options, progress)
+            else:
+                items = extract_workbook_items(request['inquiry'], options['extract_workers'])
+                progress.update(20, f"Extracted {len(items)} items")
+                matches = None
+            if not items:
+                emit({'event': 'error', 'job_id': job_id, 'message': 'No items found in any sheet of the workbook'})
+                return
+
+            if matches is None:
+                matches = match_items(pd.DataFrame(items), pricelist_df, self.client, self.cache, price_index,
+                                      options, progress)
+            output_path = write_results(matches, job_id, request.get('format', 'xlsx'), request.get('output'))
+            progress.update(100, "Results written")
+
+        with self.jobs_lock:
+            self.jobs_completed += 1
+        result = {
+            'event': 'result',
+            'job_id': job_id,
+            'output': output_path,
+            'items': len(items),
+            'matches': len(matches),
+            'elapsed_seconds': round(time.time() - start, 3),
+            'metrics': metrics.to_dict(),
+        }
+        if request.get('return_matches'):
+            result['results'] = matches
+        emit(result)
+
+def serve_stdin(worker: MatcherWorker):
+    """Serve JSON-lines requests from stdin, one job at a time, replying on stdout"""
+    def emit(event: Dict[str, Any]):
+        sys.stdout.write(json.dumps(event, default=str) + "\n")
+        sys.stdout.flush()
+
+    emit({'event': 'ready', 'pid': os.getpid(), 'pricelist_items': len(worker.price_index)})
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            emit({'event': 'error', 'message': f"Invalid JSON request: {e}"})
+            continue
+        if request.get('command') == 'shutdown':
+            break
+        worker.handle(request, emit)
+
+def serve_unix_socket(worker: MatcherWorker, socket_path: str):
+    """Serve JSON-lines requests on a Unix socket; each connection runs on its own thread"""
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            write_lock = threading.Lock()
+
+            def emit(event: Dict[str, Any]):
+                with write_lock:
+                    self.wfile.write((json.dumps(event, default=str) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+
+            for raw in self.rfile:
+                line = raw.decode('utf-8').strip()
+                if not line:
+                    continue
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    emit({'event': 'error', 'message': f"Invalid JSON request: {e}"})
+                    continue
+                if request.get('command') == 'shutdown':
+                    emit({'event': 'shutdown'})
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                    return
+                worker.handle(request, emit)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Matcher worker listening on {socket_path} ({len(worker.price_index)} pricelist items)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def serve_embed_broker(coalescer: EmbeddingCoalescer, socket_path: str):
+    """Serve embedding requests from matcher jobs on a Unix socket, one thread per connection
+
+    Requests and replies are JSON lines:
+        {"command": "embed", "texts": [...], "input_type": "search_query", "dimension": 1536}
+            -> {"event": "embeddings", "count": n, "dimension": d, "data": "<base64 float32, row-major>"}
+        {"command": "stats"} / {"command": "ping"} / {"command": "shutdown"}
+    """
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def emit(event: Dict[str, Any]):
+                self.wfile.write((json.dumps(event) + "\n").encode('utf-8'))
+                self.wfile.flush()
+
+            for raw in self.rfile:
+                try:
+                    request = json.loads(raw.decode('utf-8'))
+                except json.JSONDecodeError as e:
+                    emit({'event': 'error', 'message': f"Invalid JSON request: {e}"})
+                    continue
+                command = request.get('command')
+                if command == 'embed':
+                    try:
+                        vectors = coalescer.embed(request['texts'], request['input_type'], int(request['dimension']))
+                    except Exception as e:
+                        emit({'event': 'error', 'message': str(e)})
+                        continue
+                    emit({'event': 'embeddings', 'count': len(vectors), 'dimension': vectors.shape[1],
+                          'data': base64.b64encode(np.ascontiguousarray(vectors).tobytes()).decode('ascii')})
+                elif command == 'stats':
+                    with coalescer.condition:
+                        emit({'event': 'stats', **coalescer.stats})
+                elif command == 'ping':
+                    emit({'event': 'pong'})
+                elif command == 'shutdown':
+                    emit({'event': 'shutdown'})
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                    return
+                else:
+                    emit({'event': 'error', 'message': f"Unknown command: {command}"})
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Embedding broker listening on {socket_path} (batch {EMBED_BATCH}, "
+                f"{coalescer.concurrency} in flight, linger {coalescer.linger * 1000:.0f} ms)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def embed_broker_main(argv: Optional[List[str]] = None) -> int:
+    """embed-broker subcommand: one process that coalesces and rate limits embedding requests for all jobs"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py embed-broker",
+                                     description="Shared embedding broker for concurrent matcher jobs")
+    parser.add_argument('--socket', default=EMBED_BROKER_SOCKET, required=not EMBED_BROKER_SOCKET,
+                        help='Unix socket to listen on (jobs connect with --embed-broker)')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--linger', type=float, default=BROKER_LINGER_SECONDS,
+                        help='Seconds a partial batch waits for texts from other jobs')
+    parser.add_argument('--embed-concurrency', type=int, default=EMBED_CONCURRENCY,
+                        help='Embedding batches kept in flight at once')
+    parser.add_argument('--requests-per-minute', type=float, default=EMBED_REQUESTS_PER_MINUTE,
+                        help='Embedding request rate limit shared by all jobs')
+    parser.add_argument('--tokens-per-minute', type=float, default=EMBED_TOKENS_PER_MINUTE,
+                        help='Embedding input token rate limit (0 = unlimited)')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if not args.api_key:
+        parser.error("A Cohere API key (--api-key or COHERE_API_KEY) is required")
+
+    try:
+        configure_embedding_dispatch(args.embed_concurrency, args.requests_per_minute, args.tokens_per_minute)
+        coalescer = EmbeddingCoalescer(cohere.Client(args.api_key), args.linger, args.embed_concurrency)
+        serve_embed_broker(coalescer, args.socket)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(f"Embedding broker failed: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+def serve_main(argv: Optional[List[str]] = None) -> int:
+    """serve subcommand: run a persistent matcher worker over stdin or a Unix socket"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py serve",
+                                     description="Persistent price matching worker (JSON lines)")
+    pricelist_source = parser.add_mutually_exclusive_group(required=True)
+    pricelist_source.add_argument('--pricelist', help='Path to pricelist Excel file')
+    pricelist_source.add_argument('--index', help='Path to a pricelist index built with build-index')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--socket', help='Listen on this Unix socket path instead of stdin/stdout')
+    parser.add_argument('--dimension', type=int, choices=EMBED_DIMENSIONS, default=OUTPUT_DIMENSION,
+                        help='Embedding output dimension when embedding --pricelist (an index fixes its own)')
+    add_embedding_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if not args.socket:
+        # stdout carries the JSON-lines replies, so console logging moves to stderr
+        for handler in logging.getLogger().handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.setStream(sys.stderr)
+
+    try:
+        client = create_embedder(args)
+        worker = MatcherWorker(client, open_embedding_cache(args), args.pricelist, args.index, args.dimension)
+        if args.socket:
+            serve_unix_socket(worker, args.socket)
+        else:
+            serve_stdin(worker)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(f"Matcher worker failed: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+def load_match_labels(path: str) -> Dict[Tuple[str, int], str]:
+    """Expected matched_price_item_id per (sheet_name, row_number) from a reviewed results file"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        labels_df = pd.read_csv(path)
+    elif extension == '.jsonl':
+        labels_df = pd.read_json(path, lines=True)
+    elif extension == '.parquet':
+        labels_df = pd.read_parquet(path)
+    else:
+        labels_df = pd.read_excel(path)
+    labels_df = labels_df.dropna(subset=['sheet_name', 'row_number', 'matched_price_item_id'])
+    return {(str(row.sheet_name), int(row.row_number)): str(row.matched_price_item_id)
+            for row in labels_df.itertuples(index=False)}
+
+def dimension_report_main(argv: Optional[List[str]] = None) -> int:
+    """dimension-report subcommand: compare match quality, scoring latency and index size per embedding dimension"""
+    parser = argparse.ArgumentParser(prog="cohereexcelparsing.py dimension-report",
+                                     description="Run an inquiry at several embedding dimensions and report "
+                                                 "match agreement, scoring latency and index memory")
+    parser.add_argument('--inquiry', required=True, help='Path to inquiry Excel file')
+    parser.add_argument('--pricelist', required=True, help='Path to pricelist Excel file')
+    parser.add_argument('--labels', help='Reviewed results (xlsx/csv/jsonl/parquet with sheet_name, row_number, '
+                                         'matched_price_item_id) to score accuracy against')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--dimensions', type=int, nargs='+', choices=EMBED_DIMENSIONS, default=list(EMBED_DIMENSIONS),
+                        help='Embedding dimensions to compare')
+    parser.add_argument('--top-k', type=int, default=TOP_K, help='Ranked candidates kept per inquiry item')
+    parser.add_argument('--no-rerank', action='store_true',
+                        help='Rank by embedding similarity only, without hierarchical boosts')
+    add_embedding_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    try:
+        client = create_embedder(args)
+        cache = open_embedding_cache(args)
+        if cache is None:
+            logger.warning("Without the embedding cache, latency runs re-embed the inquiry at every dimension")
+
+        descriptions, rates, units, ids = load_pricelist_enhanced(args.pricelist)
+        pricelist_df = pd.DataFrame({'id': ids, 'description': descriptions, 'rate': rates, 'unit': units})
+        items_df = pd.DataFrame(extract_workbook_items(args.inquiry))
+        if items_df.empty:
+            logger.error("No items found in any sheet of the workbook!")
+            return 1
+        labels = load_match_labels(args.labels) if args.labels else None
+        unique_inquiries = unique_text_table(preprocess_batch(inquiry_texts(items_df)))[0]
+        options = {'top_k': args.top_k, 'rerank': not args.no_rerank}
+
+        runs = {}
+        for dimension in sorted(set(args.dimensions), reverse=True):
+            logger.info(f"=== Dimension {dimension} ===")
+            price_index = PricelistIndex.from_dataframe(pricelist_df, client, cache, dimension)
+            matches = match_items(items_df, pricelist_df, client, cache, price_index, options)
+
+            # Per-query scoring latency, one query at a time as a single job row would see it
+            queries = embed_texts_cached(client, unique_inquiries, "search_query", cache, dimension)
+            queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                price_index.search(query[None, :], args.top_k)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            runs[dimension] = {
+                'picked': {(str(m['sheet_name']), int(m['row_number'])): str(m['matched_price_item_id'])
+                           for m in matches},
+                'matched': len(matches),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'index_mb': price_index.embeddings.nbytes / (1024 * 1024),
+            }
+
+        # Agreement is measured against the largest dimension run, accuracy against the labels
+        reference = runs[max(runs)]['picked']
+        for dimension in sorted(runs):
+            run = runs[dimension]
+            report = {
+                'dimension': dimension,
+                'items': len(items_df),
+                'matched': run['matched'],
+                'agreement': round(sum(run['picked'].get(key) == value for key, value in reference.items())
+                                   / max(len(reference), 1), 4),
+                'p50_ms': round(run['p50_ms'], 3),
+                'p95_ms': round(run['p95_ms'], 3),
+                'index_mb': round(run['index_mb'], 2),
+            }
+            if labels:
+                report['accuracy'] = round(sum(run['picked'].get(key) == value for key, value in labels.items())
+                                           / len(labels), 4)
+            print(json.dumps(report), flush=True)
+    except Exception as e:
+        logger.error(f"Error building dimension report: {e}")
+        logger.error(traceback.format_exc())
+        return 1
+
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Enhanced Cohere Excel Price Matching")
+    parser.add_argument('--inquiry', required=True, help='Path to inquiry Excel file')
+    pricelist_source = parser.add_mutually_exclusive_group(required=True)
+    pricelist_source.add_argument('--pricelist', help='Path to pricelist Excel file')
+    pricelist_source.add_argument('--index', help='Path to a pricelist index built with build-index')
+    parser.add_argument('--output', required=True, help='Path for output file')
+    parser.add_argument('--format', choices=RESULT_FORMATS, default='xlsx',
+                       help='Output file format; csv, jsonl and parquet are written directly to --output')
+    parser.add_argument('--api-key', default=os.getenv('COHERE_API_KEY'), help='Cohere API key')
+    parser.add_argument('--similarity-threshold', type=float, default=SIMILARITY_THRESHOLD, 
+                       help='Minimum similarity threshold for matches')
+    parser.add_argument('--top-k', type=int, default=TOP_K,
+                       help='Number of ranked candidates to keep per inquiry item')
+    parser.add_argument('--search', choices=['exact', 'ivf', *QuantizedEmbeddings.TYPES], default='exact',
+                       help='Pricelist search engine; ivf needs an index built with --ivf-lists, '
+                            'int8 / ubinary scan quantized codes and rescore the shortlist. The quantized '
+                            'modes shrink the index (int8 4x, ubinary 32x) but search no faster than exact')
+    parser.add_argument('--nprobe', type=int, default=IVF_NPROBE,
+                       help='IVF cells probed per query (higher = better recall, slower)')
+    parser.add_argument('--dimension', type=int, choices=EMBED_DIMENSIONS, default=OUTPUT_DIMENSION,
+                       help='Embedding output dimension when embedding --pricelist (an index fixes its own)')
+    parser.add_argument('--rescore', type=int,
+                       help='Quantized search shortlists top-k times this many candidates for float rescoring '
+                            f"(default {QUANTIZED_RESCORE['int8']} for int8, {QUANTIZED_RESCORE['ubinary']} for ubinary)")
+    parser.add_argument('--fusion', choices=FUSION_METHODS, default='none',
+                       help='Fuse BM25 candidates into the dense top-k by reciprocal rank (rrf) or weighted score')
+    parser.add_argument('--hybrid-weight', type=float, default=HYBRID_WEIGHT,
+                       help='Dense share of the weighted fusion score (0-1)')
+    parser.add_argument('--check-recall', action='store_true',
+                       help='Also run exact search and log recall of the approximate search')
+    parser.add_argument('--no-rerank', action='store_true',
+                       help='Rank by embedding similarity only, without hierarchical boosts')
+    parser.add_argument('--extract-workers', type=int, default=1,
+                       help='Processes used to extract inquiry sheets (0 = one per CPU)')
+    parser.add_argument('--pipeline', action='store_true',
+                       help='Stream sheets through embedding and search so extraction, API waits and scoring overlap')
+    parser.add_argument('--metrics',
+                       help="Write per-stage timings and counters as JSON to this file ('-' = METRICS: line on stdout)")
+    job = parser.add_mutually_exclusive_group()
+    job.add_argument('--job-id',
+                     help='Checkpoint each stage under this job id so an interrupted run can be resumed')
+    job.add_argument('--resume', metavar='JOB_ID',
+                     help='Resume a checkpointed job, skipping the stages it already completed')
+    parser.add_argument('--checkpoint-dir', default=JOB_CHECKPOINT_DIR,
+                       help='Directory holding job checkpoints')
+    parser.add_argument('--state',
+                       help='Write the row-level match state to this file for re-matching later revisions')
+    parser.add_argument('--previous',
+                       help="Match state (--state) of the previous revision; only added or changed rows are scored")
+    add_embedding_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
     
     args = parser.parse_args()
+    if args.format == 'parquet' and not parquet_engine_available():
+        parser.error("--format parquet requires pyarrow or fastparquet")
     
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
+    job_id = args.resume or args.job_id or str(uuid.uuid4())
+    metrics = JobMetrics(job_id)
+    metrics_token = _job_metrics.set(metrics)
+    progress = ProgressTracker()
     try:
         logger.info("=== Enhanced Cohere Excel Price Matching Started ===")
         logger.info(f"Inquiry file: {args.inquiry}")
-        logger.info(f"Pricelist file: {args.pricelist}")
+        logger.info(f"Pricelist file: {args.pricelist or args.index}")
         logger.info(f"Output file: {args.output}")
         logger.info(f"Similarity threshold: {args.similarity_threshold}")
         
-        # Initialize Cohere client
+        # Initialize the embedding provider
         try:
-            client = cohere.Client(args.api_key)
-            logger.info("Cohere client initialized successfully")
+            client = create_embedder(args)
+            logger.info(f"Embedding provider initialized: {client.model}")
         except Exception as e:
-            raise Exception(f"Failed to initialize Cohere client: {str(e)}")
+            raise Exception(f"Failed to initialize embedding provider: {str(e)}")
         
-        # Load pricelist into DataFrame format for new processing
-        price_descriptions, price_rates, price_units, price_ids = load_pricelist_enhanced(args.pricelist)
+        cache = open_embedding_cache(args)
         
-        # Create pricelist DataFrame
-        pricelist_df = pd.DataFrame({
-            'id': price_ids,
-            'description': price_descriptions,
-            'rate': price_rates,
-            'unit': price_units
-        })
+        price_index = None
+        with metric_span('pricelist_load'):
+            if args.index:
+                # Prebuilt index: no workbook parsing or pricelist embedding needed
+                price_index = PricelistIndex.load(args.index)
+                pricelist_df = price_index.to_dataframe()
+            else:
+                # Load pricelist into DataFrame format for new processing
+                price_descriptions, price_rates, price_units, price_ids = load_pricelist_enhanced(args.pricelist)
+                
+                # Create pricelist DataFrame
+                pricelist_df = pd.DataFrame({
+                    'id': price_ids,
+                    'description': price_descriptions,
+                    'rate': price_rates,
+                    'unit': price_units
+                })
         
         logger.info(f"Loaded pricelist with {len(pricelist_df)} items")
+        count_metric('pricelist_items', len(pricelist_df))
+        progress.update(10, f"Pricelist loaded ({len(pricelist_df)} items)")
         
         # Use new multi-sheet processing
-        job_id = str(uuid.uuid4())
-        output_path = process_all_sheets(args.inquiry, pricelist_df, job_id, client)
+        options = {
+            'top_k': args.top_k,
+            'dimension': args.dimension,
+            'search': args.search,
+            'nprobe': args.nprobe,
+            'rescore': args.rescore,
+            'fusion': args.fusion,
+            'hybrid_weight': args.hybrid_weight,
+            'check_recall': args.check_recall,
+            'rerank': not args.no_rerank,
+            'extract_workers': args.extract_workers or os.cpu_count() or 1,
+            'pipeline': args.pipeline,
+        }
+        
+        checkpoint = None
+        if args.job_id or args.resume:
+            checkpoint = JobCheckpoint(job_id, args.checkpoint_dir)
+            if args.resume and not checkpoint.exists:
+                raise ValueError(f"No checkpoint for job {job_id} in {args.checkpoint_dir}")
+            checkpoint.start(file_sha256(args.inquiry), match_fingerprint(options, client, pricelist_df))
+            if cache is None:
+                cache = checkpoint.embedding_cache()
+        
+        previous = None
+        if args.previous:
+            previous = MatchState.load(args.previous)
+            logger.info(f"Incremental run against {args.previous} ({len(previous.rows)} previous rows)")
+        
+        output_path = process_all_sheets(args.inquiry, pricelist_df, job_id, client, cache, price_index, options,
+                                         progress, output_format=args.format, output_path=args.output,
+                                         checkpoint=checkpoint, previous=previous, state_path=args.state)
         
         if output_path:
-            # Copy output to specified path
-            import shutil
-            shutil.copy2(output_path, args.output)
+            if checkpoint:
+                checkpoint.remove()
+            progress.complete()
             logger.info(f"Processing completed successfully! Output saved to: {args.output}")
         else:
             logger.error("Processing failed - no output generated")
@@ -1129,141 +3731,524 @@ def main():
         import traceback
         logger.error(traceback.format_exc())
         return 1
+    finally:
+        # Failed jobs report their metrics too; they are usually the ones worth looking at
+        _job_metrics.reset(metrics_token)
+        if args.metrics:
+            try:
+                emit_metrics(metrics, args.metrics)
+            except OSError as e:
+                logger.warning(f"Could not write metrics: {e}")
     
     return 0
 
-def process_item_matching(items_df: pd.DataFrame, pricelist_df: pd.DataFrame, job_id: str, client: cohere.Client) -> Optional[str]:
-    """Process item matching and generate output Excel file"""
+def inquiry_texts(items_df: pd.DataFrame) -> List[str]:
+    """Raw text embedded for each inquiry row: the section-enhanced description when present"""
+    texts = []
+    for idx, row in items_df.iterrows():
+        # Use enhanced description for better matching
+        inquiry_desc = row.get('enhanced_description', row.get('original_description', row.get('description', '')))
+        # Ensure we have a valid string for preprocessing
+        if inquiry_desc is None:
+            inquiry_desc = str(row.get('original_description', row.get('description', '')))
+        texts.append(str(inquiry_desc))
+    return texts
+
+def embed_for_matching(provider: EmbeddingProvider, pricelist_df: pd.DataFrame, unique_inquiries: List[str],
+                       cache: Optional[EmbeddingCache], price_index: Optional[PricelistIndex],
+                       dimension: int) -> Tuple[PricelistIndex, np.ndarray]:
+    """Pricelist index (embedded here unless a prebuilt one was supplied) and raw inquiry embeddings"""
+    if price_index is None:
+        with metric_span('pricelist_index'):
+            price_index = PricelistIndex.from_dataframe(pricelist_df, provider, cache, dimension)
+    elif price_index.manifest.get('model', provider.model) != provider.model:
+        raise ValueError(f"Index was built with {price_index.manifest.get('model')}, matcher uses {provider.model}")
+
+    # Generate inquiry embeddings in EMBED_BATCH-sized requests
+    logger.info("Generating inquiry embeddings...")
+    inquiry_embeddings = embed_texts_cached(provider, unique_inquiries, "search_query", cache, price_index.dimension)
+    return price_index, inquiry_embeddings
+
+def match_items(items_df: pd.DataFrame, pricelist_df: pd.DataFrame, client: Embedder,
+                cache: Optional[EmbeddingCache] = None,
+                price_index: Optional[PricelistIndex] = None,
+                options: Optional[Dict[str, Any]] = None,
+                progress: Optional[ProgressTracker] = None) -> List[Dict]:
+    """Embed inquiry items, score them against the pricelist and return the accepted matches"""
+    options = {**DEFAULT_MATCH_OPTIONS, **(options or {})}
+    provider = as_embedding_provider(client)
+    logger.info(f"Matching with {provider.model} embeddings")
+
+    # Process inquiry items
+    logger.info(f"Processing {len(items_df)} inquiry items...")
+
+    # Preprocess all inquiry descriptions up front so they can be embedded in full batches
+    raw_inquiries = inquiry_texts(items_df)
+    processed_inquiries = preprocess_batch(raw_inquiries)
+
+    # Rows across all sheets often repeat the same processed text; embed and search each text once
+    unique_inquiries, text_ids = unique_text_table(processed_inquiries)
+    logger.info(f"{len(unique_inquiries)} distinct inquiry texts across {len(processed_inquiries)} rows")
+    count_metric('items', len(processed_inquiries))
+    count_metric('distinct_inquiry_texts', len(unique_inquiries))
+
+    # Pricelist and inquiries must come from one provider, so a failure switches the whole job to the fallback
     try:
-        logger.info("Cohere client ready for matching")
-        
-        # Prepare data for matching
-        price_descriptions = pricelist_df['description'].tolist()
-        price_rates = pricelist_df['rate'].tolist()
-        price_units = pricelist_df['unit'].tolist()
-        price_ids = pricelist_df['id'].tolist()
-        
-        # Preprocess descriptions
-        processed_price_descs = [enhanced_preprocess(desc, SYNONYM_MAP, STOP_WORDS) 
-                               for desc in price_descriptions]
-        
-        # Generate embeddings
-        logger.info("Generating price embeddings...")
-        price_embeddings = embed_texts_with_retry(client, processed_price_descs, "search_document")
-        price_embeddings_norm = price_embeddings / np.linalg.norm(price_embeddings, axis=1, keepdims=True)
-        
-        # Process inquiry items
-        logger.info(f"Processing {len(items_df)} inquiry items...")
-        
-        matches = []
-        for idx, row in items_df.iterrows():
-            # Use enhanced description for better matching
-            inquiry_desc = row.get('enhanced_description', row.get('original_description', row.get('description', '')))
-            # Ensure we have a valid string for preprocessing
-            if inquiry_desc is None:
-                inquiry_desc = str(row.get('original_description', row.get('description', '')))
-            processed_inquiry = enhanced_preprocess(str(inquiry_desc), SYNONYM_MAP, STOP_WORDS)
-            
-            # Generate inquiry embedding
-            inquiry_embedding = embed_texts_with_retry(client, [processed_inquiry], "search_query")
-            inquiry_embedding_norm = inquiry_embedding / np.linalg.norm(inquiry_embedding)
-            
-            # Calculate similarities
-            similarities = np.dot(price_embeddings_norm, inquiry_embedding_norm.T).flatten()
-            
-            # Find best match
-            best_idx = np.argmax(similarities)
-            best_similarity = similarities[best_idx]
-            
-            if best_similarity >= SIMILARITY_THRESHOLD:
-                match = {
-                    'id': str(uuid.uuid4()),
-                    'original_description': row.get('original_description', row.get('description', '')),
-                    'matched_description': price_descriptions[best_idx],
-                    'matched_rate': price_rates[best_idx],
-                    'similarity_score': float(best_similarity),
-                    'row_number': int(row['row_number']),
-                    'sheet_name': row['sheet_name'],
-                    'quantity': float(row['quantity']),
-                    'unit': price_units[best_idx],
-                    'total_amount': float(row['quantity']) * price_rates[best_idx],
-                    'matched_price_item_id': price_ids[best_idx],
-                    'section_context': row.get('section_context', 'General')
-                }
-                matches.append(match)
-                original_desc = row.get('original_description', row.get('description', ''))
-                logger.debug(f"Matched: {str(original_desc)[:50]}... -> {price_descriptions[best_idx][:50]}... (sim: {best_similarity:.3f})")
-            else:
-                original_desc = row.get('original_description', row.get('description', ''))
-                logger.debug(f"No match found for: {str(original_desc)[:50]}... (best sim: {best_similarity:.3f})")
+        price_index, inquiry_embeddings = embed_for_matching(provider, pricelist_df, unique_inquiries, cache,
+                                                             price_index, options['dimension'])
+    except Exception as e:
+        if provider.fallback is None:
+            raise
+        fallback = provider.fallback
+        logger.warning(f"{provider.model} embedding failed ({e}); matching with {fallback.model} instead")
+        if price_index is not None and price_index.manifest.get('model') != fallback.model:
+            price_index = None
+        price_index, inquiry_embeddings = embed_for_matching(fallback, pricelist_df, unique_inquiries, cache,
+                                                             price_index, options['dimension'])
+    inquiry_embeddings_norm = inquiry_embeddings / np.linalg.norm(inquiry_embeddings, axis=1, keepdims=True)
+
+    if progress:
+        progress.update(30, f"Pricelist ready ({len(price_index)} items)")
+        progress.update(70, "Inquiry embeddings ready")
+
+    # Score all distinct texts at once, then fan the ranked candidates back out to their rows
+    with metric_span('search'):
+        top_indices, top_scores = price_index.search(inquiry_embeddings_norm, options['top_k'],
+                                                     options['search'], options['nprobe'], options['rescore'])
+    return build_matches(items_df, raw_inquiries, text_ids, price_index, inquiry_embeddings_norm,
+                         top_indices, top_scores, options, progress)
+
+def build_matches(items_df: pd.DataFrame, raw_inquiries: List[str], text_ids: np.ndarray,
+                  price_index: PricelistIndex, inquiry_embeddings_norm: np.ndarray,
+                  top_indices: np.ndarray, top_scores: np.ndarray,
+                  options: Dict[str, Any], progress: Optional[ProgressTracker] = None) -> List[Dict]:
+    """Fuse, rerank and threshold the dense top-k of each distinct text, fanned back out to the rows of items_df"""
+    price_descriptions = price_index.descriptions
+    price_rates = price_index.rates
+    price_units = price_index.units
+    price_ids = price_index.ids
+
+    if options['check_recall'] and options['search'] != 'exact':
+        exact_indices, _ = price_index.search(inquiry_embeddings_norm, options['top_k'], 'exact')
+        logger.info(f"{options['search']} recall@{options['top_k']} vs exact search: "
+                    f"{recall_at_k(top_indices, exact_indices):.3f}")
+
+    if options['fusion'] != 'none':
+        # Lexical texts keep the product codes preprocessing drops, so they can split rows that share
+        # a processed text; fuse per distinct lexical text, each pointing back at its dense row
+        lexical_texts, lexical_ids = unique_text_table([lexical_text(text) for text in raw_inquiries])
+        dense_rows = text_ids[np.unique(lexical_ids, return_index=True)[1]]
+        with metric_span('fusion'):
+            top_indices, top_scores = price_index.fuse_lexical(
+                inquiry_embeddings_norm[dense_rows], lexical_texts, top_indices[dense_rows],
+                options['top_k'], options['fusion'], options['hybrid_weight']
+            )
+        text_ids = lexical_ids
+    top_indices, top_scores = top_indices[text_ids], top_scores[text_ids]
+
+    score_details = None
+    if options['rerank']:
+        with metric_span('rerank'):
+            top_indices, top_scores, score_details = hierarchical_match_scoring(
+                items_df.to_dict('records'), price_index.features, top_indices, top_scores
+            )
+
+    matches = []
+    for position, (idx, row) in enumerate(items_df.iterrows()):
+        best_idx = int(top_indices[position, 0])
+        best_similarity = top_scores[position, 0]
         
-        # Generate output Excel file compatible with existing JavaScript parser
-        output_path = os.path.join('output', f'processed-{job_id}-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx')
-        os.makedirs('output', exist_ok=True)
+        if best_similarity >= SIMILARITY_THRESHOLD:
+            match = {
+                'id': str(uuid.uuid4()),
+                'original_description': row.get('original_description', row.get('description', '')),
+                'matched_description': price_descriptions[best_idx],
+                'matched_rate': price_rates[best_idx],
+                'similarity_score': float(best_similarity),
+                'row_number': int(row['row_number']),
+                'sheet_name': row['sheet_name'],
+                'quantity': float(row['quantity']),
+                'unit': price_units[best_idx],
+                'total_amount': float(row['quantity']) * price_rates[best_idx],
+                'matched_price_item_id': price_ids[best_idx],
+                'section_context': row.get('section_context', 'General'),
+                'match_details': {
+                    name: float(values[position, 0]) for name, values in score_details.items()
+                } if score_details else None,
+                'alternatives': [
+                    {
+                        'matched_price_item_id': price_ids[alt_idx],
+                        'matched_description': price_descriptions[alt_idx],
+                        'matched_rate': price_rates[alt_idx],
+                        'similarity_score': float(alt_score)
+                    }
+                    for alt_idx, alt_score in zip(top_indices[position, 1:], top_scores[position, 1:])
+                    if alt_idx >= 0
+                ]
+            }
+            matches.append(match)
+            original_desc = row.get('original_description', row.get('description', ''))
+            logger.debug(f"Matched: {str(original_desc)[:50]}... -> {price_descriptions[best_idx][:50]}... (sim: {best_similarity:.3f})")
+        else:
+            original_desc = row.get('original_description', row.get('description', ''))
+            logger.debug(f"No match found for: {str(original_desc)[:50]}... (best sim: {best_similarity:.3f})")
+
+    count_metric('matches', len(matches))
+    if progress:
+        progress.update(85, f"Scored {len(items_df)} items, {len(matches)} matched")
+    return matches
+
+def match_items_incremental(items_df: pd.DataFrame, pricelist_df: pd.DataFrame, client: Embedder,
+                            previous: MatchState,
+                            cache: Optional[EmbeddingCache] = None,
+                            price_index: Optional[PricelistIndex] = None,
+                            options: Optional[Dict[str, Any]] = None,
+                            progress: Optional[ProgressTracker] = None) -> List[Dict]:
+    """match_items for a revision of a previously matched inquiry
+
+    Only rows whose MATCH_KEY_FIELDS are new are embedded and scored; the others keep their
+    previous match with the current row number, quantity and total_amount.
+    """
+    options = {**DEFAULT_MATCH_OPTIONS, **(options or {})}
+    if previous.fingerprint != match_fingerprint(options, client, pricelist_df):
+        logger.warning("Pricelist, embedder or options changed since the previous run; matching every row")
+        return match_items(items_df, pricelist_df, client, cache, price_index, options, progress)
+
+    items = items_df.to_dict('records')
+    keys = [MatchState.item_key(item) for item in items]
+    changed = [position for position, key in enumerate(keys) if key not in previous.rows]
+    logger.info(f"Incremental match: {len(changed)} of {len(items)} rows added or changed")
+    count_metric('rows_reused', len(items) - len(changed))
+
+    fresh = {}
+    if changed:
+        changed_df = items_df.iloc[changed].reset_index(drop=True)
+        for match in match_items(changed_df, pricelist_df, client, cache, price_index, options, progress):
+            fresh[(match['sheet_name'], match['row_number'])] = match
+
+    matches = []
+    for key, item in zip(keys, items):
+        row_number = int(item['row_number'])
+        if key not in previous.rows:
+            match = fresh.get((item['sheet_name'], row_number))
+        elif previous.rows[key] is not None:
+            prior = previous.rows[key]
+            quantity = float(item['quantity'])
+            match = {**prior, 'id': str(uuid.uuid4()), 'row_number': row_number,
+                     'quantity': quantity, 'total_amount': quantity * prior['matched_rate']}
+        else:
+            match = None
+        if match is not None:
+            matches.append(match)
+
+    count_metric('matches', len(matches))
+    if progress:
+        progress.update(85, f"Scored {len(changed)} changed items, {len(matches)} matched")
+    return matches
+
+def match_workbook_pipelined(workbook_path: str, pricelist_df: pd.DataFrame, client: Embedder,
+                             cache: Optional[EmbeddingCache] = None,
+                             price_index: Optional[PricelistIndex] = None,
+                             options: Optional[Dict[str, Any]] = None,
+                             progress: Optional[ProgressTracker] = None) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Extract, embed and search an inquiry workbook as one streaming pipeline.
+
+    An extraction thread yields sheets; this thread preprocesses their rows and groups new
+    distinct texts into EMBED_BATCH requests for an EMBED_CONCURRENCY-thread pool; a scoring
+    thread searches each batch as soon as its vectors arrive. The pricelist index is embedded
+    alongside. Bounded queues between the stages give backpressure, so a slow stage holds back
+    the ones feeding it rather than letting work pile up. Fusion, reranking and thresholding run
+    once the stream ends, through the same build_matches as match_items, so the matches are
+    identical to the phased path. If embedding fails and the provider has a fallback, the
+    extracted items are matched with match_items on the fallback instead.
+
+    Returns: (items, matches)
+    """
+    options = {**DEFAULT_MATCH_OPTIONS, **(options or {})}
+    provider = as_embedding_provider(client)
+    dimension = price_index.dimension if price_index is not None else options['dimension']
+    logger.info(f"Matching with {provider.model} embeddings (pipelined)")
+
+    sheets = queue.Queue(maxsize=PIPELINE_QUEUE_DEPTH)
+    batches = queue.Queue(maxsize=EMBED_CONCURRENCY)  # Embed futures waiting to be scored
+    searched = []  # (normalized vectors, top indices, top scores) per batch, in text order
+    failures = []
+    stop = threading.Event()  # Set when the consumer gives up, so extraction doesn't block on a full queue
+
+    def prepare_index() -> PricelistIndex:
+        if price_index is None:
+            with metric_span('pricelist_index'):
+                return PricelistIndex.from_dataframe(pricelist_df, provider, cache, dimension)
+        if price_index.manifest.get('model', provider.model) != provider.model:
+            raise ValueError(f"Index was built with {price_index.manifest.get('model')}, "
+                             f"matcher uses {provider.model}")
+        return price_index
+
+    def publish(entry) -> bool:
+        """Queue an entry for the consumer; False if it stopped listening first"""
+        while not stop.is_set():
+            try:
+                sheets.put(entry, timeout=PIPELINE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def extract():
+        sheet_stream = iter_workbook_items(workbook_path, options['extract_workers'])
+        try:
+            for sheet_items in sheet_stream:
+                if not publish(sheet_items):
+                    return
+            publish(None)
+        except Exception as e:
+            publish(e)
+        finally:
+            sheet_stream.close()  # Closes the workbook or process pool of an abandoned job
+
+    def score():
+        # Keeps draining after a failure so the batching thread never blocks on a full queue
+        while (future := batches.get()) is not None:
+            if failures:
+                continue
+            try:
+                vectors = future.result()
+                index = index_future.result()
+                norm = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+                with metric_span('search'):
+                    searched.append((norm, *index.search(norm, options['top_k'], options['search'],
+                                                         options['nprobe'], options['rescore'])))
+            except Exception as e:
+                failures.append(e)
+
+    items, raw_inquiries, text_ids, text_table, pending = [], [], [], {}, []
+    with ThreadPoolExecutor(max_workers=1) as index_pool, \
+            ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as embed_pool:
+        # Worker threads run in copies of this context so they report to the same job metrics
+        index_future = index_pool.submit(contextvars.copy_context().run, prepare_index)
+        extractor = threading.Thread(target=contextvars.copy_context().run, args=(extract,), daemon=True)
+        extractor.start()
+        scorer = threading.Thread(target=contextvars.copy_context().run, args=(score,), daemon=True)
+        scorer.start()
+
+        def flush():
+            if pending and not failures:
+                batches.put(embed_pool.submit(contextvars.copy_context().run, embed_texts_cached, provider,
+                                              list(pending), "search_query", cache, dimension))
+            pending.clear()
+
+        try:
+            while (sheet_items := sheets.get()) is not None:
+                if isinstance(sheet_items, Exception):
+                    raise sheet_items
+                if not sheet_items:
+                    continue
+                items.extend(sheet_items)
+                sheet_texts = inquiry_texts(pd.DataFrame(sheet_items))
+                raw_inquiries.extend(sheet_texts)
+                with metric_span('preprocess'):
+                    processed = preprocess_batch(sheet_texts)
+                for text in processed:
+                    if text not in text_table:
+                        text_table[text] = len(text_table)
+                        pending.append(text)
+                        if len(pending) == EMBED_BATCH:
+                            flush()
+                    text_ids.append(text_table[text])
+                if progress:
+                    progress.update(20, f"Extracted {len(items)} items")
+            flush()
+        finally:
+            stop.set()
+            while True:
+                try:
+                    sheets.get_nowait()
+                except queue.Empty:
+                    break
+            extractor.join()
+            batches.put(None)
+            scorer.join()
+
+        if items and not failures:
+            try:
+                index = index_future.result()
+            except Exception as e:
+                failures.append(e)
+
+    if not items:
+        return items, []
+
+    items_df = pd.DataFrame(items)
+    if failures:
+        if provider.fallback is None:
+            raise failures[0]
+        fallback = provider.fallback
+        logger.warning(f"{provider.model} embedding failed ({failures[0]}); matching with {fallback.model} instead")
+        if price_index is not None and price_index.manifest.get('model') != fallback.model:
+            price_index = None
+        return items, match_items(items_df, pricelist_df, fallback, cache, price_index, options, progress)
+
+    logger.info(f"{len(text_table)} distinct inquiry texts across {len(items)} rows")
+    count_metric('items', len(items))
+    count_metric('distinct_inquiry_texts', len(text_table))
+    if progress:
+        progress.update(70, "Inquiry embeddings searched")
+    inquiry_embeddings_norm, top_indices, top_scores = (np.concatenate(parts) for parts in zip(*searched))
+    return items, build_matches(items_df, raw_inquiries, np.asarray(text_ids, dtype=np.int64), index,
+                                inquiry_embeddings_norm, top_indices, top_scores, options, progress)
+
+# Columns of the results sheet, in the order the JavaScript parser reads them
+RESULT_COLUMNS = [
+    'original_description',
+    'matched_description',
+    'matched_rate',
+    'similarity_score',
+    'quantity',
+    'unit',
+    'total_amount',
+    'matched_price_item_id',
+    'row_number',
+    'sheet_name'
+]
+MAX_COLUMN_WIDTH = 50
+RESULT_FORMATS = ['xlsx', 'csv', 'jsonl', 'parquet']
+
+def result_column_widths(matches: List[Dict]) -> List[int]:
+    """Auto-size widths for the results sheet from raw values, skipping columns already at the cap"""
+    lengths = [len(header) for header in RESULT_COLUMNS]
+    cap = MAX_COLUMN_WIDTH - 2
+    for match in matches:
+        for col, name in enumerate(RESULT_COLUMNS):
+            if lengths[col] < cap:
+                lengths[col] = max(lengths[col], len(str(match[name])))
+    return [min(length + 2, MAX_COLUMN_WIDTH) for length in lengths]
+
+def write_results_workbook(matches: List[Dict], job_id: str) -> Optional[str]:
+    """Write matches to output/processed-<job>-<timestamp>.xlsx in the layout the JavaScript parser expects
+
+    Uses a write-only workbook so rows are streamed to disk without building
+    a cell object per value; widths are measured up front because a
+    write-only sheet emits its column definitions before the first row.
+    """
+    # Generate output Excel file compatible with existing JavaScript parser
+    output_path = os.path.join('output', f'processed-{job_id}-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx')
+    os.makedirs('output', exist_ok=True)
+    
+    if matches:
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Results")
         
-        if matches:
-            # Create Excel workbook with openpyxl directly for better control
-            from openpyxl import Workbook
-            from openpyxl.styles import Font, PatternFill
-            
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Results"
-            
-            # Define headers to match what JavaScript expects
-            headers = [
-                'original_description',
-                'matched_description', 
-                'matched_rate',
-                'similarity_score',
-                'quantity',
-                'unit',
-                'total_amount',
-                'matched_price_item_id',
-                'row_number',
-                'sheet_name'
-            ]
-            
-            # Add headers with formatting
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col, value=header)
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
-            
-            # Add data rows
-            for row_idx, match in enumerate(matches, 2):
-                ws.cell(row=row_idx, column=1, value=match['original_description'])
-                ws.cell(row=row_idx, column=2, value=match['matched_description'])
-                ws.cell(row=row_idx, column=3, value=match['matched_rate'])
-                ws.cell(row=row_idx, column=4, value=match['similarity_score'])
-                ws.cell(row=row_idx, column=5, value=match['quantity'])
-                ws.cell(row=row_idx, column=6, value=match['unit'])
-                ws.cell(row=row_idx, column=7, value=match['total_amount'])
-                ws.cell(row=row_idx, column=8, value=match['matched_price_item_id'])
-                ws.cell(row=row_idx, column=9, value=match['row_number'])
-                ws.cell(row=row_idx, column=10, value=match['sheet_name'])
-            
-            # Auto-size columns
-            for column in ws.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                ws.column_dimensions[column_letter].width = adjusted_width
-            
-            # Save workbook
-            wb.save(output_path)
-            
-            logger.info(f"Generated output file with {len(matches)} matches: {output_path}")
+        # Auto-size columns
+        for col, width in enumerate(result_column_widths(matches), 1):
+            ws.column_dimensions[get_column_letter(col)].width = width
+        
+        # Add headers with formatting
+        header_cells = []
+        for header in RESULT_COLUMNS:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.font = Font(bold=True)
+            cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
+            header_cells.append(cell)
+        ws.append(header_cells)
+        
+        # Add data rows
+        for match in matches:
+            ws.append([match[name] for name in RESULT_COLUMNS])
+        
+        # Save workbook
+        wb.save(output_path)
+        
+        logger.info(f"Generated output file with {len(matches)} matches: {output_path}")
+        return output_path
+    else:
+        logger.warning("No matches found!")
+        return None
+
+def write_results(matches: List[Dict], job_id: str, output_format: str = 'xlsx',
+                  output_path: Optional[str] = None) -> Optional[str]:
+    """Write matches as xlsx, csv, jsonl or parquet and return the path written
+
+    Columnar formats go straight to output_path (or output/processed-<job>-<timestamp>.<ext>)
+    with the RESULT_COLUMNS contract; xlsx keeps the export workbook layout and is
+    copied to output_path when one is given.
+    """
+    with metric_span('write'):
+        return _write_results(matches, job_id, output_format, output_path)
+
+def _write_results(matches: List[Dict], job_id: str, output_format: str,
+                   output_path: Optional[str]) -> Optional[str]:
+    if output_format == 'xlsx':
+        workbook_path = write_results_workbook(matches, job_id)
+        if workbook_path and output_path:
+            shutil.copy2(workbook_path, output_path)
             return output_path
+        return workbook_path
+    if output_format not in RESULT_FORMATS:
+        raise ValueError(f"Unsupported output format '{output_format}' (expected one of {RESULT_FORMATS})")
+    
+    if not matches:
+        logger.warning("No matches found!")
+        return None
+    
+    if output_path is None:
+        output_path = os.path.join('output', f'processed-{job_id}-{datetime.now().strftime("%Y%m%d_%H%M%S")}.{output_format}')
+        os.makedirs('output', exist_ok=True)
+    
+    results_df = pd.DataFrame(matches, columns=RESULT_COLUMNS)
+    if output_format == 'csv':
+        results_df.to_csv(output_path, index=False)
+    elif output_format == 'jsonl':
+        results_df.to_json(output_path, orient='records', lines=True, force_ascii=False)
+    else:
+        results_df.to_parquet(output_path, index=False)
+    
+    logger.info(f"Generated {output_format} output with {len(matches)} matches: {output_path}")
+    return output_path
+
+def parquet_engine_available() -> bool:
+    """pandas needs pyarrow or fastparquet to write parquet"""
+    import importlib.util
+    return any(importlib.util.find_spec(engine) for engine in ('pyarrow', 'fastparquet'))
+
+def process_item_matching(items_df: pd.DataFrame, pricelist_df: pd.DataFrame, job_id: str, client: Embedder,
+                          cache: Optional[EmbeddingCache] = None,
+                          price_index: Optional[PricelistIndex] = None,
+                          options: Optional[Dict[str, Any]] = None,
+                          progress: Optional[ProgressTracker] = None,
+                          output_format: str = 'xlsx',
+                          output_path: Optional[str] = None,
+                          checkpoint: Optional[JobCheckpoint] = None,
+                          previous: Optional[MatchState] = None,
+                          state_path: Optional[str] = None,
+                          matches: Optional[List[Dict]] = None) -> Optional[str]:
+    """Process item matching and write the results file
+
+    With a previous MatchState only added or changed rows are scored; state_path receives
+    this run's MatchState for the next revision. matches are used as given when the
+    rows were already scored (by the pipelined path).
+    """
+    try:
+        if matches is not None:
+            if checkpoint:
+                checkpoint.save_matches(matches)
+        elif checkpoint and (matches := checkpoint.load_matches()) is not None:
+            logger.info(f"Reusing {len(matches)} scored rows from the job checkpoint")
         else:
-            logger.warning("No matches found!")
-            return None
+            if previous is not None:
+                matches = match_items_incremental(items_df, pricelist_df, client, previous, cache, price_index,
+                                                  options, progress)
+            else:
+                matches = match_items(items_df, pricelist_df, client, cache, price_index, options, progress)
+            if checkpoint:
+                checkpoint.save_matches(matches)
+        if state_path:
+            fingerprint = match_fingerprint(options or {}, client, pricelist_df)
+            MatchState.from_matches(items_df.to_dict('records'), matches, fingerprint).save(state_path)
+        output_path = write_results(matches, job_id, output_format, output_path)
+        if progress:
+            progress.update(100, "Results written")
+        return output_path
             
     except Exception as e:
         logger.error(f"Error in process_item_matching: {e}")
@@ -1271,5 +4256,16 @@ def process_item_matching(items_df: pd.DataFrame, pricelist_df: pd.DataFrame, jo
         logger.error(traceback.format_exc())
         return None
 
+SUBCOMMANDS = {
+    'build-index': build_index_main,
+    'update-index': update_index_main,
+    'compact-index': compact_index_main,
+    'serve': serve_main,
+    'embed-broker': embed_broker_main,
+    'dimension-report': dimension_report_main,
+}
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        sys.exit(SUBCOMMANDS[sys.argv[1]](sys.argv[2:]))
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+Correctness tests for the matcher's caching, incremental and streaming paths.
+
+Workbooks come from the benchmark's synthetic generators and embeddings from its
+FakeEmbeddingClient, so no API key or network is needed:
+
+    python -m pytest server/services/test_cohereexcelparsing.py
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+import coherebenchmark
+import cohereexcelparsing as matcher
+from coherebenchmark import FakeEmbeddingClient, generate_boq, generate_pricelist
+
+DIMENSION = 256  # Smallest embed-v4.0 size keeps the tests quick; the code paths are the same
+
+@pytest.fixture(scope='module')
+def workbooks(tmp_path_factory):
+    """(pricelist path, inquiry path, pricelist rows) of a small synthetic project"""
+    directory = tmp_path_factory.mktemp('workbooks')
+    pricelist_path = str(directory / 'pricelist.xlsx')
+    inquiry_path = str(directory / 'inquiry.xlsx')
+    pricelist = generate_pricelist(pricelist_path, 150)
+    generate_boq(inquiry_path, pricelist, sheets=2, rows_per_sheet=40, seed=1)
+    return pricelist_path, inquiry_path, pricelist
+
+@pytest.fixture
+def pricelist_df(workbooks):
+    descriptions, rates, units, ids = matcher.load_pricelist_enhanced(workbooks[0])
+    return pd.DataFrame({'id': ids, 'description': descriptions, 'rate': rates, 'unit': units})
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Skip the embedding retry back-off"""
+    monkeypatch.setattr(matcher.time, 'sleep', lambda seconds: None)
+
+def match_rows(matches):
+    """Comparable content of matches: everything except the per-run uuid"""
+    return sorted((match['sheet_name'], match['row_number'], match['matched_price_item_id'],
+                   round(match['similarity_score'], 5), match['quantity'], round(match['total_amount'], 4))
+                  for match in matches)
+
+def build_index(workbooks, client):
+    return matcher.PricelistIndex.build(workbooks[0], client, None, DIMENSION)
+
+def test_benchmark_reports_a_successful_run(tmp_path):
+    report_path = tmp_path / 'report.json'
+    assert coherebenchmark.main(['--pricelist-rows', '60', '--sheets', '2', '--rows-per-sheet', '20',
+                                 '--latency', '0', '--workdir', str(tmp_path), '--report', str(report_path)]) == 0
+
+    with open(report_path) as f:
+        report = json.load(f)
+    run = report['runs'][0]
+    assert run['succeeded']
+    assert 0 < run['matches'] <= run['items'] <= 40
+    assert run['api_calls'] > 0
+    assert {'load_pricelist', 'extract', 'match', 'write'} <= set(run['stage_seconds'])
+
+def test_resume_reuses_checkpointed_items(workbooks, tmp_path, monkeypatch, no_sleep):
+    pricelist_path, inquiry_path, _ = workbooks
+    checkpoints = str(tmp_path / 'jobs')
+
+    def run(client, *args):
+        monkeypatch.setattr(matcher.cohere, 'Client', lambda *a, **k: client)
+        monkeypatch.setattr('sys.argv', ['cohereexcelparsing.py', '--inquiry', inquiry_path,
+                                         '--pricelist', pricelist_path, '--api-key', 'test', '--no-cache',
+                                         '--embedder', 'cohere', '--dimension', str(DIMENSION),
+                                         '--checkpoint-dir', checkpoints, '--format', 'jsonl', *args])
+        return matcher.main()
+
+    class FailingClient(FakeEmbeddingClient):
+        def embed(self, *args, **kwargs):
+            raise ConnectionError("API unavailable")
+
+    assert run(FailingClient(), '--job-id', 'job-1', '--output', str(tmp_path / 'failed.jsonl')) == 1
+    checkpoint = matcher.JobCheckpoint('job-1', checkpoints)
+    assert checkpoint.load_items()
+
+    def no_extraction(*args, **kwargs):
+        raise AssertionError("resumed job extracted the workbook again")
+
+    monkeypatch.setattr(matcher, 'extract_workbook_items', no_extraction)
+    resumed_path = tmp_path / 'resumed.jsonl'
+    assert run(FakeEmbeddingClient(), '--resume', 'job-1', '--output', str(resumed_path)) == 0
+    assert not os.path.exists(checkpoint.path)
+
+    monkeypatch.undo()
+    items = matcher.extract_workbook_items(inquiry_path)
+    with open(resumed_path) as f:
+        resumed = [json.loads(line) for line in f]
+    assert len(resumed) == len(items)
+
+def test_incremental_rematch_equals_full_rerun(workbooks, pricelist_df):
+    client = FakeEmbeddingClient()
+    options = {'dimension': DIMENSION}
+    price_index = build_index(workbooks, client)
+    items = matcher.extract_workbook_items(workbooks[1])
+    previous_matches = matcher.match_items(pd.DataFrame(items), pricelist_df, client, None, price_index, options)
+    previous = matcher.MatchState.from_matches(items, previous_matches,
+                                               matcher.match_fingerprint(options, client, pricelist_df))
+
+    # Revision: reworded rows, deleted rows and re-quantified rows
+    revised = [dict(item) for item in items[3:]]
+    replacements = workbooks[2][:4]
+    for item, (_, description, _, _) in zip(revised[::10], replacements):
+        item.update(description=description, original_description=description, enhanced_description=description)
+    for item in revised[1::7]:
+        item['quantity'] = float(item['quantity']) + 1
+
+    calls = client.calls
+    texts = client.texts
+    incremental = matcher.match_items_incremental(pd.DataFrame(revised), pricelist_df, client, previous,
+                                                  None, price_index, options)
+    assert client.texts - texts <= len(replacements)
+    assert client.calls - calls <= 1
+
+    full = matcher.match_items(pd.DataFrame(revised), pricelist_df, FakeEmbeddingClient(), None, price_index, options)
+    assert match_rows(incremental) == match_rows(full)
+
+def test_tombstoned_rows_are_never_returned(workbooks, pricelist_df):
+    client = FakeEmbeddingClient()
+    index = build_index(workbooks, client)
+    index.train_ivf(8)
+    for embedding_type in matcher.QuantizedEmbeddings.TYPES:
+        index.quantize(embedding_type)
+
+    # Drop some rows and reword others, so both removed and changed rows are tombstoned
+    revised = pricelist_df.drop(index=range(0, 150, 9)).reset_index(drop=True)
+    revised.loc[::11, 'description'] = revised.loc[::11, 'description'] + ' with stainless steel fixings'
+    updated, stats = index.update(revised, client)
+    assert stats['removed'] and stats['changed']
+    dead = set(updated.dead_rows.tolist())
+
+    # Each dead row's own vector is its best possible query
+    queries = np.asarray(updated.embeddings[updated.dead_rows], dtype=np.float32)
+    for method in ('exact', 'ivf', *matcher.QuantizedEmbeddings.TYPES):
+        indices, _ = updated.search(queries, k=5, method=method, nprobe=8)
+        assert not dead & set(indices.ravel().tolist()), method
+
+    removed_ids = set(pricelist_df['id']) - set(revised['id'])
+    dead_descriptions = [updated.descriptions[row] for row in updated.dead_rows]
+    items = pd.DataFrame({'description': dead_descriptions, 'original_description': dead_descriptions,
+                          'quantity': 1.0, 'row_number': range(1, len(dead_descriptions) + 1),
+                          'sheet_name': 'Bill 1', 'section_context': 'General'})
+    for fusion in ('rrf', 'weighted'):
+        matches = matcher.match_items(items, revised, client, None, updated, {'fusion': fusion})
+        assert not removed_ids & {match['matched_price_item_id'] for match in matches}, fusion
+
+def write_pricelist(path, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["ID", "Description", "Rate", "Unit"])
+    # load_pricelist_enhanced takes any early cell containing "id" (as in "Provide") for the ID header
+    for row in sorted(rows, key=lambda row: 'id' in row[1].lower()):
+        sheet.append(list(row))
+    workbook.save(path)
+    return str(path)
+
+def test_update_and_compact_index_cli(workbooks, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(matcher.cohere, 'Client', lambda *a, **k: FakeEmbeddingClient())
+    launched = []
+    monkeypatch.setattr(matcher.subprocess, 'Popen', lambda command, **kwargs: launched.append(command))
+    pricelist_path, _, pricelist = workbooks
+    root = str(tmp_path / 'index')
+    embedding_args = ['--api-key', 'test', '--no-cache']
+
+    def last_report():
+        return json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+    def current_version():
+        return matcher.PricelistIndex.load(root).manifest['version']
+
+    assert matcher.build_index_main(['--pricelist', pricelist_path, '--index', root, '--dimension', str(DIMENSION),
+                                     *embedding_args]) == 0
+    built = current_version()
+
+    # A small revision stays below --compact-ratio: tombstones only
+    revision = write_pricelist(tmp_path / 'revision1.xlsx', pricelist[10:])
+    assert matcher.update_index_main(['--pricelist', revision, '--index', root, '--compact-ratio', '0.5',
+                                      *embedding_args]) == 0
+    report = last_report()
+    assert report['removed'] == 10 and report['tombstones'] == 10 and report['compaction'] is None
+    assert current_version() == report['version'] != built
+    assert matcher.update_index_main(['--pricelist', revision, '--index', root, *embedding_args]) == 0
+    assert last_report()['version'] == report['version']  # Nothing changed, nothing published
+
+    # Crossing the ratio compacts in the foreground when asked to
+    revision = write_pricelist(tmp_path / 'revision2.xlsx', pricelist[20:])
+    assert matcher.update_index_main(['--pricelist', revision, '--index', root, '--compact-ratio', '0.1',
+                                      '--compact-foreground', *embedding_args]) == 0
+    assert last_report()['compaction'] == 'done'
+    compacted = matcher.PricelistIndex.load(root)
+    assert compacted.tombstones is None and len(compacted) == len(pricelist) - 20
+    assert not launched
+
+    # ... and otherwise launches compact-index for the version it just published
+    revision = write_pricelist(tmp_path / 'revision3.xlsx', pricelist[40:])
+    assert matcher.update_index_main(['--pricelist', revision, '--index', root, '--compact-ratio', '0.1',
+                                      *embedding_args]) == 0
+    report = last_report()
+    assert report['compaction'] == 'started'
+    assert launched[-1][-4:] == ['--index', root, '--version', report['version']]
+    assert len(matcher.PricelistIndex.load(root)) == len(pricelist) - 20  # Tombstoned, not yet compacted
+
+    # A compactor started for an older version leaves the newer one alone
+    assert matcher.compact_index_main(['--index', root, '--version', built]) == 0
+    assert current_version() == report['version']
+    assert matcher.compact_index_main(['--index', root, '--version', report['version']]) == 0
+    compacted = matcher.PricelistIndex.load(root)
+    assert compacted.tombstones is None and len(compacted) == len(pricelist) - 40
+
+    # A writer that started from a version that is no longer CURRENT must not publish over it
+    stale = matcher.PricelistIndex.load(root)
+    stale_version = stale.manifest['version']
+    matcher.PricelistIndex.load(root).save(root, expected_version=stale_version)
+    with pytest.raises(RuntimeError):
+        stale.save(root, expected_version=stale_version)
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'fusion': 'rrf'},
+    {'search': 'int8', 'rerank': False},
+])
+def test_pipelined_matches_equal_phased(workbooks, pricelist_df, options):
+    options = {'dimension': DIMENSION, **options}
+    inquiry_path = workbooks[1]
+
+    items = matcher.extract_workbook_items(inquiry_path)
+    phased = matcher.match_items(pd.DataFrame(items), pricelist_df, FakeEmbeddingClient(), options=options)
+    pipelined_items, pipelined = matcher.match_workbook_pipelined(inquiry_path, pricelist_df, FakeEmbeddingClient(),
+                                                                  options=options)
+
+    assert pipelined_items == items
+    assert match_rows(pipelined) == match_rows(phased)
+
+def test_pipeline_failure_releases_extraction(workbooks, pricelist_df, tmp_path):
+    # More sheets than the pipeline queue holds, so extraction would block if nobody drained it
+    inquiry_path = str(tmp_path / 'many_sheets.xlsx')
+    generate_boq(inquiry_path, workbooks[2], sheets=matcher.PIPELINE_QUEUE_DEPTH + 4, rows_per_sheet=5, seed=2)
+
+    def fail(percentage, message):
+        raise RuntimeError("progress consumer went away")
+
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError, match="progress consumer"):
+        matcher.match_workbook_pipelined(inquiry_path, pricelist_df, FakeEmbeddingClient(),
+                                         options={'dimension': DIMENSION},
+                                         progress=matcher.ProgressTracker(callback=fail))
+    assert threading.active_count() == threads
+
+class GatedClient(FakeEmbeddingClient):
+    """Holds every embed call until the test opens the gate, so all requests overlap in flight"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def embed(self, texts, model=None, input_type=None, embedding_types=None, output_dimension=None,
+              request_options=None):
+        self.gate.wait(10)
+        return super().embed(texts, model, input_type, embedding_types, output_dimension, request_options)
+
+def test_broker_deduplicates_concurrent_requests(tmp_path):
+    client = GatedClient()
+    coalescer = matcher.EmbeddingCoalescer(client, linger=0.05, concurrency=2)
+    socket_path = str(tmp_path / 'broker.sock')
+    server = threading.Thread(target=matcher.serve_embed_broker, args=(coalescer, socket_path), daemon=True)
+    server.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+
+    # Three jobs asking for overlapping texts at the same time
+    texts = [f"Supply and fix {size}mm uPVC pipe" for size in range(0, 200, 2)]
+    requests = [texts[:60], texts[30:], texts[::2]]
+    results = [None] * len(requests)
+
+    def job(position):
+        provider = matcher.BrokerProvider(socket_path)
+        results[position] = provider.embed(requests[position], 'search_query', DIMENSION)
+
+    jobs = [threading.Thread(target=job, args=(position,), daemon=True) for position in range(len(requests))]
+    for thread in jobs:
+        thread.start()
+    total = sum(map(len, requests))
+    for _ in range(200):
+        with coalescer.condition:
+            if coalescer.stats['texts'] == total:
+                break
+        time.sleep(0.05)
+    client.gate.set()
+    for thread in jobs:
+        thread.join(30)
+    assert all(vectors is not None for vectors in results)
+
+    stats = matcher.broker_request(socket_path, {'command': 'stats'})
+    matcher.broker_request(socket_path, {'command': 'shutdown'})
+    server.join(5)
+
+    assert stats['embedded'] == len(texts)
+    assert stats['deduplicated'] == total - len(texts)
+    assert client.calls == stats['batches']
+    direct = matcher.LocalNgramProvider()
+    for request, vectors in zip(requests, results):
+        assert vectors.shape == (len(request), DIMENSION)
+        np.testing.assert_allclose(vectors, direct.embed(request, 'search_query', DIMENSION), rtol=1e-6)
+def test_extract_workers_in_pipeline_and_serve_worker(workbooks, pricelist_df, tmp_path):
+    inquiry_path = workbooks[1]
+    options = {'dimension': DIMENSION, 'extract_workers': 2}
+    items = matcher.extract_workbook_items(inquiry_path)
+    expected = match_rows(matcher.match_items(pd.DataFrame(items), pricelist_df, FakeEmbeddingClient(),
+                                              options=options))
+
+    pipelined_items, pipelined = matcher.match_workbook_pipelined(inquiry_path, pricelist_df, FakeEmbeddingClient(),
+                                                                  options={**options, 'pipeline': True})
+    assert pipelined_items == items
+    assert match_rows(pipelined) == expected
+
+    worker = matcher.MatcherWorker(FakeEmbeddingClient(), None, pricelist_path=workbooks[0], dimension=DIMENSION)
+    events = []
+    worker.handle({'command': 'match', 'job_id': 'workers', 'inquiry': inquiry_path, 'format': 'jsonl',
+                   'output': str(tmp_path / 'worker.jsonl'), 'options': options, 'return_matches': True},
+                  events.append)
+    assert events[-1]['event'] == 'result', events[-1]
+    assert match_rows(events[-1]['results']) == expected